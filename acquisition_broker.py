@@ -0,0 +1,256 @@
+import itertools
+import json
+import logging
+import os
+import queue
+import threading
+from multiprocessing.connection import Client, Listener
+
+from metrics import setup_logging
+from stations import load_stations
+
+logger = logging.getLogger(__name__)
+
+# Only one process can own a COM port. The broker is that process: it holds
+# every station's RS485 session and hands out readings over local IPC, so the
+# web app can run several workers and CLI tools can read the sensors while the
+# app is up.
+#
+#   python acquisition_broker.py          # listens on BROKER_ADDRESS
+#   QA_BROKER_ADDRESS=127.0.0.1:6001 python app.py
+#
+# The address is "host:port" for a TCP socket on localhost, or a path for a
+# Unix socket (\\.\pipe\<name> for a Windows named pipe).
+#
+# Messages are JSON sent with send_bytes/recv_bytes. Connection's send/recv
+# would pickle, and unpickling runs code, so anyone who knows the authkey
+# (the default is in this file) could run code in the broker.
+BROKER_ADDRESS = os.environ.get('QA_BROKER_ADDRESS', '')
+BROKER_AUTHKEY = os.environ.get('QA_BROKER_AUTHKEY', 'qa-broker').encode()
+DEFAULT_ADDRESS = '127.0.0.1:6001'
+
+# Idle connections a client keeps; calls beyond that open their own
+CLIENT_POOL_SIZE = 8
+
+# Seconds a request waits for its station's bus worker before it gets an
+# error reply; the client gives up a little later than the broker does
+READ_TIMEOUT = float(os.environ.get('QA_BROKER_TIMEOUT', '10'))
+CLIENT_TIMEOUT = READ_TIMEOUT + 2
+
+# Lower value is served first
+PRIORITY_SCAN = 0   # an operator is waiting on /scan
+PRIORITY_POLL = 1   # background polling and CLI reads
+PRIORITIES = (PRIORITY_SCAN, PRIORITY_POLL)
+
+
+def parse_address(address):
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit() and '\\' not in address and '/' not in address:
+        return (host or '127.0.0.1', int(port))
+    return address
+
+def send_json(conn, message):
+    conn.send_bytes(json.dumps(message).encode())
+
+def recv_json(conn):
+    return json.loads(conn.recv_bytes())
+
+
+class Broker:
+
+    def __init__(self, stations, address=None, authkey=BROKER_AUTHKEY, timeout=READ_TIMEOUT):
+        self.stations = stations
+        self.address = parse_address(address or BROKER_ADDRESS or DEFAULT_ADDRESS)
+        self.authkey = authkey
+        self.timeout = timeout
+        self._queues = {sid: queue.PriorityQueue() for sid in stations}
+        self._seq = itertools.count()
+        self._listener = None
+        self._running = False
+
+    def start(self):
+        self._listener = Listener(self.address, authkey=self.authkey)
+        self.address = self._listener.address
+        self._running = True
+        for station_id in self.stations:
+            threading.Thread(target=self._bus_worker, args=(station_id,),
+                             name=f'broker-station-{station_id}', daemon=True).start()
+        threading.Thread(target=self._accept_loop, name='broker-accept', daemon=True).start()
+        return self
+
+    def stop(self):
+        self._running = False
+        if self._listener is not None:
+            self._listener.close()
+        for q in self._queues.values():
+            q.put((-1, next(self._seq), None, None))  # wake the workers
+        for station in self.stations.values():
+            station.close()
+
+    def read(self, station_id, priority=PRIORITY_POLL):
+        done = threading.Event()
+        box = {}
+        self._queues[station_id].put((priority, next(self._seq), done, box))
+        if not done.wait(self.timeout):
+            # The worker answers the abandoned request whenever it gets to it
+            raise TimeoutError(f'Station {station_id} did not answer within {self.timeout:g}s')
+        return box['result']
+
+    def _bus_worker(self, station_id):
+        # One worker per port serializes bus access. Requests that piled up
+        # while a read was in flight are answered together by the next read,
+        # which starts after all of them arrived.
+        station = self.stations[station_id]
+        q = self._queues[station_id]
+        while self._running:
+            waiting = [q.get()]
+            while True:
+                try:
+                    waiting.append(q.get_nowait())
+                except queue.Empty:
+                    break
+            waiting = [item for item in waiting if item[2] is not None]
+            if not waiting or not self._running:
+                continue
+            try:
+                result = station.read()
+            except Exception:
+                logger.exception("Station %s read failed", station_id)
+                result = (None, None, None)
+            for _, _, done, box in waiting:
+                box['result'] = result
+                done.set()
+
+    def _accept_loop(self):
+        while self._running:
+            try:
+                conn = self._listener.accept()
+            except Exception as e:
+                if self._running:
+                    logger.error("Broker accept failed: %s", e)
+                continue
+            threading.Thread(target=self._serve, args=(conn,), name='broker-conn', daemon=True).start()
+
+    def _serve(self, conn):
+        with conn:
+            while self._running:
+                try:
+                    request = recv_json(conn)
+                except (EOFError, OSError):
+                    return
+                except ValueError:
+                    send_json(conn, {'ok': False, 'error': 'Request is not JSON'})
+                    continue
+                if not isinstance(request, dict):
+                    send_json(conn, {'ok': False, 'error': 'Request must be a JSON object'})
+                    continue
+                try:
+                    reply = self.handle(request)
+                except Exception as e:
+                    logger.error("Broker request %r failed: %s", request, e)
+                    reply = {'ok': False, 'error': str(e)}
+                send_json(conn, reply)
+
+    def handle(self, request):
+        op = request.get('op')
+        if op == 'read':
+            station_id = request.get('station')
+            if not isinstance(station_id, str) or station_id not in self.stations:
+                return {'ok': False, 'error': f'Unknown station {station_id}'}
+            priority = request.get('priority', PRIORITY_POLL)
+            if type(priority) is not int or priority not in PRIORITIES:
+                return {'ok': False, 'error': f'Invalid priority {priority}'}
+            power, power_factor, rpm = self.read(station_id, priority)
+            return {'ok': True, 'power': power, 'power_factor': power_factor, 'rpm': rpm}
+        if op == 'stations':
+            return {'ok': True, 'stations': list(self.stations)}
+        if op == 'ping':
+            return {'ok': True}
+        return {'ok': False, 'error': f'Unknown op {op}'}
+
+
+class BrokerClient:
+    # Thread-safe client. Each call borrows a connection from a small pool,
+    # so reads for different stations are in flight together and a scan's
+    # PRIORITY_SCAN request reaches the broker while a poll is still
+    # waiting. Reconnects once if the broker was restarted.
+
+    def __init__(self, address=None, authkey=BROKER_AUTHKEY, pool_size=CLIENT_POOL_SIZE, timeout=CLIENT_TIMEOUT):
+        self.address = parse_address(address or BROKER_ADDRESS or DEFAULT_ADDRESS)
+        self.authkey = authkey
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+
+    def _borrow(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return Client(self.address, authkey=self.authkey)
+
+    def _give_back(self, conn):
+        if self._idle.qsize() < self.pool_size:
+            self._idle.put(conn)
+        else:
+            _close_quietly(conn)
+
+    def _call(self, request):
+        for attempt in range(2):
+            conn = self._borrow()
+            try:
+                send_json(conn, request)
+                if not conn.poll(self.timeout):
+                    # A late reply would answer the next call on this connection
+                    _close_quietly(conn)
+                    raise TimeoutError(f'Broker did not reply within {self.timeout:g}s')
+                reply = recv_json(conn)
+            except TimeoutError:
+                raise
+            except (EOFError, OSError):
+                # The broker went away: every idle connection is as dead as this one
+                _close_quietly(conn)
+                self.close()
+                if attempt:
+                    raise
+                continue
+            self._give_back(conn)
+            return reply
+
+    def close(self):
+        while True:
+            try:
+                _close_quietly(self._idle.get_nowait())
+            except queue.Empty:
+                return
+
+    def read(self, station_id, priority=PRIORITY_POLL):
+        reply = self._call({'op': 'read', 'station': station_id, 'priority': priority})
+        if not reply.get('ok'):
+            raise ValueError(reply.get('error'))
+        return reply['power'], reply['power_factor'], reply['rpm']
+
+    def stations(self):
+        return self._call({'op': 'stations'})['stations']
+
+
+def _close_quietly(conn):
+    try:
+        conn.close()
+    except OSError:
+        pass
+
+
+def main():
+    setup_logging(os.environ.get('QA_LOG_LEVEL', 'INFO').upper())
+    broker = Broker(load_stations()).start()
+    logger.info("Acquisition broker serving %s on %s", ', '.join(broker.stations), broker.address)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        broker.stop()
+
+
+if __name__ == "__main__":
+    main()
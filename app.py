@@ -1,11 +1,30 @@
-from flask import Flask, render_template, request, redirect, send_file, jsonify
-from flask_socketio import SocketIO
+from flask import Flask, render_template, request, redirect, send_file, jsonify, g, has_app_context, Response, stream_with_context
+from flask_socketio import SocketIO, join_room, leave_room, rooms
 import sqlite3
+from contextlib import nullcontext
 from datetime import datetime
 import random
 import os, sys
 import logging
-from rs485_reader import get_live_power_and_factor_and_rpm
+import queue
+import tempfile
+import threading
+import time
+from sensor_poller import SensorPoller
+from stations import load_stations
+from acquisition_broker import BROKER_ADDRESS, PRIORITY_POLL, PRIORITY_SCAN, BrokerClient
+from config_cache import ConfigCache
+from duplicate_guard import DuplicateGuard, DuplicateScanError
+from scan_export import has_rows, iter_delimited, write_xlsx
+from broadcaster import ALL, Broadcaster, date_room, station_room
+from scan_writer import ScanWriter, WriterStalledError
+from archive import RETAIN_MONTHS, archive_closed_months, archived_months, iter_sources, remove_archives
+from rollups import GRAINS, create_rollup_tables, create_rollup_triggers, query_trends, rebuild_rollups
+from spc import RULES, SPCEngine
+from capture import (CAPTURE, CAPTURE_INTERVAL, CAPTURE_WINDOW, BYTEORDER, DTYPE, SERIES, STEADY, STEADY_SAMPLES,
+                     capture, capture_steady, create_waveform_table, find_waveform, from_samples, store_waveform)
+from metrics import HTTP_REQUESTS, HTTP_SECONDS, TimedConnection, gauge, render as render_metrics, setup_logging
+from scan_import import IMPORT_MAX_ROWS, check_result, insert_chunks, next_daily_numbers, normalize_record, parse_csv, parse_jsonl
 
 def resource_path(rel):
     try:
@@ -21,16 +40,83 @@ app = Flask(
 )
 
 socketio = SocketIO(app, cors_allowed_origins="*")
+broadcaster = Broadcaster(socketio)
 
 DB_FILE = "scan_log.db"
 
-logging.basicConfig(level=logging.DEBUG)
+# SQLite connection pool
+DB_POOL_SIZE = 8                    # idle connections kept for reuse
+DB_BUSY_TIMEOUT = 5.0               # seconds to wait for a writer before "database is locked"
+DB_MMAP_SIZE = 64 * 1024 * 1024     # bytes of the file read through mmap
+DB_CACHED_STATEMENTS = 256          # prepared statements kept per connection
+
+# Background sensor polling (off by default: /scan reads the bus itself)
+SENSOR_POLLING = os.environ.get('QA_SENSOR_POLLING', '0') == '1'
+SAMPLE_MAX_AGE = float(os.environ.get('QA_SAMPLE_MAX_AGE', '1.0'))   # seconds
+SAMPLE_WINDOW = float(os.environ.get('QA_SAMPLE_WINDOW', '0'))       # seconds, 0 = latest sample only
+LIVE_EMIT_INTERVAL = 1.0                                              # seconds between live_readings events
+
+# Write-behind: /scan answers once the scan is journaled and a writer thread
+# inserts queued scans in batches (see scan_writer.py)
+WRITE_BEHIND = os.environ.get('QA_WRITE_BEHIND', '0') == '1'
+
+# With QA_CAPTURE=1, /scan reads the meters over a window and keeps the
+# series next to the scan; with QA_STEADY=1 it reads them until the
+# readings settle (see capture.py)
+
+# With QA_RETAIN_MONTHS set, closed months are moved to archive files (see archive.py)
+ARCHIVE_CHECK_INTERVAL = 6 * 3600   # seconds
+
+
+def run_blocking(fn, *args):
+    # Serial I/O blocks in pyserial and can't yield to an eventlet/gevent hub,
+    # so run it on the async mode's native thread pool and let the other
+    # greenlets (HTTP requests, websockets) keep going meanwhile.
+    mode = socketio.async_mode
+    if mode == 'eventlet':
+        from eventlet import tpool
+        return tpool.execute(fn, *args)
+    if mode == 'gevent':
+        import gevent
+        return gevent.get_hub().threadpool.apply(fn, args)
+    return fn(*args)  # threading mode: each request already has its own thread
+
+stations = load_stations()
+DEFAULT_STATION = next(iter(stations))
+
+# With QA_BROKER_ADDRESS set, the acquisition broker process owns the ports
+# and this process (or any number of them) asks it for readings.
+broker = BrokerClient() if BROKER_ADDRESS else None
+
+def read_via_broker(station_id, priority):
+    try:
+        return broker.read(station_id, priority)
+    except Exception as e:
+        logger.error("Error reading from acquisition broker: %s", e)
+        return None, None, None
+
+def read_bus(station, priority=PRIORITY_SCAN):
+    if broker is not None:
+        return run_blocking(read_via_broker, station.id, priority)
+    return run_blocking(station.read)
+
+# One poller per station, so each port is polled by its own worker
+pollers = {sid: SensorPoller(read=lambda station=station: read_bus(station, PRIORITY_POLL))
+           for sid, station in stations.items()}
+
+# Log records are queued and written by one listener thread (see metrics.py)
+LOG_LEVEL = os.environ.get('QA_LOG_LEVEL', 'INFO').upper()
+setup_logging(LOG_LEVEL)
 logger = logging.getLogger(__name__)
 
 def init_db():
     conn = sqlite3.connect(DB_FILE)
     c = conn.cursor()
 
+    # WAL lets dashboard reads run while a scan is being written. The mode is
+    # stored in the database file, so setting it once here is enough.
+    c.execute("PRAGMA journal_mode=WAL")
+
     # Create scans table
     c.execute("""
     CREATE TABLE IF NOT EXISTS scans (
@@ -76,175 +162,580 @@ def init_db():
     """)
 
     conn.commit()
+    migrate_db(conn)
     conn.close()
+    config_cache.invalidate()
+    duplicate_guard.invalidate()
+    spc_engine.invalidate()
 
 
-def get_db():
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
-    return conn
+# Schema migrations, applied in order on top of the tables created above.
+# PRAGMA user_version records how many have run, so existing scan_log.db files
+# are upgraded in place on startup. Only ever append to MIGRATIONS.
 
-def insert_scan(qr_code, power=None, rpm=None, power_factor=None, failure_code='NA', result=None):
-    try:
-        # Get current voice recognition setting for new scan
-        voice_recognition = get_default_voice_recognition()
+def _add_column(c, table, column, decl):
+    columns = [row[1] for row in c.execute(f"PRAGMA table_info({table})")]
+    if column not in columns:
+        c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
 
-        with get_db() as conn:
-            cur = conn.cursor()
-            today = datetime.now().strftime('%Y-%m-%d')
-            cur.execute("""
-                SELECT COUNT(*) + 1 as number 
-                FROM scans 
-                WHERE date(timestamp) = ?
-            """, (today,))
-            daily_number = cur.fetchone()['number']
+def _migration_station(c):
+    _add_column(c, 'scans', 'station', "TEXT DEFAULT '1'")
 
-            # REQUIRE power, rpm, power_factor explicitly passed; else error out
-            if power is None or rpm is None or power_factor is None:
-                raise ValueError("power, rpm, and power_factor must be provided")
+def _migration_scan_date(c):
+    # date(timestamp) in a WHERE clause can't use an index, so keep the day
+    # in its own column. The trigger covers rows inserted without it.
+    _add_column(c, 'scans', 'scan_date', 'TEXT')
+    c.execute("UPDATE scans SET scan_date = date(timestamp) WHERE scan_date IS NULL")
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS scans_fill_scan_date
+        AFTER INSERT ON scans
+        WHEN NEW.scan_date IS NULL
+        BEGIN
+            UPDATE scans SET scan_date = date(NEW.timestamp) WHERE id = NEW.id;
+        END
+    """)
+    # Day listing (ORDER BY id within a day) and covering index for the daily counters
+    c.execute("CREATE INDEX IF NOT EXISTS idx_scans_scan_date ON scans (scan_date)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_scans_scan_date_result ON scans (scan_date, result)")
+    # Duplicate FP OK check and failure code lookups by QR code
+    c.execute("CREATE INDEX IF NOT EXISTS idx_scans_qr_code_result ON scans (qr_code, result)")
+
+def _migration_daily_stats(c):
+    # Per-day scan count (the next daily_number is scan_count + 1) and the
+    # FP OK / SP OK / RW tallies. Triggers update it in the same transaction
+    # as whatever statement touched scans: inserts, /undo, result edits.
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS daily_stats (
+            scan_date TEXT PRIMARY KEY,
+            scan_count INTEGER NOT NULL DEFAULT 0,
+            fp_ok INTEGER NOT NULL DEFAULT 0,
+            sp_ok INTEGER NOT NULL DEFAULT 0,
+            rw INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS daily_stats_insert
+        AFTER INSERT ON scans
+        WHEN NEW.scan_date IS NOT NULL
+        BEGIN
+            INSERT OR IGNORE INTO daily_stats (scan_date) VALUES (NEW.scan_date);
+            UPDATE daily_stats SET
+                scan_count = scan_count + 1,
+                fp_ok = fp_ok + (NEW.result IS 'FP OK'),
+                sp_ok = sp_ok + (NEW.result IS 'SP OK'),
+                rw = rw + (NEW.result IS 'RW')
+            WHERE scan_date = NEW.scan_date;
+        END
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS daily_stats_delete
+        AFTER DELETE ON scans
+        WHEN OLD.scan_date IS NOT NULL
+        BEGIN
+            UPDATE daily_stats SET
+                scan_count = scan_count - 1,
+                fp_ok = fp_ok - (OLD.result IS 'FP OK'),
+                sp_ok = sp_ok - (OLD.result IS 'SP OK'),
+                rw = rw - (OLD.result IS 'RW')
+            WHERE scan_date = OLD.scan_date;
+        END
+    """)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS daily_stats_update
+        AFTER UPDATE OF result, scan_date ON scans
+        BEGIN
+            UPDATE daily_stats SET
+                scan_count = scan_count - 1,
+                fp_ok = fp_ok - (OLD.result IS 'FP OK'),
+                sp_ok = sp_ok - (OLD.result IS 'SP OK'),
+                rw = rw - (OLD.result IS 'RW')
+            WHERE scan_date = OLD.scan_date;
+            INSERT OR IGNORE INTO daily_stats (scan_date) SELECT NEW.scan_date WHERE NEW.scan_date IS NOT NULL;
+            UPDATE daily_stats SET
+                scan_count = scan_count + 1,
+                fp_ok = fp_ok + (NEW.result IS 'FP OK'),
+                sp_ok = sp_ok + (NEW.result IS 'SP OK'),
+                rw = rw + (NEW.result IS 'RW')
+            WHERE scan_date = NEW.scan_date;
+        END
+    """)
+    rebuild_daily_stats(c)
 
-            # Extract model prefix
-            model_prefix = qr_code.split('.')[0]
+def _migration_config_version(c):
+    # Version stamp for the models and settings caches: any change bumps it,
+    # whichever process or tool made it.
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS config_version (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL
+        )
+    """)
+    c.execute("INSERT OR IGNORE INTO config_version (id, version) VALUES (1, 0)")
+    for table in ('models', 'settings'):
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            c.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS {table}_{event.lower()}_bump_version
+                AFTER {event} ON {table}
+                BEGIN
+                    UPDATE config_version SET version = version + 1 WHERE id = 1;
+                END
+            """)
 
-            # Fetch model limits from DB
-            cur.execute("""
-                SELECT power_min, power_max, pf_min, rpm_min, rpm_max
-                FROM models
-                WHERE model_prefix = ? COLLATE NOCASE
-            """, (model_prefix,))
-            model = cur.fetchone()
-
-            # Default to FAIL if model not found
-            status = 'FAIL'
-            if model:
-                power_min, power_max, pf_min, rpm_min, rpm_max = model
-                if (
-                    power_min <= power <= power_max and
-                    pf_min <= power_factor and
-                    rpm_min <= rpm <= rpm_max
-                ):
-                    status = 'PASS'
-                    failure_code = 'NA'
-                    result = 'FP OK'
-                else:
-                    if failure_code == 'NA':
-                        failure_code = ''
-                    result = failure_code if result is None else result
+def _migration_unique_fp_ok(c):
+    # At most one FP OK scan per QR code, enforced by the database so two
+    # stations can't both pass the same serial. Duplicates recorded before
+    # the index existed are kept but flagged, and left out of the index.
+    _add_column(c, 'scans', 'fp_ok_duplicate', 'INTEGER NOT NULL DEFAULT 0')
+    c.execute("""
+        UPDATE scans SET fp_ok_duplicate = 1
+        WHERE result = 'FP OK' AND id > (
+            SELECT MIN(s.id) FROM scans s WHERE s.qr_code = scans.qr_code AND s.result = 'FP OK'
+        )
+    """)
+    c.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS ux_scans_fp_ok_qr_code
+        ON scans (qr_code) WHERE result = 'FP OK' AND fp_ok_duplicate = 0
+    """)
+
+def _migration_rollups(c):
+    # Hourly/daily/monthly counts and measurement sums per model and station
+    # for /api/trends, kept by triggers and backfilled from history here
+    create_rollup_tables(c)
+    create_rollup_triggers(c)
+    rebuild_rollups(c)
+
+def _migration_archives(c):
+    # Bookkeeping for monthly archival (archive.py): which months moved to
+    # which file, and the serials that passed first time in those months, so
+    # the FP OK rule still holds for them
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS scan_archives (
+            month TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            row_count INTEGER NOT NULL,
+            archived_at TEXT NOT NULL
+        )
+    """)
+    c.execute("CREATE TABLE IF NOT EXISTS archived_fp_ok (qr_code TEXT PRIMARY KEY) WITHOUT ROWID")
+    for event in ('INSERT', 'UPDATE OF result'):
+        c.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS scans_archived_fp_ok_{event.split()[0].lower()}
+            BEFORE {event} ON scans
+            WHEN NEW.result = 'FP OK' AND NEW.fp_ok_duplicate = 0
+                 AND EXISTS (SELECT 1 FROM archived_fp_ok WHERE qr_code = NEW.qr_code)
+            BEGIN
+                SELECT RAISE(ABORT, 'UNIQUE constraint failed: archived FP OK scan');
+            END
+        """)
+
+def _migration_waveforms(c):
+    # Series captured over the test window (capture.py), one row per scan
+    create_waveform_table(c)
+    c.execute("""
+        CREATE TRIGGER IF NOT EXISTS scans_delete_waveform AFTER DELETE ON scans
+        BEGIN
+            DELETE FROM scan_waveforms WHERE scan_id = OLD.id;
+        END
+    """)
+
+MIGRATIONS = [
+    _migration_station,
+    _migration_scan_date,
+    _migration_daily_stats,
+    _migration_config_version,
+    _migration_unique_fp_ok,
+    _migration_rollups,
+    _migration_archives,
+    _migration_waveforms,
+]
+
+def rebuild_daily_stats(c, keep_months=()):
+    # Recompute the rollup from scans, e.g. after editing the database by
+    # hand. Days of the keep_months (archived, so not in scans) stay as they are.
+    params = list(keep_months)
+    not_kept = f"substr(scan_date, 1, 7) NOT IN ({', '.join('?' * len(params))})"
+    c.execute("DELETE FROM daily_stats" + (f" WHERE {not_kept}" if params else ""), params)
+    c.execute(f"""
+        INSERT INTO daily_stats (scan_date, scan_count, fp_ok, sp_ok, rw)
+        SELECT scan_date, COUNT(*),
+               SUM(result IS 'FP OK'), SUM(result IS 'SP OK'), SUM(result IS 'RW')
+        FROM scans
+        WHERE scan_date IS NOT NULL{f" AND {not_kept}" if params else ""}
+        GROUP BY scan_date
+    """, params)
+
+def migrate_db(conn):
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None  # manage the transactions explicitly so DDL is included
+    try:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            c = conn.cursor()
+            c.execute("BEGIN")
+            try:
+                migration(c)
+                c.execute(f"PRAGMA user_version = {number}")
+                c.execute("COMMIT")
+            except Exception:
+                c.execute("ROLLBACK")
+                raise
+            logger.info("Applied database migration %d (%s)", number, migration.__name__)
+    finally:
+        conn.isolation_level = isolation_level
+
+
+class PooledConnection(TimedConnection):
+    # Remembers which database file it was opened on, so a pooled connection
+    # is never handed out after DB_FILE changes. Statement times go to /metrics.
+    db_file = None
+
+_db_pool = queue.LifoQueue()
+_db_local = threading.local()
+
+def connect_db():
+    conn = sqlite3.connect(DB_FILE, timeout=DB_BUSY_TIMEOUT, check_same_thread=False,
+                           cached_statements=DB_CACHED_STATEMENTS, factory=PooledConnection)
+    conn.db_file = DB_FILE
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA synchronous=NORMAL")  # safe with WAL, skips an fsync per commit
+    conn.execute(f"PRAGMA busy_timeout={int(DB_BUSY_TIMEOUT * 1000)}")
+    conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+    return conn
+
+def _acquire_db():
+    while True:
+        try:
+            conn = _db_pool.get_nowait()
+        except queue.Empty:
+            return connect_db()
+        if conn.db_file == DB_FILE:
+            return conn
+        conn.close()
+
+def _release_db(conn, failed=False):
+    try:
+        if conn.in_transaction:
+            if failed:
+                conn.rollback()
             else:
-                failure_code = 'UNKNOWN MODEL'
-                result = 'MODEL NOT FOUND'
+                conn.commit()
+    except sqlite3.Error:
+        conn.close()
+        return
+    if conn.db_file == DB_FILE and _db_pool.qsize() < DB_POOL_SIZE:
+        _db_pool.put(conn)
+    else:
+        conn.close()
 
-            timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+def get_db():
+    # Inside a request every call returns the same pooled connection, so the
+    # request runs as one unit of work; it goes back to the pool on teardown.
+    # Background threads (pollers, CLI) get one connection per thread.
+    if has_app_context():
+        conn = g.get('_db')
+        if conn is None:
+            conn = g._db = _acquire_db()
+        return conn
+    conn = getattr(_db_local, 'conn', None)
+    if conn is None or conn.db_file != DB_FILE:
+        if conn is not None:
+            conn.close()
+        conn = _db_local.conn = connect_db()
+    return conn
 
-            cur.execute("""
-                INSERT INTO scans (
-                    daily_number, qr_code, power, rpm, power_factor, 
-                    failure_code, status, timestamp, result, voice_recognition
-                )
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                daily_number, qr_code, power, rpm, power_factor,
-                failure_code, status, timestamp, result, voice_recognition
-            ))
-            conn.commit()
+config_cache = ConfigCache(get_db)
+duplicate_guard = DuplicateGuard(get_db)
+scan_writer = None  # set by start_write_behind()
+spc_engine = SPCEngine(get_db)
+
+def start_write_behind():
+    global scan_writer
+    scan_writer = ScanWriter(connect_db, DB_FILE + '.pending', sleep=socketio.sleep, guard=duplicate_guard).start()
+
+def flush_scans():
+    # Queued scans must be in the table before a handler reads or edits
+    # "the last scan", or it would act on the one before
+    if scan_writer is not None:
+        scan_writer.flush()
+
+@app.errorhandler(WriterStalledError)
+def writer_stalled(e):
+    # flush_scans() gave up: the database isn't taking writes (locked, disk full)
+    logger.error("Write-behind writer stalled: %s", e)
+    return jsonify({'error': f'Database is not accepting writes, try again shortly ({e})'}), 503
+
+def reset_scan_numbering():
+    # After scans were deleted outside the writer
+    if scan_writer is not None:
+        scan_writer.reset()
+
+def exclusive_scans():
+    # For a bulk insert that numbers its own scans: holds off /scan
+    # meanwhile, see ScanWriter.exclusive()
+    return scan_writer.exclusive() if scan_writer is not None else nullcontext()
+
+@app.before_request
+def start_request_timer():
+    g._request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('_request_started', None)
+    if started is not None:
+        endpoint = request.endpoint or 'unmatched'
+        HTTP_SECONDS.observe(time.perf_counter() - started, endpoint, request.method)
+        HTTP_REQUESTS.inc(endpoint, str(response.status_code))
+    return response
+
+@app.teardown_appcontext
+def release_db(exc):
+    conn = g.pop('_db', None)
+    if conn is not None:
+        _release_db(conn, failed=exc is not None)
+
+def grade_scan(model, power, rpm, power_factor, failure_code, result):
+    # (status, failure_code, result) for a reading against the model's limits
+    if not model:
+        return 'FAIL', 'UNKNOWN MODEL', 'MODEL NOT FOUND'
+    power_min, power_max, pf_min, rpm_min, rpm_max = model
+    if (
+        power_min <= power <= power_max and
+        pf_min <= power_factor and
+        rpm_min <= rpm <= rpm_max
+    ):
+        return 'PASS', 'NA', 'FP OK'
+    if failure_code == 'NA':
+        failure_code = ''
+    return 'FAIL', failure_code, failure_code if result is None else result
+
+def insert_scan(qr_code, power=None, rpm=None, power_factor=None, failure_code='NA', result=None, station=None,
+                waveform=None):
+    try:
+        # Get current voice recognition setting for new scan
+        voice_recognition = get_default_voice_recognition()
 
-            return {
-                'daily_number': daily_number,
-                'qr_code': qr_code,
-                'power': power,
-                'rpm': rpm,
-                'power_factor': power_factor,
-                'failure_code': failure_code,
-                'status': status,
-                'timestamp': timestamp,
-                'result': result,
-                'voice_recognition': voice_recognition
-            }
+        # REQUIRE power, rpm, power_factor explicitly passed; else error out
+        if power is None or rpm is None or power_factor is None:
+            raise ValueError("power, rpm, and power_factor must be provided")
+
+        # Model limits come from the in-memory cache of the models table
+        model = config_cache.model(qr_code.split('.')[0])
+        status, failure_code, result = grade_scan(model, power, rpm, power_factor, failure_code, result)
+
+        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        scan = {
+            'qr_code': qr_code,
+            'power': power,
+            'rpm': rpm,
+            'power_factor': power_factor,
+            'failure_code': failure_code,
+            'status': status,
+            'timestamp': timestamp,
+            'result': result,
+            'voice_recognition': voice_recognition,
+            'station': station or DEFAULT_STATION,
+            'scan_date': timestamp[:10],
+        }
+
+        if scan_writer is not None:
+            scan_writer.submit(scan)  # checks for a duplicate FP OK and registers this one atomically
+        else:
+            with get_db() as conn:
+                cur = conn.cursor()
+                cur.execute("SELECT scan_count + 1 as number FROM daily_stats WHERE scan_date = ?",
+                            (scan['scan_date'],))
+                row = cur.fetchone()
+                scan['daily_number'] = row['number'] if row else 1
+                cur.execute("""
+                    INSERT INTO scans (
+                        daily_number, qr_code, power, rpm, power_factor, 
+                        failure_code, status, timestamp, result, voice_recognition, station, scan_date
+                    )
+                    VALUES (:daily_number, :qr_code, :power, :rpm, :power_factor,
+                            :failure_code, :status, :timestamp, :result, :voice_recognition, :station, :scan_date)
+                """, scan)
+                scan['id'] = cur.lastrowid
+                if waveform is not None:
+                    store_waveform(conn, scan['id'], waveform)
+                conn.commit()
+        if scan_writer is not None and waveform is not None:
+            # The id is already assigned, so the series can go in ahead of
+            # the queued scan row
+            with get_db() as conn:
+                store_waveform(conn, scan['id'], waveform)
+                conn.commit()
+        if result == 'FP OK' and scan_writer is None:
+            duplicate_guard.add(qr_code)
+
+        # The writer thread may still hold the dict, so hand back a copy
+        return {key: value for key, value in scan.items() if key != 'scan_date'}
+    except DuplicateScanError:
+        raise
+    except sqlite3.IntegrityError:
+        # The unique FP OK index caught a duplicate the pre-check missed
+        raise DuplicateScanError(qr_code)
     except Exception as e:
-        print(f"Error inserting scan: {str(e)}")
+        logger.error("Error inserting scan: %s", e)
         return None
     
-def get_stats():
-    today = datetime.now().strftime('%Y-%m-%d')
-    current_month = datetime.now().strftime('%Y-%m')
+def get_stats(date=None, conn=None):
+    # Reads the daily_stats rollup, which triggers keep in step with scans
+    date = date or datetime.now().strftime('%Y-%m-%d')
 
-    with get_db() as conn:
+    def read(conn):
         cur = conn.cursor()
-
-        # First Passed
-        cur.execute("SELECT COUNT(*) FROM scans WHERE date(timestamp)=? AND result='FP OK'", (today,))
-        first_passed = cur.fetchone()[0]
-
-        # Second Passed
-        cur.execute("SELECT COUNT(*) FROM scans WHERE date(timestamp)=? AND result='SP OK'", (today,))
-        second_passed = cur.fetchone()[0]
-
-        # Total Passed
-        total_passed = first_passed + second_passed
-
-        # Rework
-        cur.execute("SELECT COUNT(*) FROM scans WHERE date(timestamp)=? AND result='RW'", (today,))
-        rework = cur.fetchone()[0]
+        cur.execute("SELECT fp_ok, sp_ok, rw FROM daily_stats WHERE scan_date = ?", (date,))
+        row = cur.fetchone()
+        return tuple(row) if row else (0, 0, 0)
+
+    def read_counts(conn):
+        if scan_writer is None:
+            return read(conn)
+        # Add the scans still queued for the writer
+        row, pending = scan_writer.read_with_pending(date, lambda: read(conn))
+        return tuple(a + b for a, b in zip(row, pending))
+
+    if conn is None:
+        with get_db() as conn:
+            first_passed, second_passed, rework = read_counts(conn)
+    else:
+        first_passed, second_passed, rework = read_counts(conn)
 
     return {
-        "total_passed": total_passed,
+        "total_passed": first_passed + second_passed,
         "first_passed": first_passed,
         "second_passed": second_passed,
         "rework": rework
     }
 
 
-def get_scans(date=None):
+SCAN_FIELDS = ('id', 'daily_number', 'qr_code', 'power', 'rpm', 'power_factor', 'failure_code',
+               'status', 'timestamp', 'result', 'voice_recognition', 'station')
+SCAN_PAGE_SIZE = 100       # rows per page on the dashboard and /api/scans
+SCAN_PAGE_SIZE_MAX = 1000
+
+def query_scans(conn, start_date=None, end_date=None, status=None, result=None, model=None,
+                station=None, before_id=None, limit=SCAN_PAGE_SIZE, fields=SCAN_FIELDS):
+    # Newest first, paged by id: pass the last id of one page as before_id
+    # to get the next, so every page is an index range scan however deep.
+    # `id` is always returned, it is the cursor.
+    # Archived months in the range are read too, newest stretch first.
+    columns = ['id'] + [f for f in fields if f != 'id']
+    where, params = [], []
+    if status:
+        where.append("status = ?")
+        params.append(status)
+    if result:
+        where.append("result = ?")
+        params.append(result)
+    if model:
+        where.append("qr_code LIKE ? ESCAPE '\\'")
+        params.append(model.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '.%')
+    if station:
+        where.append("station = ?")
+        params.append(station)
+    if before_id:
+        where.append("id < ?")
+        params.append(before_id)
+
+    scans = []
+    sources = iter_sources(conn, SCAN_FIELDS, start_date, end_date, newest_first=True)
     try:
-        with get_db() as conn:
-            cur = conn.cursor()
-            query = """
-                SELECT daily_number, qr_code, power, rpm, power_factor, failure_code, status, timestamp, result, voice_recognition
-                FROM scans
-            """
-            params = []
-            if date:
-                query += " WHERE date(timestamp) = ?"
-                params.append(date)
+        for source, source_params, _, _ in sources:
+            query = f"SELECT {', '.join(columns)} FROM {source}"
+            if where:
+                query += " WHERE " + " AND ".join(where)
             query += " ORDER BY id DESC"
-            cur.execute(query, params)
-            return [dict(row) for row in cur.fetchall()]
+            query_params = source_params + params
+            if limit:
+                query += " LIMIT ?"
+                query_params.append(limit - len(scans))
+            scans += [dict(row) for row in conn.execute(query, query_params)]
+            if limit and len(scans) >= limit:
+                break
+    finally:
+        sources.close()
+    return scans
+
+def get_scans(date=None, limit=None):
+    try:
+        with get_db() as conn:
+            return query_scans(conn, start_date=date, end_date=date, limit=limit)
     except Exception as e:
-        print(f"Error getting scans: {str(e)}")
+        logger.error("Error getting scans: %s", e)
         return []
 
+def next_cursor(scans, limit):
+    return scans[-1]['id'] if limit and len(scans) == limit else None
+
+def read_sensors(station_id=None):
+    # Use the poller's reading when it is fresh enough, otherwise go to the bus
+    station_id = station_id or DEFAULT_STATION
+    if SENSOR_POLLING:
+        poller = pollers[station_id]
+        if SAMPLE_WINDOW > 0:
+            sample = poller.average(SAMPLE_WINDOW, SAMPLE_MAX_AGE)
+        else:
+            sample = poller.latest(SAMPLE_MAX_AGE)
+        if sample is not None:
+            return sample.power, sample.power_factor, sample.rpm
+    return read_bus(stations[station_id])
+
+def capture_sensors(station_id):
+    # (power, power_factor, rpm, waveform): the mean of a capture window and
+    # the series behind it. In steady-state mode the bus is read until the
+    # readings settle and the mean covers the settled ones. Otherwise, with
+    # polling on, the window comes from the poller's buffer, and without it
+    # the bus is read for the whole window.
+    station = stations[station_id]
+    if STEADY:
+        wave = capture_steady(lambda: read_bus(station), sleep=socketio.sleep)
+        if wave is None:
+            return None, None, None, None
+        if not wave.steady:
+            logger.warning("Readings on station %s did not settle within %.1fs, grading the last %d",
+                           station_id, wave.duration(), STEADY_SAMPLES)
+        return (*wave.average(STEADY_SAMPLES), wave)
+    wave = None
+    if SENSOR_POLLING:
+        wave = from_samples(pollers[station_id].window(CAPTURE_WINDOW, SAMPLE_MAX_AGE))
+    if wave is None:
+        wave = capture(lambda: read_bus(station), CAPTURE_WINDOW, CAPTURE_INTERVAL, sleep=socketio.sleep)
+    if wave is None:
+        return None, None, None, None
+    return (*wave.average(), wave)
+
+_last_live_emit = {}
+
+def emit_live_reading(station_id, sample):
+    if sample.monotonic - _last_live_emit.get(station_id, 0.0) < LIVE_EMIT_INTERVAL:
+        return
+    _last_live_emit[station_id] = sample.monotonic
+    broadcaster.publish('live_readings', {
+        'station': station_id,
+        'timestamp': datetime.fromtimestamp(sample.timestamp).strftime('%Y-%m-%d %H:%M:%S'),
+        'power': sample.power,
+        'power_factor': sample.power_factor,
+        'rpm': sample.rpm
+    }, station_room(station_id))
+
+def start_sensor_polling():
+    for station_id, poller in pollers.items():
+        poller.add_listener(lambda sample, station_id=station_id: emit_live_reading(station_id, sample))
+        poller.start(spawn=socketio.start_background_task, sleep=socketio.sleep)
+
 @app.route('/')
 def index():
+    flush_scans()
     try:
         date = request.args.get('date', datetime.now().strftime('%Y-%m-%d'))
-        scans = get_scans(date)
+        # First page only; main.js loads the rest from /api/scans on scroll
+        scans = get_scans(date, limit=SCAN_PAGE_SIZE)
 
         with get_db() as conn:
             cur = conn.cursor()
 
-            # Calculate First Passed (today only) - result 'FP OK'
-            cur.execute("""
-                SELECT COUNT(*) as count FROM scans
-                WHERE date(timestamp) = ? AND result = 'FP OK'
-            """, (date,))
-            first_passed = cur.fetchone()['count']
-
-            # Calculate Second Passed (today only) - result 'SP OK'
-            cur.execute("""
-                SELECT COUNT(*) as count FROM scans
-                WHERE date(timestamp) = ? AND result = 'SP OK'
-            """, (date,))
-            second_passed = cur.fetchone()['count']
-
-            # Total Passed = First Passed + Second Passed
-            total_passed = first_passed + second_passed
-
-            # Calculate Rework (today only) - result 'RW'
-            cur.execute("""
-                SELECT COUNT(*) as count FROM scans
-                WHERE date(timestamp) = ? AND result = 'RW'
-            """, (date,))
-            rework = cur.fetchone()['count']
+            stats = get_stats(date, conn)
 
             # Fetch models for settings modal
             cur.execute("SELECT * FROM models ORDER BY model_prefix")
@@ -252,14 +743,15 @@ def index():
 
         return render_template('index.html',
                                scans=scans,
+                               next_cursor=next_cursor(scans, SCAN_PAGE_SIZE),
                                selected_date=date,
-                               total_passed=total_passed,
-                               first_passed=first_passed,
-                               rework=rework,
-                               second_passed=second_passed,
+                               total_passed=stats['total_passed'],
+                               first_passed=stats['first_passed'],
+                               rework=stats['rework'],
+                               second_passed=stats['second_passed'],
                                models=models)
     except Exception as e:
-        print(f"Error in index route: {str(e)}")
+        logger.error("Error in index route: %s", e)
         return render_template('index.html',
                                scans=[],
                                selected_date=datetime.now().strftime('%Y-%m-%d'),
@@ -269,32 +761,115 @@ def index():
                                second_passed=0,
                                models=[])
 
+# Delta events: after an edit, clients get the changed row and the new
+# counters and patch their table instead of reloading the page. Scan and
+# counter events go to the room of the day they belong to, live readings to
+# the station's room; a display joins the rooms it shows via 'subscribe'.
+
+@socketio.on('subscribe')
+def subscribe(data):
+    data = data or {}
+    for room in rooms():
+        if room.startswith(('station:', 'date:')) or room in (SPC_ROOM, SPC_VIOLATIONS_ROOM):
+            leave_room(room)
+    station_id = data.get('station')
+    for sid in ([station_id] if station_id in stations else stations):
+        join_room(station_room(sid))
+    join_room(date_room(data.get('date') or datetime.now().strftime('%Y-%m-%d')))
+    # spc: 'violations' for screens that only show rule violations, true for
+    # SPC screens that also want the summary after every scan
+    if data.get('spc') == 'violations':
+        join_room(SPC_VIOLATIONS_ROOM)
+    elif data.get('spc'):
+        join_room(SPC_ROOM)
+
+def get_scan_row(conn, scan_id):
+    row = conn.execute(f"SELECT {', '.join(SCAN_FIELDS)} FROM scans WHERE id = ?", (scan_id,)).fetchone()
+    return dict(row) if row else None
+
+def emit_stats_changed(conn, date):
+    stats = get_stats(date, conn)
+    broadcaster.publish('stats_changed', {'date': date, 'stats': stats}, date_room(date))
+    return stats
+
+def emit_scan_updated(conn, scan_id):
+    scan = get_scan_row(conn, scan_id)
+    if scan is None:
+        return None
+    broadcaster.publish('scan_updated', {'scan': scan}, date_room(scan['timestamp'][:10]))
+    emit_stats_changed(conn, scan['timestamp'][:10])
+    return scan
+
+SPC_ROOM = 'spc'
+SPC_VIOLATIONS_ROOM = 'spc:violations'
+
+def update_spc(scan):
+    # Feed a new scan to the SPC engine and tell the SPC rooms; never fails the scan
+    prefix = scan['qr_code'].split('.')[0]
+    model = config_cache.model(prefix)
+    if model is None:
+        return
+    try:
+        violations = spc_engine.observe(prefix, scan)
+        broadcaster.publish('spc_update', {'model': prefix, 'measures': spc_engine.summary(prefix, model)}, SPC_ROOM)
+        if violations:
+            violation = {
+                'model': prefix,
+                'scan': {key: scan[key] for key in ('id', 'qr_code', 'timestamp', 'station')},
+                'violations': violations,
+            }
+            # A client is in one of the two rooms, so nobody gets it twice
+            broadcaster.publish('spc_violation', violation, SPC_ROOM)
+            broadcaster.publish('spc_violation', violation, SPC_VIOLATIONS_ROOM)
+    except Exception as e:
+        logger.error("Error updating SPC for %s: %s", scan['qr_code'], e)
+
+def duplicate_scan_response():
+    return jsonify({
+        'success': False,
+        'duplicate_fp_ok': True,
+        'message': 'Duplicate scan not allowed.'
+    }), 200
+
 @app.route('/scan', methods=['POST'])
 def scan():
     qr_code = request.form.get('qr_code', '').strip()
     failure_code = request.form.get('failure_code', 'NA')
+    station_id = request.form.get('station', '').strip() or DEFAULT_STATION
     if not qr_code:
         return jsonify({'error': 'QR code is required'}), 400
+    if station_id not in stations:
+        return jsonify({'error': f'Unknown station {station_id}'}), 400
     
-    with get_db() as conn:
-        cur = conn.cursor()
-        cur.execute("SELECT 1 FROM scans WHERE qr_code=? AND result='FP OK' LIMIT 1", (qr_code,))
-        if cur.fetchone():
-            return jsonify({
-                'success': False,
-                'duplicate_fp_ok': True,
-                'message': 'Duplicate scan not allowed.'
-            }), 200
-
-    power, power_factor, rpm = get_live_power_and_factor_and_rpm()
+    # Early out before reading the bus; insert_scan() makes the binding check
+    if duplicate_guard.is_duplicate(qr_code) or (scan_writer is not None and scan_writer.has_pending_fp_ok(qr_code)):
+        return duplicate_scan_response()
+
+    waveform = None
+    if CAPTURE or STEADY:
+        power, power_factor, rpm, waveform = capture_sensors(station_id)
+    else:
+        power, power_factor, rpm = read_sensors(station_id)
     if power is None or power_factor is None or rpm is None:
         return jsonify({'error': 'Failed to read sensors data from RS485'}), 500
 
-    scan_data = insert_scan(qr_code, power=power, rpm=rpm, power_factor=power_factor, failure_code=failure_code)
+    try:
+        scan_data = insert_scan(qr_code, power=power, rpm=rpm, power_factor=power_factor, failure_code=failure_code,
+                                station=station_id, waveform=waveform if CAPTURE else None)
+    except DuplicateScanError:
+        return duplicate_scan_response()
     if scan_data:
+        logger.debug("Scan %s #%s on station %s: %s %s (power %s, PF %s, RPM %s)", qr_code, scan_data['id'],
+                     station_id, scan_data['status'], scan_data['result'], power, power_factor, rpm)
         stats = get_stats()  # 👈 get updated numbers
-        socketio.emit('new_scan', {**scan_data, **stats})  # emit to all clients
-        return jsonify({'success': True, 'data': scan_data, 'stats': stats})  # 👈 include stats in response
+        broadcaster.publish('new_scan', {**scan_data, **stats}, date_room(scan_data['timestamp'][:10]))
+        update_spc(scan_data)
+        response = {'success': True, 'data': scan_data, 'stats': stats}  # 👈 include stats in response
+        if waveform is not None:
+            # How long the measurement took; steady is None outside steady-state mode
+            response['acquisition'] = {'samples': len(waveform), 'seconds': round(waveform.duration(), 3),
+                                       'steady': waveform.steady}
+        return jsonify(response)
     else:
         return jsonify({'error': 'Failed to insert scan'}), 500
 
@@ -303,105 +878,68 @@ def export():
     start_date = request.args.get('start_date')
     end_date = request.args.get('end_date')
     file_name = request.args.get('file_name', 'scan_report')
+    export_format = request.args.get('format', 'xlsx').lower()
     
     if not all([start_date, end_date]):
         return jsonify({'error': 'Date range is required'}), 400
+    if export_format not in ('xlsx', 'csv', 'tsv'):
+        return jsonify({'error': 'Format must be xlsx, csv or tsv'}), 400
+    flush_scans()
         
     try:
-        with get_db() as conn:
-            cur = conn.cursor()
-            cur.execute("""
-                SELECT daily_number, qr_code, power, rpm, power_factor, failure_code, result, voice_recognition
-                FROM scans
-                WHERE date(timestamp) BETWEEN ? AND ?
-                ORDER BY timestamp ASC
-            """, (start_date, end_date))
-            
-            scans = cur.fetchall()
-            
-            if not scans:
-                return jsonify({'error': 'No data found'}), 404
-                
-            filename = os.path.join(os.path.expanduser("~/Documents"), f"{file_name}.xlsx")
-            from openpyxl import Workbook
-            from openpyxl.styles import Alignment, Font
-
-            wb = Workbook()
-            ws = wb.active
-
-            headers = [
-                'SL.NO', 'QR Code', 'Power', 'RPM', 'Power Factor', 'Failure Code',
-                'IS 302-1 A-3 Functional test',
-                'IS 374  18.4 d Simple running  test',
-                'IS 374 4.6 Enclosure',
-                'IS 374 Cl. 4.3 Blades and Motor',
-                'Result',
-                'Voice Recognition'
-            ]
-            ws.append(headers)
-
-            for col_num, header in enumerate(headers, 1):
-                cell = ws.cell(row=1, column=col_num)
-                cell.alignment = Alignment(horizontal='center', vertical='center')
-                cell.font = Font(bold=True)
-
-            for scan in scans:
-                row = [
-                    scan['daily_number'],
-                    scan['qr_code'],
-                    scan['power'],
-                    scan['rpm'],
-                    scan['power_factor'],
-                    scan['failure_code'],
-                    'OK',
-                    'OK',
-                    'OK',
-                    'OK',
-                    scan['result'],
-                    scan['voice_recognition']
-                ]
-                ws.append(row)
-                for col_num in range(1, len(row) + 1):
-                    ws.cell(row=ws.max_row, column=col_num).alignment = Alignment(horizontal='center', vertical='center')
-
-            for col in ws.columns:
-                max_length = 0
-                column = col[0].column_letter
-                for cell in col:
-                    try:
-                        cell_length = len(str(cell.value))
-                        if cell_length > max_length:
-                            max_length = cell_length
-                    except:
-                        pass
-                adjusted_width = (max_length + 2)
-                ws.column_dimensions[column].width = adjusted_width
-
-            wb.save(filename)
-            return send_file(filename, as_attachment=True)
+        conn = get_db()
+        if not has_rows(conn, start_date, end_date):
+            return jsonify({'error': 'No data found'}), 404
+
+        if export_format in ('csv', 'tsv'):
+            delimiter = ',' if export_format == 'csv' else '\t'
+            mimetype = 'text/csv' if export_format == 'csv' else 'text/tab-separated-values'
+            body = stream_with_context(iter_delimited(conn, start_date, end_date, delimiter))
+            return Response(body, mimetype=mimetype, headers={
+                'Content-Disposition': f'attachment; filename="{file_name}.{export_format}"'
+            })
+
+        # Written to a temp file (openpyxl needs a seekable target for the
+        # zip) and removed once the download has been sent.
+        fd, path = tempfile.mkstemp(suffix='.xlsx')
+        os.close(fd)
+        try:
+            write_xlsx(conn, start_date, end_date, path)
+            response = send_file(path, as_attachment=True, download_name=f"{file_name}.xlsx")
+        except Exception:
+            os.remove(path)
+            raise
+        response.call_on_close(lambda: os.remove(path))
+        return response
     except Exception as e:
-        print(f"Error in export: {str(e)}")
+        logger.error("Error in export: %s", e)
         return jsonify({'error': 'Export failed'}), 500
     
     
 
 @app.route('/undo', methods=['POST'])
 def undo():
+    flush_scans()
     try:
         with get_db() as conn:
             cur = conn.cursor()
-            cur.execute("SELECT id FROM scans ORDER BY id DESC LIMIT 1")
+            cur.execute("SELECT id, qr_code, result, scan_date FROM scans ORDER BY id DESC LIMIT 1")
             last_scan = cur.fetchone()
             
             if last_scan:
                 cur.execute("DELETE FROM scans WHERE id = ?", (last_scan['id'],))
                 conn.commit()
-                return jsonify({'success': True})
+                duplicate_guard.result_changed(last_scan['qr_code'], last_scan['result'], None)
+                reset_scan_numbering()
+                spc_engine.invalidate(last_scan['qr_code'].split('.')[0])
+                broadcaster.publish('scan_removed', {'id': last_scan['id']}, date_room(last_scan['scan_date']))
+                stats = emit_stats_changed(conn, last_scan['scan_date'])
+                return jsonify({'success': True, 'id': last_scan['id'], 'stats': stats})
             else:
                 return jsonify({'error': 'No scans to remove'}), 404
                 
     except Exception as e:
-        print(f"Error in undo: {str(e)}")
+        logger.error("Error in undo: %s", e)
         return jsonify({'error': str(e)}), 500
 
 @app.route('/models', methods=['GET', 'POST'])
@@ -443,6 +981,8 @@ def manage_models():
                 cur.execute("DELETE FROM models WHERE model_prefix = ? COLLATE NOCASE", (prefix,))
                 conn.commit()
 
+            config_cache.invalidate()
+
         # Fetch updated models
         cur.execute("SELECT * FROM models ORDER BY model_prefix")
         models = cur.fetchall()
@@ -452,23 +992,28 @@ def manage_models():
         selected_date = request.args.get('date', datetime.now().strftime('%Y-%m-%d'))
         
         # Re-use your existing get_scans function or implement below
-        scans = get_scans(selected_date)
+        scans = get_scans(selected_date, limit=SCAN_PAGE_SIZE)
 
-        # Calculate stats
-        current_month = selected_date[:7]
+        # Calculate stats from the rollups
         cur.execute("""
-            SELECT COUNT(*) as count 
-            FROM scans WHERE strftime('%Y-%m', timestamp) = ?
-        """, (current_month,))
+            SELECT COALESCE(SUM(scan_count), 0) as count
+            FROM scan_rollups WHERE grain = 'month' AND period = ?
+        """, (selected_date[:7],))
         monthly_scans = cur.fetchone()['count']
 
-        today_total = len([scan for scan in scans if scan['timestamp'].startswith(selected_date)])
-        today_passed = len([scan for scan in scans if scan['timestamp'].startswith(selected_date) and scan['status'] == 'PASS'])
+        cur.execute("""
+            SELECT COALESCE(SUM(scan_count), 0) as total, COALESCE(SUM(pass_count), 0) as passed
+            FROM scan_rollups WHERE grain = 'day' AND period = ?
+        """, (selected_date,))
+        counts = cur.fetchone()
+        today_total = counts['total']
+        today_passed = counts['passed']
         today_failed = today_total - today_passed
 
     # Render the main dashboard template with full context data
     return render_template('index.html', 
                            scans=scans,
+                           next_cursor=next_cursor(scans, SCAN_PAGE_SIZE),
                            selected_date=selected_date,
                            models=models,
                            monthly_scans=monthly_scans,
@@ -478,38 +1023,274 @@ def manage_models():
 
 
 
+@app.route('/api/scans')
+def api_scans():
+    flush_scans()
+    args = request.args
+    try:
+        limit = int(args.get('limit', SCAN_PAGE_SIZE))
+        before_id = int(args['before_id']) if args.get('before_id') else None
+    except ValueError:
+        return jsonify({'error': 'limit and before_id must be integers'}), 400
+    # query_scans reads a falsy limit as "all rows", and SQLite LIMIT -1 as well
+    if limit < 1:
+        return jsonify({'error': f'limit must be between 1 and {SCAN_PAGE_SIZE_MAX}'}), 400
+    limit = min(limit, SCAN_PAGE_SIZE_MAX)
+    fields = SCAN_FIELDS
+    if args.get('fields'):
+        fields = [f.strip() for f in args['fields'].split(',') if f.strip()]
+        unknown = [f for f in fields if f not in SCAN_FIELDS]
+        if unknown:
+            return jsonify({'error': f"Unknown fields: {', '.join(unknown)}"}), 400
+
+    try:
+        scans = query_scans(get_db(),
+                            start_date=args.get('start_date') or args.get('date'),
+                            end_date=args.get('end_date') or args.get('date'),
+                            status=args.get('status'),
+                            result=args.get('result'),
+                            model=args.get('model'),
+                            station=args.get('station'),
+                            before_id=before_id,
+                            limit=limit,
+                            fields=fields)
+        return jsonify({'scans': scans, 'next_cursor': next_cursor(scans, limit)})
+    except Exception as e:
+        logger.error("Error in api_scans: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/scans/batch', methods=['POST'])
+def api_scans_batch():
+    # Bulk load of pre-measured scans, as JSON lines or CSV with a header row.
+    # Rows are graded like /scan, numbered per day in timestamp order and
+    # inserted in chunks; the reply has one outcome per input row.
+    fmt = request.args.get('format') or ('csv' if 'csv' in (request.content_type or '') else 'jsonl')
+    if fmt not in ('jsonl', 'csv'):
+        return jsonify({'error': 'Format must be jsonl or csv'}), 400
+    text = request.get_data(as_text=True)
+    records = list((parse_csv if fmt == 'csv' else parse_jsonl)(text))
+    if not records:
+        return jsonify({'error': 'No records'}), 400
+    if len(records) > IMPORT_MAX_ROWS:
+        return jsonify({'error': f'At most {IMPORT_MAX_ROWS} records per request'}), 413
+
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    voice_default = get_default_voice_recognition()
+    outcomes = []
+    scans = []
+    for line, record, error in records:
+        outcome = {'line': line}
+        outcomes.append(outcome)
+        if error is None:
+            try:
+                scan = normalize_record(record, now)
+                if scan['station'] and scan['station'] not in stations:
+                    raise ValueError(f"Unknown station {scan['station']}")
+            except ValueError as e:
+                error = str(e)
+        if error is not None:
+            outcome.update(status='invalid', error=error)
+            continue
+
+        model = config_cache.model(scan['qr_code'].split('.')[0])
+        requested = scan['result']
+        scan['status'], scan['failure_code'], scan['result'] = grade_scan(
+            model, scan['power'], scan['rpm'], scan['power_factor'], scan['failure_code'], scan['result'])
+        try:
+            check_result(requested, scan['status'])
+        except ValueError as e:
+            outcome.update(status='invalid', error=str(e))
+            continue
+        scan['station'] = scan['station'] or DEFAULT_STATION
+        scan['voice_recognition'] = scan['voice_recognition'] or voice_default
+        scan['scan_date'] = scan['timestamp'][:10]
+        scan['outcome'] = outcome
+        scans.append(scan)
+
+    scans.sort(key=lambda scan: scan['timestamp'])
+    # From the duplicate check to registering the new FP OK scans, no /scan
+    # can be numbered or queued (the queue is empty: exclusive() flushed it)
+    with exclusive_scans():
+        fp_ok = set()
+        kept = []
+        for scan in scans:
+            if scan['result'] == 'FP OK':
+                if scan['qr_code'] in fp_ok or duplicate_guard.is_duplicate(scan['qr_code']):
+                    scan['outcome'].update(status='duplicate', error='Duplicate FP OK')
+                    continue
+                fp_ok.add(scan['qr_code'])
+            kept.append(scan)
+        scans = kept
+        try:
+            with get_db() as conn:
+                numbers = next_daily_numbers(conn, {scan['scan_date'] for scan in scans})
+                for scan in scans:
+                    scan['daily_number'] = numbers[scan['scan_date']]
+                    numbers[scan['scan_date']] += 1
+                insert_chunks(conn, scans)
+        except Exception as e:
+            logger.error("Error in batch import: %s", e)
+            return jsonify({'error': 'Import failed'}), 500
+        for scan in scans:
+            if scan['result'] == 'FP OK' and not scan.get('error'):
+                duplicate_guard.add(scan['qr_code'])
+
+    dates = set()
+    for scan in scans:
+        if scan.get('error'):
+            scan['outcome'].update(status='duplicate', error=scan['error'])
+            continue
+        scan['outcome'].update(status='inserted', id=scan['id'], daily_number=scan['daily_number'],
+                               result=scan['result'])
+        dates.add(scan['scan_date'])
+        spc_engine.invalidate(scan['qr_code'].split('.')[0])
+
+    summary = {'inserted': 0, 'duplicate': 0, 'invalid': 0}
+    for outcome in outcomes:
+        summary[outcome['status']] += 1
+
+    # One update for the whole batch: displays showing an affected day reload
+    # their first page instead of getting thousands of new_scan events
+    if dates:
+        broadcaster.publish('scans_imported', {'dates': sorted(dates), 'count': summary['inserted']}, ALL)
+        with get_db() as conn:
+            for date in dates:
+                emit_stats_changed(conn, date)
+
+    return jsonify({'success': True, 'summary': summary, 'outcomes': outcomes})
+
+@app.route('/api/trends')
+def api_trends():
+    # Yield and measurement drift per hour/day/month, read from the rollups:
+    #   /api/trends?grain=month&start=2024-01&end=2024-12&model=CF1
+    #   /api/trends?grain=day&start=2024-05-01&end=2024-05-31&group_by=station
+    args = request.args
+    grain = args.get('grain', 'day')
+    if grain not in GRAINS:
+        return jsonify({'error': f"grain must be one of {', '.join(GRAINS)}"}), 400
+    group_by = args.get('group_by')
+    if group_by not in (None, 'model_prefix', 'station'):
+        return jsonify({'error': 'group_by must be model_prefix or station'}), 400
+    today = datetime.now().strftime('%Y-%m-%d')
+    start = args.get('start') or today[:8] + '01'
+    end = args.get('end') or today
+    flush_scans()
+    try:
+        points, failures = query_trends(get_db(), grain, start, end, model=args.get('model'),
+                                        station=args.get('station'), group_by=group_by)
+        return jsonify({'grain': grain, 'start': start, 'end': end, 'points': points, 'failure_codes': failures})
+    except Exception as e:
+        logger.error("Error in api_trends: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/spc')
+def api_spc():
+    # Control chart data per measure for one model: running mean/std, control
+    # limits, Cp/Cpk against the model's limits and the recent points with
+    # the Western Electric rules each one broke
+    prefix = request.args.get('model', '').strip()
+    if not prefix:
+        return jsonify({'error': 'model is required'}), 400
+    model = config_cache.model(prefix)
+    if model is None:
+        return jsonify({'error': f'Unknown model {prefix}'}), 404
+    try:
+        return jsonify({'model': prefix, 'rules': RULES, 'measures': spc_engine.snapshot(prefix, model)})
+    except Exception as e:
+        logger.error("Error in api_spc: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+def get_waveform(scan_id, columns):
+    conn = get_db()
+    return find_waveform(conn, scan_id, columns, archived_months(conn))
+
+@app.route('/api/scans/<int:scan_id>/waveform')
+def api_scan_waveform(scan_id):
+    # What was captured for a scan; the series themselves are fetched one by one
+    flush_scans()
+    row = get_waveform(scan_id, ('started_at', 'sample_count'))
+    if row is None:
+        return jsonify({'error': f'No waveform for scan {scan_id}'}), 404
+    return jsonify({
+        'id': scan_id,
+        'started_at': row['started_at'],
+        'sample_count': row['sample_count'],
+        'dtype': DTYPE,
+        'byteorder': BYTEORDER,
+        'series': {name: f'/api/scans/{scan_id}/waveform/{name}' for name in SERIES},
+    })
+
+@app.route('/api/scans/<int:scan_id>/waveform/<series>')
+def api_scan_waveform_series(scan_id, series):
+    # One series as stored: packed little-endian float32, sent as the bytes
+    # SQLite returned without decoding or re-encoding
+    if series not in SERIES:
+        return jsonify({'error': f'series must be one of {", ".join(SERIES)}'}), 400
+    flush_scans()
+    row = get_waveform(scan_id, ('sample_count', series))
+    if row is None:
+        return jsonify({'error': f'No waveform for scan {scan_id}'}), 404
+    return Response(row[series], mimetype='application/octet-stream', headers={
+        'X-Sample-Count': str(row['sample_count']),
+        'X-Dtype': DTYPE,
+        'X-Byte-Order': BYTEORDER,
+        'Content-Disposition': f'attachment; filename="scan_{scan_id}_{series}.f32"',
+    })
+
+gauge('qa_socketio_queue_depth', 'Events waiting in the broadcaster queue', lambda: broadcaster.stats()['depth'])
+gauge('qa_socketio_events_dropped', 'Events dropped since start because the broadcaster queue was full',
+      lambda: broadcaster.stats()['dropped'])
+gauge('qa_scan_writer_queue_depth', 'Scans waiting for the write-behind writer',
+      lambda: scan_writer.depth() if scan_writer is not None else 0)
+gauge('qa_db_pool_idle', 'Idle SQLite connections in the pool', lambda: _db_pool.qsize())
+
+@app.route('/metrics')
+def metrics():
+    # Prometheus text exposition of the counters and histograms in metrics.py
+    return Response(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/api/broadcast')
+def api_broadcast():
+    # Queue depth and drop counters of the Socket.IO broadcaster
+    return jsonify(broadcaster.stats())
+
+@app.route('/api/flush', methods=['POST'])
+def api_flush():
+    # Blocks until every queued scan is committed (write-behind mode)
+    flush_scans()
+    return jsonify({'success': True, 'write_behind': scan_writer is not None})
+
 @app.route('/update_failure_code', methods=['POST'])
 def update_failure_code():
     qr_code = request.form.get('qr_code', '').strip()
     failure_code = request.form.get('failure_code', '').strip()
     if not qr_code or not failure_code:
         return jsonify({'error': 'QR code and failure code are required'}), 400
+    flush_scans()
 
     try:
         with get_db() as conn:
             cur = conn.cursor()
             # Update the most recent failed scan for this QR code with empty failure_code
             cur.execute("""
-                UPDATE scans
-                SET failure_code = ?
+                SELECT id FROM scans
                 WHERE qr_code = ? AND status = 'FAIL' AND (failure_code = '' OR failure_code IS NULL)
                 ORDER BY id DESC
                 LIMIT 1
-            """, (failure_code, qr_code))
-            conn.commit()
-            if cur.rowcount == 0:
+            """, (qr_code,))
+            target = cur.fetchone()
+            if not target:
                 return jsonify({'error': 'No matching failed scan found'}), 404
-            return jsonify({'success': True})
+            cur.execute("UPDATE scans SET failure_code = ? WHERE id = ?", (failure_code, target['id']))
+            conn.commit()
+            scan = emit_scan_updated(conn, target['id'])
+            return jsonify({'success': True, 'scan': scan})
     except Exception as e:
-        print(f"Error updating failure code: {str(e)}")
+        logger.error("Error updating failure code: %s", e)
         return jsonify({'error': 'Failed to update failure code'}), 500
 
 def get_default_voice_recognition():
-    with get_db() as conn:
-        cur = conn.cursor()
-        cur.execute("SELECT value FROM settings WHERE key = 'default_voice_recognition'")
-        result = cur.fetchone()
-        return result['value'] if result else 'NA'
+    return config_cache.setting('default_voice_recognition', 'NA')
 
 @app.route('/voice_recognition', methods=['POST'])
 def voice_recognition():
@@ -525,22 +1306,31 @@ def voice_recognition():
                 VALUES ('default_voice_recognition', ?)
             """, (option,))
             conn.commit()
+        config_cache.invalidate()
+        broadcaster.publish('settings_changed', {'default_voice_recognition': option}, ALL)
         return jsonify({'success': True, 'selected': option})
     except Exception as e:
-        print(f"Error updating voice recognition: {str(e)}")
+        logger.error("Error updating voice recognition: %s", e)
         return jsonify({'error': str(e)}), 500
     
+def duplicate_fp_ok_error():
+    return jsonify({
+        'error': 'This QR code already has an FP OK scan',
+        'duplicate_fp_ok': True
+    }), 409
+
 @app.route('/edit_last_scan', methods=['POST'])
 def edit_last_scan():
     failure_code = request.form.get('failure_code', '').strip()
     result = request.form.get('result', '').strip()
     if not failure_code or not result:
         return jsonify({'error': 'Both failure code and result are required'}), 400
+    flush_scans()
     try:
         with get_db() as conn:
             cur = conn.cursor()
             # Get last scan's ID
-            cur.execute("SELECT id FROM scans ORDER BY id DESC LIMIT 1")
+            cur.execute("SELECT id, qr_code, result FROM scans ORDER BY id DESC LIMIT 1")
             last_scan = cur.fetchone()
             if not last_scan:
                 return jsonify({'error': 'No scans found'}), 404
@@ -552,12 +1342,17 @@ def edit_last_scan():
                 WHERE id = ?
             """, (failure_code, result, scan_id))
             conn.commit()
-        return jsonify({'success': True})
+            duplicate_guard.result_changed(last_scan['qr_code'], last_scan['result'], result)
+            scan = emit_scan_updated(conn, scan_id)
+        return jsonify({'success': True, 'scan': scan})
+    except sqlite3.IntegrityError:
+        return duplicate_fp_ok_error()
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     
 @app.route('/last_scan')
 def last_scan():
+    flush_scans()
     try:
         with get_db() as conn:
             cur = conn.cursor()
@@ -575,27 +1370,37 @@ def update_result():
     result = request.form.get('result', '').strip()
     if not result:
         return jsonify({'error': 'Result is required'}), 400
+    flush_scans()
     try:
         with get_db() as conn:
             cur = conn.cursor()
             # Update the most recent scan
+            cur.execute("SELECT id, qr_code, result FROM scans ORDER BY id DESC LIMIT 1")
+            last_scan = cur.fetchone()
+            if not last_scan:
+                return jsonify({'success': True})
             cur.execute("""
                 UPDATE scans
                 SET result = ?
-                WHERE id = (SELECT id FROM scans ORDER BY id DESC LIMIT 1)
-            """, (result,))
+                WHERE id = ?
+            """, (result, last_scan['id']))
             conn.commit()
-        return jsonify({'success': True})
+            duplicate_guard.result_changed(last_scan['qr_code'], last_scan['result'], result)
+            scan = emit_scan_updated(conn, last_scan['id'])
+        return jsonify({'success': True, 'scan': scan})
+    except sqlite3.IntegrityError:
+        return duplicate_fp_ok_error()
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 @app.route('/update_failure_code_and_result', methods=['POST'])
 def update_failure_code_and_result():
+    flush_scans()
     try:
         failure_code = request.form.get('failure_code', '').strip()
         result = request.form.get('result', '').strip()
 
-        logger.debug(f"Received failure_code: {failure_code}, result: {result}")
+        logger.debug("Received failure_code: %s, result: %s", failure_code, result)
 
         if not failure_code:
             return jsonify({'error': 'Failure code is required'}), 400
@@ -604,7 +1409,7 @@ def update_failure_code_and_result():
             cur = conn.cursor()
             # First, verify if the last scan exists and is a failure
             cur.execute("""
-                SELECT id FROM scans 
+                SELECT id, qr_code, result FROM scans 
                 WHERE status = 'FAIL' 
                 ORDER BY id DESC LIMIT 1
             """)
@@ -626,34 +1431,134 @@ def update_failure_code_and_result():
             if cur.rowcount == 0:
                 return jsonify({'error': 'Update failed'}), 500
 
-            return jsonify({'success': True})
+            duplicate_guard.result_changed(last_scan['qr_code'], last_scan['result'], result)
+            scan = emit_scan_updated(conn, last_scan['id'])
+            return jsonify({'success': True, 'scan': scan})
 
+    except sqlite3.IntegrityError:
+        return duplicate_fp_ok_error()
     except Exception as e:
-        print(f"Error in update_failure_code_and_result: {str(e)}")
+        logger.error("Error in update_failure_code_and_result: %s", e)
         return jsonify({'error': str(e)}), 500
 @app.route('/defaults')
 def defaults():
-    with get_db() as conn:
-        cur = conn.cursor()
-        cur.execute("SELECT value FROM settings WHERE key = 'default_voice_recognition'")
-        result = cur.fetchone()
-        voice_default = result['value'] if result else 'NA'
+    voice_default = get_default_voice_recognition()
     return jsonify({'default_voice_recognition': voice_default})
 
 @app.route('/clear_scans', methods=['POST'])
 def clear_scans():
+    flush_scans()
     try:
         with get_db() as conn:
             cur = conn.cursor()
+            # Archived months stay, with their counters and trends; removing
+            # them is a separate, deliberate step (flask --app app remove-archives)
+            cleared = [row[0] for row in cur.execute(
+                "SELECT scan_date FROM daily_stats WHERE substr(scan_date, 1, 7) NOT IN (SELECT month FROM scan_archives)"
+                " UNION SELECT DISTINCT scan_date FROM scans")]
             cur.execute("DELETE FROM scans")  # clears only scan logs
+            cur.execute("DELETE FROM daily_stats WHERE substr(scan_date, 1, 7) NOT IN (SELECT month FROM scan_archives)")
+            for table in ('scan_rollups', 'failure_rollups'):
+                cur.execute(f"DELETE FROM {table} WHERE substr(period, 1, 7) NOT IN (SELECT month FROM scan_archives)")
             conn.commit()
+            duplicate_guard.invalidate()  # reloads, archived FP OK serials still count
+            reset_scan_numbering()
+            spc_engine.invalidate()
+            # Only displays showing a cleared day are told, with its (zeroed) counters
+            for date in cleared:
+                broadcaster.publish('scan_removed', {'all': True}, date_room(date))
+                emit_stats_changed(conn, date)
         return jsonify({'success': True, 'message': 'All scan logs cleared successfully.'})
     except Exception as e:
-        print(f"Error clearing scans: {str(e)}")
+        logger.error("Error clearing scans: %s", e)
         return jsonify({'error': 'Failed to clear scans'}), 500
 
+def rebuild_stats():
+    init_db()
+    with get_db() as conn:
+        rebuild_daily_stats(conn.cursor(), [month for month, _ in archived_months(conn)])
+        conn.commit()
+    print("daily_stats rebuilt")
+
+@app.cli.command('rebuild-stats')
+def rebuild_stats_command():
+    """Recompute the daily_stats rollup from the scans table (archived months are kept)."""
+    rebuild_stats()
+
+def archive_scans():
+    # Moves closed months out of the hot database (QA_RETAIN_MONTHS months are kept)
+    flush_scans()
+    with get_db() as conn:
+        archived = archive_closed_months(conn)
+    for month, rows in archived.items():
+        logger.info("Archived %d scans of %s", rows, month)
+    return archived
+
+def start_archiver():
+    def run():
+        while True:
+            try:
+                archive_scans()
+            except Exception as e:
+                logger.error("Error archiving scans: %s", e)
+            socketio.sleep(ARCHIVE_CHECK_INTERVAL)
+    socketio.start_background_task(run)
+
+@app.cli.command('archive-scans')
+def archive_scans_command():
+    """Move months older than QA_RETAIN_MONTHS into per-month archive files."""
+    init_db()
+    archive_scans()
+
+def rebuild_trend_rollups():
+    init_db()
+    with get_db() as conn:
+        rebuild_rollups(conn.cursor(), [month for month, _ in archived_months(conn)])
+        conn.commit()
+    print("scan_rollups and failure_rollups rebuilt")
+
+def remove_scan_archives():
+    init_db()
+    flush_scans()
+    with get_db() as conn:
+        months = remove_archives(conn)
+    duplicate_guard.invalidate()
+    spc_engine.invalidate()
+    print(f"Removed {len(months)} archived month(s): {', '.join(months) or 'none'}")
+    return months
+
+@app.cli.command('remove-archives')
+def remove_archives_command():
+    """Delete every monthly archive file and what refers to it, for good."""
+    remove_scan_archives()
+
+@app.cli.command('rebuild-rollups')
+def rebuild_rollups_command():
+    """Recompute the trend rollups from the scans table (archived months are kept)."""
+    rebuild_trend_rollups()
+
 
 if __name__ == '__main__':
+    if sys.argv[1:] == ['rebuild-stats']:  # also: flask --app app rebuild-stats
+        rebuild_stats()
+        sys.exit(0)
+    if sys.argv[1:] == ['archive-scans']:  # also: flask --app app archive-scans
+        init_db()
+        archive_scans()
+        sys.exit(0)
+    if sys.argv[1:] == ['remove-archives']:  # also: flask --app app remove-archives
+        remove_scan_archives()
+        sys.exit(0)
+    if sys.argv[1:] == ['rebuild-rollups']:  # also: flask --app app rebuild-rollups
+        rebuild_trend_rollups()
+        sys.exit(0)
     init_db()
-    print(">>> Flask-SocketIO async_mode:", socketio.async_mode)  # debug print
+    config_cache.load()
+    if WRITE_BEHIND:
+        start_write_behind()
+    if RETAIN_MONTHS > 0:
+        start_archiver()
+    logger.info("Flask-SocketIO async_mode: %s", socketio.async_mode)
+    if SENSOR_POLLING:
+        start_sensor_polling()
     socketio.run(app, host='0.0.0.0', port=5000, debug=True)
@@ -0,0 +1,220 @@
+import logging
+import os
+import sqlite3
+from datetime import datetime
+
+from capture import create_waveform_table
+
+logger = logging.getLogger(__name__)
+
+# Monthly archival of the scans table. Closed months are moved out of
+# scan_log.db into one SQLite file per month, so the hot database (and its
+# page cache) only holds the recent months the line works with.
+#
+#   archive/scans_2024-05.db
+#
+# What stays in the hot database for archived months:
+#   daily_stats, scan_rollups, failure_rollups   counters and trends, unchanged
+#   archived_fp_ok                               serials that passed first time,
+#                                                so a unit still can't pass twice
+#   scan_archives                                which months live in which file
+#
+# Captured waveforms (capture.py) move into the archive file with their scans.
+#
+# Readers that span dates (listing, export) attach the month files they need,
+# a few at a time, and read them together with the hot table.
+
+ARCHIVE_DIR = os.environ.get('QA_ARCHIVE_DIR', 'archive')
+# Months kept in the hot database, the current one included; 0 disables archival
+RETAIN_MONTHS = int(os.environ.get('QA_RETAIN_MONTHS', '0'))
+# Archives attached per query; SQLite allows 10 attached databases by default
+ATTACH_LIMIT = 8
+
+
+def month_start(month):
+    return month + '-01'
+
+def month_end(month):
+    return month + '-31'  # scan_date is text, so this sorts after every day of the month
+
+def next_month(month):
+    year, number = int(month[:4]), int(month[5:7])
+    year, number = (year + 1, 1) if number == 12 else (year, number + 1)
+    return f'{year:04d}-{number:02d}'
+
+def cutoff_month(retain_months, today=None):
+    # The oldest month that stays hot
+    today = today or datetime.now().strftime('%Y-%m-%d')
+    year, number = int(today[:4]), int(today[5:7])
+    index = year * 12 + (number - 1) - (retain_months - 1)
+    return f'{index // 12:04d}-{index % 12 + 1:02d}'
+
+
+def archive_path(month, archive_dir=None):
+    return os.path.join(archive_dir or ARCHIVE_DIR, f'scans_{month}.db')
+
+def _scan_columns(conn):
+    return [(row[1], row[2]) for row in conn.execute("PRAGMA main.table_info(scans)")]
+
+def archive_month(conn, month, archive_dir=None):
+    # Copies one month into its archive file, then removes it from the hot
+    # table with the counters left as they were. Two transactions: a crash
+    # in between leaves the rows in both places and a rerun finishes the job.
+    path = archive_path(month, archive_dir)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    columns = _scan_columns(conn)
+    names = ', '.join(name for name, _ in columns)
+    low, high = month_start(month), month_end(month)
+
+    conn.commit()
+    conn.execute("ATTACH DATABASE ? AS archive", (path,))
+    try:
+        decls = ', '.join('id INTEGER PRIMARY KEY' if name == 'id' else f'{name} {decl}'
+                          for name, decl in columns)
+        conn.execute(f"CREATE TABLE IF NOT EXISTS archive.scans ({decls})")
+        conn.execute("CREATE INDEX IF NOT EXISTS archive.idx_scans_scan_date ON scans (scan_date)")
+        conn.execute(f"""
+            INSERT OR IGNORE INTO archive.scans ({names})
+            SELECT {names} FROM main.scans WHERE scan_date BETWEEN ? AND ?
+        """, (low, high))
+        # Captured waveforms go with their scans (the delete trigger drops them from main)
+        create_waveform_table(conn, 'archive')
+        conn.execute("""
+            INSERT OR IGNORE INTO archive.scan_waveforms
+            SELECT * FROM main.scan_waveforms WHERE scan_id IN (SELECT id FROM archive.scans)
+        """)
+        conn.commit()
+        row_count = conn.execute("SELECT COUNT(*) FROM archive.scans").fetchone()[0]
+
+        # The delete triggers would take the month out of the counters and
+        # trends; keep copies and put them back afterwards
+        kept = {
+            'daily_stats': ("scan_date BETWEEN ? AND ?", (low, high)),
+            'scan_rollups': ("substr(period, 1, 7) = ?", (month,)),
+            'failure_rollups': ("substr(period, 1, 7) = ?", (month,)),
+        }
+        for table, (where, params) in kept.items():
+            conn.execute(f"DROP TABLE IF EXISTS temp.kept_{table}")
+            conn.execute(f"CREATE TEMP TABLE kept_{table} AS SELECT * FROM main.{table} WHERE {where}", params)
+        conn.execute("""
+            INSERT OR IGNORE INTO main.archived_fp_ok (qr_code)
+            SELECT qr_code FROM archive.scans WHERE result = 'FP OK' AND fp_ok_duplicate = 0
+        """)
+        conn.execute("DELETE FROM main.scans WHERE scan_date BETWEEN ? AND ?", (low, high))
+        for table, (where, params) in kept.items():
+            conn.execute(f"DELETE FROM main.{table} WHERE {where}", params)
+            conn.execute(f"INSERT INTO main.{table} SELECT * FROM temp.kept_{table}")
+            conn.execute(f"DROP TABLE temp.kept_{table}")
+        conn.execute("""
+            INSERT OR REPLACE INTO scan_archives (month, path, row_count, archived_at)
+            VALUES (?, ?, ?, ?)
+        """, (month, path, row_count, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.execute("DETACH DATABASE archive")
+    return row_count
+
+def archive_closed_months(conn, retain_months=None, archive_dir=None, today=None):
+    # Archives every month older than the retained ones; returns {month: rows}
+    retain_months = RETAIN_MONTHS if retain_months is None else retain_months
+    if retain_months <= 0:
+        return {}
+    cutoff = month_start(cutoff_month(retain_months, today))
+    months = [row[0] for row in conn.execute(
+        "SELECT DISTINCT substr(scan_date, 1, 7) FROM scans WHERE scan_date < ? ORDER BY 1", (cutoff,))]
+    return {month: archive_month(conn, month, archive_dir) for month in months}
+
+def remove_archives(conn):
+    # Deletes every archive for good, with the counters, trends and FP OK
+    # serials of its month. The files go only once that is committed, so a
+    # failed commit never leaves scan_archives pointing at missing files.
+    months = archived_months(conn)
+    try:
+        for month, _ in months:
+            conn.execute("DELETE FROM daily_stats WHERE scan_date BETWEEN ? AND ?",
+                         (month_start(month), month_end(month)))
+            for table in ('scan_rollups', 'failure_rollups'):
+                conn.execute(f"DELETE FROM {table} WHERE substr(period, 1, 7) = ?", (month,))
+        conn.execute("DELETE FROM scan_archives")
+        conn.execute("DELETE FROM archived_fp_ok")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    for month, path in months:
+        if os.path.exists(path):
+            os.remove(path)
+    return [month for month, _ in months]
+
+
+def archived_months(conn, start_date=None, end_date=None):
+    # [(month, path)] of the archives overlapping the range, oldest first
+    where, params = [], []
+    if start_date:
+        where.append("month >= ?")
+        params.append(start_date[:7])
+    if end_date:
+        where.append("month <= ?")
+        params.append(end_date[:7])
+    query = "SELECT month, path FROM scan_archives"
+    if where:
+        query += " WHERE " + " AND ".join(where)
+    return [tuple(row) for row in conn.execute(query + " ORDER BY month", params)]
+
+def iter_sources(conn, columns, start_date=None, end_date=None, newest_first=False):
+    # Splits [start_date, end_date] into consecutive stretches and yields
+    # (source, params, low, high) for each: source is an SQL table expression
+    # with `columns` of every scan dated low..high, hot and archived alike.
+    # The archives of a stretch stay attached until the caller asks for the
+    # next one. Without archives this is just the hot table.
+    names = ', '.join(columns)
+    months = archived_months(conn, start_date, end_date)
+    groups = [months[i:i + ATTACH_LIMIT] for i in range(0, len(months), ATTACH_LIMIT)]
+
+    stretches = []
+    low = start_date
+    for group in groups:
+        high = month_end(group[-1][0])
+        if end_date and end_date < high:
+            high = end_date
+        stretches.append((group, low, high))
+        low = month_start(next_month(group[-1][0]))
+    if not groups or not end_date or low <= end_date:
+        stretches.append(([], low, end_date))
+    if newest_first:
+        stretches.reverse()
+
+    for group, low, high in stretches:
+        where, params = [], []
+        if low:
+            where.append("scan_date >= ?")
+            params.append(low)
+        if high:
+            where.append("scan_date <= ?")
+            params.append(high)
+        where = " WHERE " + " AND ".join(where) if where else ""
+        hot = f"SELECT {names} FROM main.scans{where}"
+        if not group:
+            yield f"({hot})", params, low, high
+            continue
+
+        aliases = []
+        try:
+            for month, path in group:
+                if not os.path.exists(path):
+                    logger.warning("Archive %s for %s is missing, skipping it", path, month)
+                    continue
+                alias = f"archive_{month.replace('-', '_')}"
+                conn.execute("ATTACH DATABASE ? AS " + alias, (path,))
+                aliases.append(alias)
+            parts = [f"SELECT {names} FROM {alias}.scans{where}" for alias in aliases] + [hot]
+            yield "(" + " UNION ALL ".join(parts) + ")", params * len(parts), low, high
+        finally:
+            for alias in aliases:
+                try:
+                    conn.execute("DETACH DATABASE " + alias)
+                except sqlite3.OperationalError as e:
+                    logger.error("Could not detach %s: %s", alias, e)
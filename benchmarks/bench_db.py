@@ -0,0 +1,82 @@
+# Scans/sec through /scan with the sensors stubbed out, so only the database
+# path is measured. Runs twice: once the way the app used to open SQLite (new
+# connection per get_db() call, rollback journal) and once with the pooled
+# WAL connections.
+#
+#   python benchmarks/bench_db.py --scans 500 --readers 2
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import app as app_module
+
+
+def legacy_get_db():
+    conn = sqlite3.connect(app_module.DB_FILE)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+
+def run(label, scans, readers, legacy):
+    tmp = tempfile.TemporaryDirectory()
+    app_module.DB_FILE = os.path.join(tmp.name, 'bench.db')
+    app_module.init_db()
+    with sqlite3.connect(app_module.DB_FILE) as conn:
+        conn.execute("INSERT INTO models VALUES ('BENCH', 50, 100, 0.9, 250, 400)")
+        if legacy:
+            conn.execute("PRAGMA journal_mode=DELETE")
+
+    original_get_db = app_module.get_db
+    if legacy:
+        app_module.get_db = legacy_get_db
+
+    stop = threading.Event()
+    reads = [0]
+
+    def dashboard():
+        client = app_module.app.test_client()
+        while not stop.is_set():
+            client.get('/')
+            reads[0] += 1
+
+    threads = [threading.Thread(target=dashboard, daemon=True) for _ in range(readers)]
+    for t in threads:
+        t.start()
+
+    client = app_module.app.test_client()
+    failures = 0
+    started = time.perf_counter()
+    for i in range(scans):
+        rv = client.post('/scan', data={'qr_code': f'BENCH.{i:06d}'})
+        if rv.status_code != 200:
+            failures += 1
+    elapsed = time.perf_counter() - started
+
+    stop.set()
+    for t in threads:
+        t.join()
+    app_module.get_db = original_get_db
+    tmp.cleanup()
+
+    print(f"{label:<8} {scans / elapsed:8.1f} scans/s   {reads[0] / elapsed:8.1f} page loads/s   {failures} failed")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the /scan database path')
+    parser.add_argument('--scans', type=int, default=300)
+    parser.add_argument('--readers', type=int, default=1, help='threads loading the dashboard meanwhile')
+    args = parser.parse_args()
+
+    app_module.read_sensors = lambda station_id=None: (75.5, 0.98, 320)
+    run('before', args.scans, args.readers, legacy=True)
+    run('after', args.scans, args.readers, legacy=False)
+
+
+if __name__ == '__main__':
+    main()
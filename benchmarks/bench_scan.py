@@ -0,0 +1,97 @@
+# End-to-end /scan latency against the simulated RS485 bus (Linux only).
+#
+#   python benchmarks/bench_scan.py --scans 200 --latency 0.01 --jitter 0.005
+#
+# Reports p50/p95/p99 for the bus phase (sensor read), the DB phase
+# (insert_scan + get_stats) and the whole request.
+import argparse
+import math
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import serial
+import app as app_module
+import rs485_reader
+from modbus_sim import ModbusSimulator
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    # nearest-rank
+    k = max(0, math.ceil(pct / 100.0 * len(ordered)) - 1)
+    return ordered[k]
+
+
+def timed(fn, bucket):
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            bucket[-1] += time.perf_counter() - started
+    return wrapper
+
+
+def report(name, values):
+    ms = [v * 1000 for v in values]
+    print(f"{name:<8} p50 {percentile(ms, 50):8.2f} ms   p95 {percentile(ms, 95):8.2f} ms   "
+          f"p99 {percentile(ms, 99):8.2f} ms   max {max(ms):8.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark /scan against the simulated RS485 bus')
+    parser.add_argument('--scans', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.005, help='slave response latency (s)')
+    parser.add_argument('--jitter', type=float, default=0.0, help='extra random latency (s)')
+    parser.add_argument('--crc-error-rate', type=float, default=0.0)
+    parser.add_argument('--exception-rate', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+
+    tmp = tempfile.TemporaryDirectory()
+    app_module.DB_FILE = os.path.join(tmp.name, 'bench.db')
+    app_module.init_db()
+    with app_module.get_db() as conn:
+        conn.execute("INSERT INTO models VALUES ('BENCH', 50, 100, 0.9, 250, 400)")
+        conn.commit()
+
+    bus, db = [], []
+    app_module.read_sensors = timed(app_module.read_sensors, bus)
+    app_module.insert_scan = timed(app_module.insert_scan, db)
+    app_module.get_stats = timed(app_module.get_stats, db)
+
+    sim = ModbusSimulator(latency=args.latency, jitter=args.jitter, crc_error_rate=args.crc_error_rate,
+                          exception_rate=args.exception_rate, seed=args.seed).start()
+    station = app_module.stations[app_module.DEFAULT_STATION]
+    station.session = rs485_reader.RS485Session(port=sim.port, meter_parity=serial.PARITY_NONE)
+
+    total, failures = [], 0
+    client = app_module.app.test_client()
+    try:
+        for i in range(args.scans):
+            bus.append(0.0)
+            db.append(0.0)
+            started = time.perf_counter()
+            rv = client.post('/scan', data={'qr_code': f'BENCH.{i:06d}'})
+            total.append(time.perf_counter() - started)
+            if rv.status_code != 200:
+                failures += 1
+    finally:
+        station.close()
+        sim.stop()
+        tmp.cleanup()
+
+    print(f"{args.scans} scans, {failures} failed, {sim.requests} bus requests")
+    report('bus', bus)
+    report('db', db)
+    report('total', total)
+
+
+if __name__ == '__main__':
+    main()
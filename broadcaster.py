@@ -0,0 +1,124 @@
+import logging
+import queue
+import threading
+import time
+
+from metrics import SOCKETIO_EMIT_SECONDS, SOCKETIO_EVENTS
+
+# Events published within this window go out together as one 'batch' message per room
+COALESCE_WINDOW = 0.05  # seconds
+# Events waiting to be sent; when full, new events are dropped and counted
+MAX_PENDING = 5000
+
+ALL = None  # room value for "every connected client"
+
+logger = logging.getLogger(__name__)
+
+
+def station_room(station_id):
+    return f'station:{station_id}'
+
+def date_room(date):
+    return f'date:{date}'
+
+
+def coalesce_key(event, data):
+    # Events that only carry the latest state replace an earlier one with the
+    # same key in the same batch. Others (new_scan, scan_removed) all go out.
+    if event == 'stats_changed':
+        return (event, data.get('date'))
+    if event == 'scan_updated':
+        return (event, data['scan']['id'])
+    if event == 'live_readings':
+        return (event, data.get('station'))
+    if event == 'spc_update':
+        return (event, data.get('model'))
+    if event == 'settings_changed':
+        return (event,)
+    return None
+
+
+class Broadcaster:
+    # Request handlers publish() and return at once; a background task sends
+    # what piled up every COALESCE_WINDOW, one emit per room, so a slow
+    # websocket client never holds up an HTTP response and a burst of edits
+    # costs one message per display instead of one per edit.
+
+    def __init__(self, socketio, window=COALESCE_WINDOW, max_pending=MAX_PENDING):
+        self.socketio = socketio
+        self.window = window
+        self._pending = queue.Queue(maxsize=max_pending)
+        self._flush_lock = threading.Lock()
+        self._running = False
+        self.published = 0
+        self.dropped = 0
+        self.batches = 0
+        self.sent = 0
+        self.max_depth = 0
+
+    def start(self):
+        if not self._running:
+            self._running = True
+            self.socketio.start_background_task(self._run)
+        return self
+
+    def stop(self):
+        self._running = False
+
+    def publish(self, event, data, room=ALL):
+        self.start()
+        try:
+            self._pending.put_nowait((room, event, data))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        self.published += 1
+        self.max_depth = max(self.max_depth, self._pending.qsize())
+        return True
+
+    def _run(self):
+        # socketio.sleep yields to the eventlet/gevent hub, which a blocking
+        # wait on a threading primitive would not
+        while self._running:
+            self.socketio.sleep(self.window)
+            if self._pending.empty():
+                continue
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error("Broadcast failed: %s", e)
+
+    def flush(self):
+        # Send everything queued so far; safe to call from a request or a test
+        with self._flush_lock:
+            rooms = {}
+            while True:
+                try:
+                    room, event, data = self._pending.get_nowait()
+                except queue.Empty:
+                    break
+                batch = rooms.setdefault(room, {})
+                key = coalesce_key(event, data)
+                if key is None:
+                    key = object()
+                batch.pop(key, None)  # the latest copy goes last
+                batch[key] = [event, data]
+            for room, batch in rooms.items():
+                events = list(batch.values())
+                started = time.perf_counter()
+                self.socketio.emit('batch', events, to=room)
+                SOCKETIO_EMIT_SECONDS.observe(time.perf_counter() - started)
+                for event, _ in events:
+                    SOCKETIO_EVENTS.inc(event)
+                self.batches += 1
+                self.sent += len(batch)
+
+    def stats(self):
+        return {
+            'depth': self._pending.qsize(),
+            'max_depth': self.max_depth,
+            'published': self.published,
+            'dropped': self.dropped,
+            'batches': self.batches,
+            'sent': self.sent,
+        }
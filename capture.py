@@ -0,0 +1,189 @@
+import os
+import sys
+import time
+from array import array
+from datetime import datetime
+
+# High-rate capture of the measurements over the test window. Instead of one
+# reading per scan, the meters are read repeatedly for CAPTURE_WINDOW seconds;
+# the scan is graded on the mean and the series are kept for traceability.
+#
+# Each series is stored as one BLOB of packed little-endian float32 values in
+# scan_waveforms, one row per scan, so a few thousand samples cost a few kB
+# next to the scan instead of thousands of rows:
+#
+#   t              seconds since started_at
+#   power, power_factor, rpm
+#
+# A client reads a series back with e.g. numpy.frombuffer(blob, '<f4') or
+# array('f', blob) (byteswapped on a big-endian host).
+#
+# Steady-state mode (QA_STEADY=1) uses the same loop without a fixed window:
+# the meters are read back to back until the last STEADY_SAMPLES readings of
+# every measure have settled (spread and drift within STEADY_TOLERANCE), or
+# STEADY_TIMEOUT has passed. The scan is graded on the mean of those last
+# readings, which is no noisier than a single read and usually much less.
+
+CAPTURE = os.environ.get('QA_CAPTURE', '0') == '1'
+CAPTURE_WINDOW = float(os.environ.get('QA_CAPTURE_WINDOW', '3.0'))       # seconds
+CAPTURE_INTERVAL = float(os.environ.get('QA_CAPTURE_INTERVAL', '0.05'))  # seconds between reads, bus permitting
+CAPTURE_MAX_SAMPLES = 10000
+
+STEADY = os.environ.get('QA_STEADY', '0') == '1'
+STEADY_SAMPLES = int(os.environ.get('QA_STEADY_SAMPLES', '8'))          # readings in the rolling window
+STEADY_TIMEOUT = float(os.environ.get('QA_STEADY_TIMEOUT', '10.0'))     # seconds, grade what we have after this
+STEADY_INTERVAL = float(os.environ.get('QA_STEADY_INTERVAL', '0'))      # seconds between reads, 0 = back to back
+# Largest standard deviation, and drift across the window, still counted as settled
+STEADY_TOLERANCE = {
+    'power': float(os.environ.get('QA_STEADY_POWER_TOL', '0.5')),          # W
+    'power_factor': float(os.environ.get('QA_STEADY_PF_TOL', '0.01')),
+    'rpm': float(os.environ.get('QA_STEADY_RPM_TOL', '5')),
+}
+
+SERIES = ('t', 'power', 'power_factor', 'rpm')
+DTYPE = 'float32'
+BYTEORDER = 'little'
+
+
+class Waveform:
+
+    def __init__(self, started_at):
+        self.started_at = started_at   # wall-clock time of the first sample
+        self.series = {name: array('f') for name in SERIES}
+        self.steady = None             # set by steady-state capture: settled before the timeout
+
+    def __len__(self):
+        return len(self.series['t'])
+
+    def append(self, t, power, power_factor, rpm):
+        for name, value in zip(SERIES, (t, power, power_factor, rpm)):
+            self.series[name].append(value)
+
+    def average(self, last=None):
+        # (power, power_factor, rpm) rounded like a single reading, for
+        # grading; the mean of the `last` samples only when given
+        start = -last if last else 0
+        power, power_factor, rpm = (self.series[name][start:] for name in SERIES[1:])
+        n = len(power)
+        return (
+            round(sum(power) / n, 1),
+            round(sum(power_factor) / n, 2),
+            round(sum(rpm) / n),
+        )
+
+    def duration(self):
+        return self.series['t'][-1] if len(self) else 0.0
+
+    def started_text(self):
+        return datetime.fromtimestamp(self.started_at).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+
+
+def pack(values):
+    # array('f') is native order; the stored format is always little-endian
+    if sys.byteorder != BYTEORDER:
+        values = array('f', values)
+        values.byteswap()
+    return values.tobytes()
+
+def unpack(blob):
+    values = array('f')
+    values.frombytes(blob)
+    if sys.byteorder != BYTEORDER:
+        values.byteswap()
+    return values
+
+
+def capture(read, window=CAPTURE_WINDOW, interval=CAPTURE_INTERVAL, sleep=time.sleep,
+            clock=time.monotonic, now=time.time, until=None):
+    # Reads (power, power_factor, rpm) from the bus until `window` seconds
+    # have passed, or until(wave) is true after a reading; failed reads are
+    # skipped. None if every read failed.
+    wave = Waveform(now())
+    start = clock()
+    while len(wave) < CAPTURE_MAX_SAMPLES:
+        started = clock()
+        power, power_factor, rpm = read()
+        if power is not None and power_factor is not None and rpm is not None:
+            wave.append(started - start, power, power_factor, rpm)
+            if until is not None and until(wave):
+                break
+        if clock() - start >= window:
+            break
+        sleep(max(0.0, interval - (clock() - started)))
+    return wave if len(wave) else None
+
+def settled(wave, samples=STEADY_SAMPLES, tolerance=STEADY_TOLERANCE):
+    # True when the last `samples` readings of every measure have a standard
+    # deviation, and a least-squares drift from first to last, within tolerance
+    n = len(wave)
+    if n < max(samples, 2):
+        return False
+    t = wave.series['t'][n - samples:]
+    t_mean = sum(t) / samples
+    t_var = sum((x - t_mean) ** 2 for x in t)
+    for name, limit in tolerance.items():
+        values = wave.series[name][n - samples:]
+        mean = sum(values) / samples
+        if sum((x - mean) ** 2 for x in values) / (samples - 1) > limit * limit:
+            return False
+        if t_var > 0:
+            slope = sum((a - t_mean) * (x - mean) for a, x in zip(t, values)) / t_var
+            if abs(slope) * (t[-1] - t[0]) > limit:
+                return False
+    return True
+
+def capture_steady(read, samples=STEADY_SAMPLES, timeout=STEADY_TIMEOUT, interval=STEADY_INTERVAL,
+                   tolerance=STEADY_TOLERANCE, sleep=time.sleep, clock=time.monotonic, now=time.time):
+    # Reads until settled() or the timeout; wave.steady tells which ended it
+    wave = capture(read, timeout, interval, sleep=sleep, clock=clock, now=now,
+                   until=lambda wave: settled(wave, samples, tolerance))
+    if wave is not None:
+        wave.steady = settled(wave, samples, tolerance)
+    return wave
+
+def from_samples(samples):
+    # The same from SensorPoller samples already in memory
+    if not samples:
+        return None
+    wave = Waveform(samples[0].timestamp)
+    for s in samples:
+        wave.append(s.monotonic - samples[0].monotonic, s.power, s.power_factor, s.rpm)
+    return wave
+
+
+def create_waveform_table(conn, schema='main'):
+    conn.execute(f"""
+        CREATE TABLE IF NOT EXISTS {schema}.scan_waveforms (
+            scan_id INTEGER PRIMARY KEY,
+            started_at TEXT NOT NULL,
+            sample_count INTEGER NOT NULL,
+            {', '.join(f'{name} BLOB NOT NULL' for name in SERIES)}
+        )
+    """)
+
+def store_waveform(conn, scan_id, wave):
+    conn.execute(f"""
+        INSERT OR REPLACE INTO scan_waveforms (scan_id, started_at, sample_count, {', '.join(SERIES)})
+        VALUES (?, ?, ?, {', '.join('?' * len(SERIES))})
+    """, (scan_id, wave.started_text(), len(wave), *(pack(wave.series[name]) for name in SERIES)))
+
+def find_waveform(conn, scan_id, columns, archives=()):
+    # The scan_waveforms row of a scan, from the hot database or else from
+    # the month archives [(month, path)], newest first
+    query = f"SELECT {', '.join(columns)} FROM {{}}.scan_waveforms WHERE scan_id = ?"
+    row = conn.execute(query.format('main'), (scan_id,)).fetchone()
+    for month, path in reversed(archives):
+        if row is not None:
+            break
+        if not os.path.exists(path):
+            continue
+        conn.execute("ATTACH DATABASE ? AS waveform_archive", (path,))
+        try:
+            has_table = conn.execute("""
+                SELECT 1 FROM waveform_archive.sqlite_master WHERE type = 'table' AND name = 'scan_waveforms'
+            """).fetchone()
+            if has_table:
+                row = conn.execute(query.format('waveform_archive'), (scan_id,)).fetchone()
+        finally:
+            conn.execute("DETACH DATABASE waveform_archive")
+    return row
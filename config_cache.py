@@ -0,0 +1,60 @@
+import threading
+import time
+
+# How often a worker checks the version stamp for changes made by another process
+CHECK_INTERVAL = 1.0  # seconds
+
+
+class ConfigCache:
+    # Process-wide copy of the models and settings tables. Both change a few
+    # times a shift but are read on every scan. Writers in this process call
+    # invalidate(); triggers bump config_version.version on any change, which
+    # lets other worker processes notice within CHECK_INTERVAL.
+
+    def __init__(self, get_db, check_interval=CHECK_INTERVAL):
+        self.get_db = get_db
+        self.check_interval = check_interval
+        self._config = None   # (models, settings), replaced whole so readers never see a mix
+        self._version = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    def load(self):
+        conn = self.get_db()
+        with self._lock:
+            version = self._read_version(conn)
+            models = {}
+            for row in conn.execute("SELECT model_prefix, power_min, power_max, pf_min, rpm_min, rpm_max FROM models"):
+                models[row[0].casefold()] = tuple(row[1:])
+            settings = {row[0]: row[1] for row in conn.execute("SELECT key, value FROM settings")}
+            self._config, self._version = (models, settings), version
+            self._checked = time.monotonic()
+            return self._config
+
+    def invalidate(self):
+        self._config = None
+
+    def _read_version(self, conn):
+        row = conn.execute("SELECT version FROM config_version WHERE id = 1").fetchone()
+        return row[0] if row else 0
+
+    def _fresh(self):
+        # The current (models, settings); callers look up in what this
+        # returns, as invalidate() may drop self._config at any time
+        config = self._config
+        if config is None:
+            return self.load()
+        if time.monotonic() - self._checked >= self.check_interval:
+            self._checked = time.monotonic()
+            if self._read_version(self.get_db()) != self._version:
+                return self.load()
+        return config
+
+    def model(self, prefix):
+        # (power_min, power_max, pf_min, rpm_min, rpm_max) or None
+        models, _ = self._fresh()
+        return models.get(prefix.casefold())
+
+    def setting(self, key, default=None):
+        _, settings = self._fresh()
+        return settings.get(key, default)
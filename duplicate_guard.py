@@ -0,0 +1,64 @@
+import threading
+
+
+class DuplicateScanError(Exception):
+    # Raised when a QR code that already has an FP OK scan would get another one
+    pass
+
+
+class DuplicateGuard:
+    # In-memory set of QR codes that have an FP OK scan. A miss needs no
+    # database work: the unique partial index on scans still rejects a
+    # duplicate written by another process in the meantime. A hit is
+    # confirmed against the database, so an undo made elsewhere can't leave
+    # a stale entry blocking a unit. Serials whose FP OK scan was archived
+    # are kept in archived_fp_ok and count too.
+
+    def __init__(self, get_db):
+        self.get_db = get_db
+        self._codes = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        conn = self.get_db()
+        codes = {row[0] for row in conn.execute(
+            "SELECT qr_code FROM scans WHERE result = 'FP OK' UNION SELECT qr_code FROM archived_fp_ok")}
+        with self._lock:
+            self._codes = codes
+
+    def invalidate(self):
+        with self._lock:
+            self._codes = None
+
+    def _in_db(self, qr_code):
+        row = self.get_db().execute(
+            "SELECT 1 FROM scans WHERE qr_code = ? AND result = 'FP OK' "
+            "UNION ALL SELECT 1 FROM archived_fp_ok WHERE qr_code = ? LIMIT 1", (qr_code, qr_code)).fetchone()
+        return row is not None
+
+    def is_duplicate(self, qr_code):
+        if self._codes is None:
+            self.load()
+        if qr_code not in self._codes:
+            return False
+        if self._in_db(qr_code):
+            return True
+        self._codes.discard(qr_code)
+        return False
+
+    def add(self, qr_code):
+        if self._codes is not None:
+            self._codes.add(qr_code)
+
+    def result_changed(self, qr_code, old_result, new_result):
+        # Call after the change is written, with new_result None for a delete
+        if self._codes is None or old_result == new_result:
+            return
+        if new_result == 'FP OK':
+            self._codes.add(qr_code)
+        elif old_result == 'FP OK' and not self._in_db(qr_code):
+            self._codes.discard(qr_code)
+
+    def clear(self):
+        with self._lock:
+            self._codes = set()
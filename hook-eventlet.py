@@ -3,6 +3,7 @@ hiddenimports = [
     'eventlet.hubs.kqueue',
     'eventlet.hubs.poll',
     'eventlet.hubs.selects',
+    'eventlet.tpool',
     'dns.asyncquery',
     'dns.asyncbackend',
     'dns.asyncresolver',
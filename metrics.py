@@ -0,0 +1,254 @@
+import atexit
+import bisect
+import logging
+import queue
+import re
+import sqlite3
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+# In-process counters and fixed-bucket histograms, served by /metrics in the
+# Prometheus text format. Recording is a dict lookup and a few additions
+# under a lock, cheap enough for every Modbus transaction and SQL statement.
+#
+#   qa_modbus_request_seconds{slave}          round trip of a good reply
+#   qa_modbus_errors_total{slave, error}      crc, length, timeout, exception, mismatch
+#   qa_db_statement_seconds{statement}        'SELECT scans', 'INSERT daily_stats', ...
+#   qa_socketio_emit_seconds                  one emit of a broadcaster batch
+#   qa_socketio_events_total{event}           events sent to clients
+#   qa_http_request_seconds{endpoint, method}
+#   qa_http_requests_total{endpoint, status}
+#
+# Logging goes through a queue as well (setup_logging), so a log call from a
+# request or the bus never waits on the console.
+
+# Seconds; covers a cached SQLite read up to a Modbus timeout
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs += [f'{name}="{value}"' for name, value in extra]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            items = sorted(self._values.items())
+        lines += [f'{self.name}{_labels(self.labels, key)} {_number(value)}' for key, value in items]
+        return lines
+
+
+class Histogram:
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._series = {}   # labels -> [count per bucket (+Inf last), sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def count(self, *labels):
+        series = self._series.get(labels)
+        return series[2] if series else 0
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            items = sorted((key, ([*counts], total, n)) for key, (counts, total, n) in self._series.items())
+        for key, (counts, total, n) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{_labels(self.labels, key, [("le", _number(bound))])} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.labels, key)} {_number(total)}')
+            lines.append(f'{self.name}_count{_labels(self.labels, key)} {n}')
+        return lines
+
+
+class Gauge:
+    # Read when /metrics is scraped, from a function returning the value
+
+    def __init__(self, name, help, read):
+        self.name = name
+        self.help = help
+        self.read = read
+
+    def render(self):
+        try:
+            value = self.read()
+        except Exception:
+            return []
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} gauge', f'{self.name} {_number(value)}']
+
+
+_metrics = {}
+
+def _register(metric):
+    # Re-registering a name (a module reloaded by a test) keeps the first one
+    return _metrics.setdefault(metric.name, metric)
+
+def counter(name, help, labels=()):
+    return _register(Counter(name, help, labels))
+
+def histogram(name, help, labels=(), buckets=DEFAULT_BUCKETS):
+    return _register(Histogram(name, help, labels, buckets))
+
+def gauge(name, help, read):
+    # Unlike counters, a gauge is replaced, so it reads the current object
+    _metrics[name] = Gauge(name, help, read)
+    return _metrics[name]
+
+def render():
+    lines = []
+    for name in sorted(_metrics):
+        lines += _metrics[name].render()
+    return '\n'.join(lines) + '\n'
+
+
+MODBUS_SECONDS = histogram('qa_modbus_request_seconds', 'Modbus request to validated reply, per slave', ('slave',))
+MODBUS_ERRORS = counter('qa_modbus_errors_total', 'Modbus replies that failed validation or never came',
+                        ('slave', 'error'))
+DB_STATEMENT_SECONDS = histogram('qa_db_statement_seconds', 'SQLite statement execution time', ('statement',))
+SOCKETIO_EMIT_SECONDS = histogram('qa_socketio_emit_seconds', 'Time to emit one broadcaster batch')
+SOCKETIO_EVENTS = counter('qa_socketio_events_total', 'Events sent to Socket.IO clients, after coalescing', ('event',))
+HTTP_SECONDS = histogram('qa_http_request_seconds', 'HTTP request handling time', ('endpoint', 'method'))
+HTTP_REQUESTS = counter('qa_http_requests_total', 'HTTP requests by response status', ('endpoint', 'status'))
+
+
+def modbus_error_kind(error, response):
+    # The check_response() message as a label value
+    if not response:
+        return 'timeout'
+    if error.startswith('Exception code'):
+        return 'exception'
+    if error == 'CRC check failed':
+        return 'crc'
+    if error == 'Response length error':
+        return 'length'
+    return 'mismatch'
+
+
+_VERB = re.compile(r'\s*(\w+)')
+_TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE|TABLE)\s+(?:IF\s+(?:NOT\s+)?EXISTS\s+)?([\w.]+)', re.IGNORECASE)
+_statement_labels = {}
+STATEMENT_LABELS_MAX = 1024
+
+def statement_label(sql):
+    # 'SELECT scans' for any SELECT ... FROM scans ...; statements are
+    # mostly constant strings, so the label is worked out once per string
+    label = _statement_labels.get(sql)
+    if label is None:
+        verb = _VERB.match(sql)
+        label = verb.group(1).upper() if verb else 'OTHER'
+        table = _TABLE.search(sql)
+        if table:
+            label += ' ' + table.group(1)
+        if len(_statement_labels) < STATEMENT_LABELS_MAX:
+            _statement_labels[sql] = label
+    return label
+
+
+class TimedCursor(sqlite3.Cursor):
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            DB_STATEMENT_SECONDS.observe(time.perf_counter() - started, statement_label(sql))
+
+    def executemany(self, sql, parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, parameters)
+        finally:
+            DB_STATEMENT_SECONDS.observe(time.perf_counter() - started, statement_label(sql))
+
+
+class TimedConnection(sqlite3.Connection):
+    # Times every statement run through execute/executemany, on the
+    # connection or on its cursors. Only the execute step is measured: rows
+    # a SELECT returns later are stepped through while they are fetched.
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            DB_STATEMENT_SECONDS.observe(time.perf_counter() - started, statement_label(sql))
+
+    def executemany(self, sql, parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, parameters)
+        finally:
+            DB_STATEMENT_SECONDS.observe(time.perf_counter() - started, statement_label(sql))
+
+
+_listener = None
+
+def setup_logging(level=logging.INFO, handler=None):
+    # Root logging through a queue: callers only enqueue the record and one
+    # listener thread formats and writes it
+    global _listener
+    stop_logging()
+    handler = handler or logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    records = queue.SimpleQueue()
+    root = logging.getLogger()
+    for existing in [h for h in root.handlers if isinstance(h, QueueHandler)]:
+        root.removeHandler(existing)
+    root.addHandler(QueueHandler(records))
+    root.setLevel(level)
+    _listener = QueueListener(records, handler, respect_handler_level=True)
+    _listener.start()
+    return _listener
+
+@atexit.register
+def stop_logging():
+    # Writes out what is still queued
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,145 @@
+import os
+import random
+import select
+import struct
+import threading
+import time
+
+from rs485_reader import ENERGY_METER_SLAVE_ID, MP5W_SLAVE_ID, calc_crc
+
+# Stand-in for the RS485 bus on a plain Linux box: a pty whose far end answers
+# Modbus RTU requests the way the energy meter and the MP5W do. Point
+# rs485_reader at `simulator.port` instead of COM3. Linux ptys reject parity
+# changes, so open the session with PARITY_NONE for both slaves.
+
+
+class VirtualSlave:
+
+    def __init__(self, slave_id, function_code):
+        self.slave_id = slave_id
+        self.function_code = function_code
+        self.registers = {}   # protocol address -> 16-bit word
+
+    def set_word(self, register, value):
+        # `register` uses the same 1-based numbering as rs485_reader
+        self.registers[register - 1] = value & 0xFFFF
+
+    def set_float(self, register, value):
+        raw = struct.pack('>f', value)
+        self.set_word(register, int.from_bytes(raw[:2], 'big'))
+        self.set_word(register + 1, int.from_bytes(raw[2:], 'big'))
+
+    def respond(self, address, count):
+        body = bytes([self.slave_id, self.function_code, 2 * count])
+        body += b''.join(self.registers.get(address + i, 0).to_bytes(2, 'big') for i in range(count))
+        return body
+
+
+def energy_meter(power=75.5, power_factor=0.98):
+    slave = VirtualSlave(ENERGY_METER_SLAVE_ID, 0x03)
+    slave.set_float(3051, power)
+    slave.set_float(3055, power_factor)
+    return slave
+
+def mp5w(rpm=320):
+    slave = VirtualSlave(MP5W_SLAVE_ID, 0x04)
+    slave.set_word(0x03E9 + 1, rpm)
+    return slave
+
+
+class ModbusSimulator:
+
+    def __init__(self, slaves=None, latency=0.005, jitter=0.0, crc_error_rate=0.0,
+                 exception_rate=0.0, exception_code=0x04, seed=None):
+        self.slaves = {s.slave_id: s for s in (slaves or [energy_meter(), mp5w()])}
+        self.latency = latency
+        self.jitter = jitter
+        self.crc_error_rate = crc_error_rate
+        self.exception_rate = exception_rate
+        self.exception_code = exception_code
+        self.requests = 0
+        self.port = None
+        self._random = random.Random(seed)
+        self._master = None
+        self._slave_fd = None
+        self._thread = None
+        self._running = False
+
+    def start(self):
+        import pty
+        import tty
+        self._master, self._slave_fd = pty.openpty()
+        tty.setraw(self._slave_fd)
+        self.port = os.ttyname(self._slave_fd)
+        self._running = True
+        self._thread = threading.Thread(target=self._serve, name='modbus-sim', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(1)
+        for fd in (self._master, self._slave_fd):
+            if fd is not None:
+                os.close(fd)
+        self._master = self._slave_fd = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _serve(self):
+        buf = b''
+        while self._running:
+            ready, _, _ = select.select([self._master], [], [], 0.05)
+            if not ready:
+                buf = b''  # line went quiet: drop any partial frame
+                continue
+            try:
+                buf += os.read(self._master, 256)
+            except OSError:
+                return
+            # Every request the readers send (0x03/0x04) is 8 bytes long
+            while len(buf) >= 8:
+                frame, buf = buf[:8], buf[8:]
+                reply = self.handle(frame)
+                if reply:
+                    delay = self.latency + self._random.uniform(0, self.jitter)
+                    if delay > 0:
+                        time.sleep(delay)
+                    os.write(self._master, reply)
+
+    def handle(self, frame):
+        self.requests += 1
+        if frame[-2:] != calc_crc(frame[:-2]):
+            return None  # real slaves stay silent on a corrupt request
+        slave = self.slaves.get(frame[0])
+        if slave is None:
+            return None
+        function_code = frame[1]
+        address = int.from_bytes(frame[2:4], 'big')
+        count = int.from_bytes(frame[4:6], 'big')
+
+        if function_code != slave.function_code or self._random.random() < self.exception_rate:
+            code = 0x01 if function_code != slave.function_code else self.exception_code
+            body = bytes([slave.slave_id, 0x80 | function_code, code])
+        else:
+            body = slave.respond(address, count)
+
+        crc = calc_crc(body)
+        if self._random.random() < self.crc_error_rate:
+            crc = bytes([crc[0] ^ 0xFF, crc[1]])
+        return body + crc
+
+
+if __name__ == "__main__":
+    with ModbusSimulator() as sim:
+        print(f"Simulating energy meter (slave {ENERGY_METER_SLAVE_ID}) and MP5W (slave {MP5W_SLAVE_ID}) on {sim.port}")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,233 @@
+import math
+
+# Pre-aggregated scan counts and measurement sums per (grain, period,
+# model_prefix, station), kept current by triggers on scans like daily_stats.
+# Trend questions over a month or a year read a few hundred rollup rows
+# instead of every scan.
+#
+# power/pf/rpm keep count, sum and sum of squares (mean and standard
+# deviation follow from those) plus min and max. Deleting a scan subtracts it
+# from the counts and sums, but min/max can't be shrunk without rescanning, so
+# after an undo they are an envelope of what was measured; rebuild_rollups()
+# (flask --app app rebuild-rollups) makes them exact again.
+
+# grain -> length of the timestamp ('YYYY-MM-DD HH:MM:SS') prefix naming its period
+GRAINS = {
+    'hour': 13,    # '2024-05-01 10'
+    'day': 10,     # '2024-05-01'
+    'month': 7,    # '2024-05'
+}
+
+MEASURES = ('power', 'pf', 'rpm')
+MEASURE_COLUMNS = {'power': 'power', 'pf': 'power_factor', 'rpm': 'rpm'}
+
+COUNTERS = ('scan_count', 'pass_count', 'fail_count', 'fp_ok', 'sp_ok', 'rw')
+
+
+def model_prefix_sql(row):
+    # Same as qr_code.split('.')[0]
+    return (f"CASE WHEN instr({row}.qr_code, '.') > 0 "
+            f"THEN substr({row}.qr_code, 1, instr({row}.qr_code, '.') - 1) ELSE {row}.qr_code END")
+
+def _keys_sql(row, grain):
+    return (f"'{grain}', substr({row}.timestamp, 1, {GRAINS[grain]}), "
+            f"{model_prefix_sql(row)}, ifnull({row}.station, '')")
+
+def _counter_values(row):
+    return [
+        "1",
+        f"{row}.status IS 'PASS'",
+        f"{row}.status IS 'FAIL'",
+        f"{row}.result IS 'FP OK'",
+        f"{row}.result IS 'SP OK'",
+        f"{row}.result IS 'RW'",
+    ]
+
+def create_rollup_tables(c):
+    measure_columns = []
+    for m in MEASURES:
+        measure_columns += [f"{m}_min REAL", f"{m}_max REAL",
+                            f"{m}_sum REAL NOT NULL DEFAULT 0", f"{m}_sumsq REAL NOT NULL DEFAULT 0"]
+    c.execute(f"""
+        CREATE TABLE IF NOT EXISTS scan_rollups (
+            grain TEXT NOT NULL,
+            period TEXT NOT NULL,
+            model_prefix TEXT NOT NULL COLLATE NOCASE,
+            station TEXT NOT NULL,
+            {', '.join(f'{name} INTEGER NOT NULL DEFAULT 0' for name in COUNTERS)},
+            {', '.join(measure_columns)},
+            PRIMARY KEY (grain, period, model_prefix, station)
+        ) WITHOUT ROWID
+    """)
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS failure_rollups (
+            grain TEXT NOT NULL,
+            period TEXT NOT NULL,
+            model_prefix TEXT NOT NULL COLLATE NOCASE,
+            station TEXT NOT NULL,
+            failure_code TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (grain, period, model_prefix, station, failure_code)
+        ) WITHOUT ROWID
+    """)
+
+def _add_statements(row):
+    # Upserts adding one scan (NEW or OLD) to every grain
+    statements = []
+    insert_columns = ['grain', 'period', 'model_prefix', 'station', *COUNTERS]
+    updates = [f"{name} = {name} + excluded.{name}" for name in COUNTERS]
+    for m in MEASURES:
+        insert_columns += [f"{m}_min", f"{m}_max", f"{m}_sum", f"{m}_sumsq"]
+        updates += [f"{m}_min = min({m}_min, excluded.{m}_min)", f"{m}_max = max({m}_max, excluded.{m}_max)",
+                    f"{m}_sum = {m}_sum + excluded.{m}_sum", f"{m}_sumsq = {m}_sumsq + excluded.{m}_sumsq"]
+    for grain in GRAINS:
+        values = [_keys_sql(row, grain), *_counter_values(row)]
+        for m in MEASURES:
+            col = f"{row}.{MEASURE_COLUMNS[m]}"
+            values += [col, col, col, f"{col} * {col}"]
+        statements.append(f"""
+            INSERT INTO scan_rollups ({', '.join(insert_columns)})
+            VALUES ({', '.join(values)})
+            ON CONFLICT (grain, period, model_prefix, station) DO UPDATE SET {', '.join(updates)};
+        """)
+        statements.append(f"""
+            INSERT INTO failure_rollups (grain, period, model_prefix, station, failure_code, count)
+            SELECT {_keys_sql(row, grain)}, {row}.failure_code, 1
+            WHERE {row}.status IS 'FAIL' AND ifnull({row}.failure_code, '') != ''
+            ON CONFLICT (grain, period, model_prefix, station, failure_code) DO UPDATE SET count = count + 1;
+        """)
+    return statements
+
+def _remove_statements(row):
+    statements = []
+    sets = [f"{name} = {name} - ({value})" for name, value in zip(COUNTERS, _counter_values(row))]
+    for m in MEASURES:
+        col = f"{row}.{MEASURE_COLUMNS[m]}"
+        sets += [f"{m}_sum = {m}_sum - {col}", f"{m}_sumsq = {m}_sumsq - {col} * {col}"]
+    for grain in GRAINS:
+        where = (f"grain = '{grain}' AND period = substr({row}.timestamp, 1, {GRAINS[grain]}) "
+                 f"AND model_prefix = {model_prefix_sql(row)} AND station = ifnull({row}.station, '')")
+        statements.append(f"UPDATE scan_rollups SET {', '.join(sets)} WHERE {where};")
+        statements.append(f"""
+            UPDATE failure_rollups SET count = count - 1
+            WHERE {where} AND failure_code = {row}.failure_code AND {row}.status IS 'FAIL';
+        """)
+    return statements
+
+def create_rollup_triggers(c):
+    body = '\n'.join(_add_statements('NEW'))
+    c.execute(f"CREATE TRIGGER IF NOT EXISTS scan_rollups_insert AFTER INSERT ON scans BEGIN {body} END")
+    body = '\n'.join(_remove_statements('OLD'))
+    c.execute(f"CREATE TRIGGER IF NOT EXISTS scan_rollups_delete AFTER DELETE ON scans BEGIN {body} END")
+    body = '\n'.join(_remove_statements('OLD') + _add_statements('NEW'))
+    c.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS scan_rollups_update
+        AFTER UPDATE OF qr_code, station, timestamp, status, result, failure_code, power, power_factor, rpm
+        ON scans
+        BEGIN {body} END
+    """)
+
+def rebuild_rollups(c, keep_months=()):
+    # Backfill: recompute both tables from the scans history. Months in
+    # keep_months ('YYYY-MM', the archived ones, whose scans are no longer
+    # in the table) keep the rows they have.
+    params = list(keep_months)
+    not_kept = f"NOT IN ({', '.join('?' * len(params))})"
+    period_keep = f" WHERE substr(period, 1, 7) {not_kept}" if params else ""
+    scan_keep = f" AND substr(timestamp, 1, 7) {not_kept}" if params else ""
+    c.execute("DELETE FROM scan_rollups" + period_keep, params)
+    c.execute("DELETE FROM failure_rollups" + period_keep, params)
+    prefix = model_prefix_sql('scans')
+    aggregates = [
+        "COUNT(*)", "SUM(status IS 'PASS')", "SUM(status IS 'FAIL')",
+        "SUM(result IS 'FP OK')", "SUM(result IS 'SP OK')", "SUM(result IS 'RW')",
+    ]
+    columns = list(COUNTERS)
+    for m in MEASURES:
+        col = MEASURE_COLUMNS[m]
+        aggregates += [f"MIN({col})", f"MAX({col})", f"TOTAL({col})", f"TOTAL({col} * {col})"]
+        columns += [f"{m}_min", f"{m}_max", f"{m}_sum", f"{m}_sumsq"]
+    for grain, length in GRAINS.items():
+        c.execute(f"""
+            INSERT INTO scan_rollups (grain, period, model_prefix, station, {', '.join(columns)})
+            SELECT '{grain}', substr(timestamp, 1, {length}), ({prefix}) COLLATE NOCASE, ifnull(station, ''),
+                   {', '.join(aggregates)}
+            FROM scans
+            WHERE 1{scan_keep}
+            GROUP BY 2, 3, 4
+        """, params)
+        c.execute(f"""
+            INSERT INTO failure_rollups (grain, period, model_prefix, station, failure_code, count)
+            SELECT '{grain}', substr(timestamp, 1, {length}), ({prefix}) COLLATE NOCASE, ifnull(station, ''),
+                   failure_code, COUNT(*)
+            FROM scans
+            WHERE status = 'FAIL' AND ifnull(failure_code, '') != ''{scan_keep}
+            GROUP BY 2, 3, 4, 5
+        """, params)
+
+
+def _period_range(grain, start, end):
+    length = GRAINS[grain]
+    low = start[:length]
+    # '~' sorts after digits, so '2024-05-01~' covers every hour of that day
+    high = end[:length] if len(end) >= length else end + '~'
+    return low, high
+
+def _spread(n, total, total_sq):
+    if n < 2:
+        return None
+    variance = (total_sq - total * total / n) / (n - 1)
+    return math.sqrt(max(variance, 0.0))
+
+def query_trends(conn, grain, start, end, model=None, station=None, group_by=None):
+    # One point per period (per model or station with group_by), newest last
+    low, high = _period_range(grain, start, end)
+    where = ["grain = ?", "period BETWEEN ? AND ?"]
+    params = [grain, low, high]
+    if model:
+        where.append("model_prefix = ?")
+        params.append(model)
+    if station:
+        where.append("station = ?")
+        params.append(station)
+    keys = ['period'] + ([group_by] if group_by else [])
+
+    selects = [f"SUM({name}) AS {name}" for name in COUNTERS]
+    for m in MEASURES:
+        selects += [f"MIN({m}_min) AS {m}_min", f"MAX({m}_max) AS {m}_max",
+                    f"SUM({m}_sum) AS {m}_sum", f"SUM({m}_sumsq) AS {m}_sumsq"]
+    rows = conn.execute(f"""
+        SELECT {', '.join(keys)}, {', '.join(selects)}
+        FROM scan_rollups
+        WHERE {' AND '.join(where)}
+        GROUP BY {', '.join(keys)}
+        HAVING SUM(scan_count) > 0
+        ORDER BY {', '.join(keys)}
+    """, params).fetchall()
+
+    points = []
+    for row in rows:
+        row = dict(row)
+        n = row['scan_count']
+        point = {key: row[key] for key in keys}
+        point.update({name: row[name] for name in COUNTERS})
+        point['first_pass_yield'] = row['fp_ok'] / n
+        point['pass_rate'] = row['pass_count'] / n
+        for m in MEASURES:
+            point[m] = {
+                'min': row[f'{m}_min'],
+                'max': row[f'{m}_max'],
+                'mean': row[f'{m}_sum'] / n,
+                'std': _spread(n, row[f'{m}_sum'], row[f'{m}_sumsq']),
+            }
+        points.append(point)
+
+    failures = conn.execute(f"""
+        SELECT failure_code, SUM(count) AS count
+        FROM failure_rollups
+        WHERE {' AND '.join(where)}
+        GROUP BY failure_code
+        HAVING SUM(count) > 0
+        ORDER BY count DESC, failure_code
+    """, params).fetchall()
+    return points, [dict(row) for row in failures]
@@ -1,28 +1,58 @@
+import logging
 import serial
+import threading
 import time
 import struct
 
+from metrics import MODBUS_ERRORS, MODBUS_SECONDS, modbus_error_kind
+
+logger = logging.getLogger(__name__)
+
 # Configuration
 SERIAL_PORT = "COM3"
 BAUDRATE = 9600
 ENERGY_METER_SLAVE_ID = 1
 MP5W_SLAVE_ID = 3
+ENERGY_METER_PARITY = serial.PARITY_ODD
+MP5W_PARITY = serial.PARITY_NONE
 
-# Register addresses for energy meter
+# Register addresses for energy meter (32-bit floats, two registers each)
 ENERGY_PARAMETERS = [
     ("Active Power (W)", 3051),
     ("Power Factor", 3055),
 ]
 
-def calc_crc(data):
-    crc = 0xFFFF
-    for pos in data:
-        crc ^= pos
+# Block read planning: registers closer than MAX_REGISTER_GAP are fetched in
+# one request, as long as the block stays within MAX_BLOCK_REGISTERS.
+MAX_REGISTER_GAP = 8
+MAX_BLOCK_REGISTERS = 125  # Modbus limit for function 0x03
+
+# Modbus RTU framing
+MAX_RETRIES = 2               # extra attempts after a CRC or length error
+RESPONSE_TIMEOUT_MIN = 0.05   # seconds, lower bound for the adaptive timeout
+RESPONSE_TIMEOUT_MAX = 1.0    # seconds, also the timeout before any reply is seen
+FRAME_GAP_FLOOR = 0.02        # USB-RS485 adapters deliver bytes in bursts, never end a frame sooner
+
+
+def _make_crc_table():
+    table = []
+    for byte in range(256):
+        crc = byte
         for _ in range(8):
             if crc & 1:
                 crc = (crc >> 1) ^ 0xA001
             else:
                 crc >>= 1
+        table.append(crc)
+    return tuple(table)
+
+_CRC_TABLE = _make_crc_table()
+
+def calc_crc(data):
+    crc = 0xFFFF
+    table = _CRC_TABLE
+    for pos in data:
+        crc = (crc >> 8) ^ table[(crc ^ pos) & 0xFF]
     return crc.to_bytes(2, byteorder='little')
 
 def build_modbus_request(slave_id, function_code, register_address, register_count):
@@ -30,22 +60,101 @@ def build_modbus_request(slave_id, function_code, register_address, register_cou
     crc = calc_crc(msg)
     return msg + crc
 
-def read_float_register(ser, slave_id, register):
-    addr = register - 1
-    request = build_modbus_request(slave_id, 0x03, addr, 2)
+def frame_gap(baudrate):
+    # 3.5 character times (11 bits per character); the spec fixes it at
+    # 1.75 ms above 19200 baud.
+    if baudrate > 19200:
+        gap = 0.00175
+    else:
+        gap = 3.5 * 11.0 / baudrate
+    return max(gap, FRAME_GAP_FLOOR)
 
-    ser.reset_input_buffer()
-    ser.write(request)
-    time.sleep(0.2)
-    response = ser.read(9)
 
-    # Validate response
-    if len(response) != 9 or response[0] != slave_id or response[1] != 0x03:
-        return None
+class SlaveTiming:
+    # Response timeout for one slave, derived from the latencies it has
+    # actually shown: smoothed mean plus four mean deviations.
+
+    def __init__(self, timeout=RESPONSE_TIMEOUT_MAX):
+        self.timeout = timeout
+        self.srtt = None
+        self.rttvar = 0.0
+
+    def observe(self, latency):
+        if self.srtt is None:
+            self.srtt = latency
+            self.rttvar = latency / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - latency)
+            self.srtt = 0.875 * self.srtt + 0.125 * latency
+        self.timeout = min(max(self.srtt + 4 * self.rttvar, RESPONSE_TIMEOUT_MIN), RESPONSE_TIMEOUT_MAX)
+
+    def backoff(self):
+        self.timeout = min(self.timeout * 2, RESPONSE_TIMEOUT_MAX)
+
+
+def _set_timeouts(ser, timeout, inter_byte_timeout):
+    # Changing a timeout reconfigures the port, so only touch it on change
+    if ser.timeout != timeout:
+        ser.timeout = timeout
+    if getattr(ser, 'inter_byte_timeout', None) != inter_byte_timeout:
+        ser.inter_byte_timeout = inter_byte_timeout
+
+def read_frame(ser, expected_len, timeout, gap):
+    # Wait up to `timeout` for the reply to start, then read until the
+    # expected length is reached or the line goes quiet for `gap`.
+    _set_timeouts(ser, timeout, gap)
+    response = ser.read(2)
+    if len(response) < 2:
+        return response
+    if response[1] & 0x80:
+        expected_len = 5  # exception reply: slave, function|0x80, code, CRC
+    return response + ser.read(expected_len - 2)
+
+def check_response(response, slave_id, function_code, expected_len):
+    if len(response) >= 5 and response[1] == (0x80 | function_code):
+        if response[-2:] == calc_crc(response[:-2]):
+            return f"Exception code: {response[2]:02X}"
+    if len(response) != expected_len:
+        return "Response length error"
+    if response[0] != slave_id:
+        return "Slave ID mismatch"
+    if response[1] != function_code:
+        return f"Unexpected function code: {response[1]:02X}"
+    if response[-2:] != calc_crc(response[:-2]):
+        return "CRC check failed"
+    return None
+
+def modbus_transaction(ser, slave_id, function_code, register_address, register_count, timing=None, retries=MAX_RETRIES):
+    # Returns the validated response frame, or None. CRC and length errors
+    # are retried; exception replies are a real answer and are not.
+    request = build_modbus_request(slave_id, function_code, register_address, register_count)
+    expected_len = 5 + 2 * register_count
+    timing = timing or SlaveTiming()
+    gap = frame_gap(getattr(ser, 'baudrate', BAUDRATE))
+
+    for attempt in range(retries + 1):
+        ser.reset_input_buffer()
+        started = time.monotonic()
+        ser.write(request)
+        response = read_frame(ser, expected_len, timing.timeout, gap)
+        elapsed = time.monotonic() - started
 
-    data_no_crc = response[:-2]
-    crc_calc = calc_crc(data_no_crc)
-    if response[-2:] != crc_calc:
+        error = check_response(response, slave_id, function_code, expected_len)
+        if error is None:
+            timing.observe(elapsed)
+            MODBUS_SECONDS.observe(elapsed, str(slave_id))
+            return response
+        MODBUS_ERRORS.inc(str(slave_id), modbus_error_kind(error, response))
+        logger.warning("Slave %s: %s", slave_id, error)
+        if error.startswith("Exception code"):
+            return None
+        if not response:
+            timing.backoff()
+    return None
+
+def read_float_register(ser, slave_id, register, timing=None):
+    response = modbus_transaction(ser, slave_id, 0x03, register - 1, 2, timing)
+    if response is None:
         return None
 
     data = response[3:7]
@@ -57,82 +166,159 @@ def read_float_register(ser, slave_id, register):
         return None
     return None
 
-def read_mp5w_rpm(ser, slave_id):
-    start_addr = 0x03E9
-    request = build_modbus_request(slave_id, 0x04, start_addr, 1)
-
-    ser.reset_input_buffer()
-    ser.write(request)
-    time.sleep(0.5)
-    response = ser.read(7)
+def plan_register_blocks(parameters, max_gap=MAX_REGISTER_GAP, max_block=MAX_BLOCK_REGISTERS):
+    # Returns [(start_register, register_count, [(name, offset), ...]), ...]
+    # where offset is the float's register index inside the block.
+    blocks = []
+    for name, reg in sorted(parameters, key=lambda p: p[1]):
+        if blocks:
+            start, count, fields = blocks[-1]
+            end = start + count
+            if reg - end <= max_gap and reg + 2 - start <= max_block:
+                blocks[-1] = (start, max(count, reg + 2 - start), fields + [(name, reg - start)])
+                continue
+        blocks.append((reg, 2, [(name, 0)]))
+    return blocks
 
+def read_float_block(ser, slave_id, block, timing=None):
+    start, count, fields = block
+    values = dict.fromkeys((name for name, _ in fields))
+    response = modbus_transaction(ser, slave_id, 0x03, start - 1, count, timing)
+    if response is None:
+        return values
 
-    if len(response) != 7:
-        print("Response length error")
-        return None
-    if response[0] != slave_id:
-        print("Slave ID mismatch")
-        return None
-    if response[1] == (0x80 + 0x04):
-        print(f"Exception code: {response[2]:02X}")
-        return None
-    if response[1] != 0x04:
-        print(f"Unexpected function code: {response[1]:02X}")
-        return None
+    view = memoryview(response)
+    for name, offset in fields:
+        value = struct.unpack_from('>f', view, 3 + 2 * offset)[0]
+        if 0 <= value < 1e6:
+            values[name] = value
+    return values
 
-    data_no_crc = response[:-2]
-    crc_calc = calc_crc(data_no_crc)
-    if response[-2:] != crc_calc:
-        print("CRC check failed")
+def read_mp5w_rpm(ser, slave_id, timing=None):
+    start_addr = 0x03E9
+    response = modbus_transaction(ser, slave_id, 0x04, start_addr, 1, timing)
+    if response is None:
         return None
 
     rpm = (response[3] << 8) + response[4]
     return rpm
 
-def open_serial(parity):
-    return serial.Serial(
-        port=SERIAL_PORT,
-        baudrate=BAUDRATE,
-        bytesize=8,
-        parity=parity,
-        stopbits=1,
-        timeout=1
-    )
+class RS485Session:
+    # Keeps one serial port open for the life of the process. The energy meter
+    # talks odd parity and the MP5W no parity, so line settings are switched in
+    # place instead of closing and reopening the port between slaves.
 
-def get_live_power_and_factor_and_rpm():
-    try:
-        # Read power and power factor from energy meter
-        ser = open_serial(serial.PARITY_ODD)
-        power = None
-        power_factor = None
-
-        for name, reg in ENERGY_PARAMETERS:
-            val = read_float_register(ser, ENERGY_METER_SLAVE_ID, reg)
-            if val is not None:
-                if name == "Active Power (W)":
-                    power = val
-                elif name == "Power Factor":
-                    power_factor = val
-        ser.close()
-
-        # Read RPM from MP5W
-        time.sleep(0.1)
-        ser = open_serial(serial.PARITY_NONE)
-        rpm = read_mp5w_rpm(ser, MP5W_SLAVE_ID)
-        ser.close()
+    def __init__(self, port=None, baudrate=None, meter_parity=ENERGY_METER_PARITY, rpm_parity=MP5W_PARITY,
+                 meter_slave_id=ENERGY_METER_SLAVE_ID, rpm_slave_id=MP5W_SLAVE_ID):
+        self.port = port or SERIAL_PORT
+        self.baudrate = baudrate or BAUDRATE
+        self.meter_parity = meter_parity
+        self.rpm_parity = rpm_parity
+        self.meter_slave_id = meter_slave_id
+        self.rpm_slave_id = rpm_slave_id
+        self._ser = None
+        self._lock = threading.RLock()
+        self._timings = {}
+        self.energy_plan = plan_register_blocks(ENERGY_PARAMETERS)
 
+    def timing(self, slave_id):
+        return self._timings.setdefault(slave_id, SlaveTiming())
+
+    def _open(self, parity):
+        return serial.Serial(
+            port=self.port,
+            baudrate=self.baudrate,
+            bytesize=8,
+            parity=parity,
+            stopbits=1,
+            timeout=1
+        )
+
+    def _acquire(self, parity):
+        if self._ser is None or not self._ser.is_open:
+            self._ser = self._open(parity)
+        elif self._ser.parity != parity:
+            # pyserial applies the new settings to the open handle
+            self._ser.parity = parity
+            self._ser.reset_input_buffer()
+        return self._ser
+
+    def _drop(self):
+        if self._ser is not None:
+            try:
+                self._ser.close()
+            except Exception:
+                pass
+        self._ser = None
+
+    def close(self):
+        with self._lock:
+            self._drop()
+
+    def _run(self, parity, fn):
+        # One reconnect attempt: a USB adapter that was unplugged or a port
+        # left in a bad state gets reopened on the next call.
+        with self._lock:
+            for attempt in range(2):
+                try:
+                    return fn(self._acquire(parity))
+                except (serial.SerialException, OSError) as e:
+                    logger.error("RS485 error on %s: %s", self.port, e)
+                    self._drop()
+                    if attempt:
+                        raise
+
+    def read_energy_meter(self):
+        def read(ser):
+            values = {}
+            for block in self.energy_plan:
+                values.update(read_float_block(ser, self.meter_slave_id, block,
+                                               self.timing(self.meter_slave_id)))
+            return values
+        values = self._run(self.meter_parity, read)
+        power = values.get("Active Power (W)")
+        power_factor = values.get("Power Factor")
         return round(power, 1) if power is not None else None, \
-            round(power_factor, 2) if power_factor is not None else None, \
-            rpm
+            round(power_factor, 2) if power_factor is not None else None
 
+    def read_rpm(self):
+        return self._run(self.rpm_parity, lambda ser: read_mp5w_rpm(ser, self.rpm_slave_id, self.timing(self.rpm_slave_id)))
 
+    def read_all(self):
+        with self._lock:
+            power, power_factor = self.read_energy_meter()
+            rpm = self.read_rpm()
+        return power, power_factor, rpm
+
+
+_session = None
+_session_lock = threading.Lock()
+
+def get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = RS485Session()
+        return _session
+
+def get_live_power_and_factor_and_rpm():
+    try:
+        return get_session().read_all()
     except Exception as e:
-        print(f"Error reading RS485 data: {e}")
+        logger.error("Error reading RS485 data: %s", e)
         return None, None, None
 
 # For testing
 if __name__ == "__main__":
-    power, pf, rpm = get_live_power_and_factor_and_rpm()
+    import os
+    if os.environ.get('QA_BROKER_ADDRESS'):
+        # The app's broker owns the port; ask it instead of opening COM3
+        from acquisition_broker import BrokerClient
+        from stations import DEFAULT_STATION
+        station_id = os.environ.get('QA_STATION', DEFAULT_STATION)
+        power, pf, rpm = BrokerClient().read(station_id)
+    else:
+        power, pf, rpm = get_live_power_and_factor_and_rpm()
     print(f"\nActive Power: {power}")
     print(f"Power Factor: {pf}")
     print(f"RPM: {rpm}")
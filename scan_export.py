@@ -0,0 +1,131 @@
+import csv
+import io
+
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Alignment, Font
+from openpyxl.utils import get_column_letter
+
+from archive import iter_sources
+
+# Rows fetched from SQLite per round; the export never holds more than this in memory
+EXPORT_CHUNK_SIZE = 500
+
+EXPORT_HEADERS = [
+    'SL.NO', 'QR Code', 'Power', 'RPM', 'Power Factor', 'Failure Code',
+    'IS 302-1 A-3 Functional test',
+    'IS 374  18.4 d Simple running  test',
+    'IS 374 4.6 Enclosure',
+    'IS 374 Cl. 4.3 Blades and Motor',
+    'Result',
+    'Voice Recognition'
+]
+
+EXPORT_COLUMNS = ('daily_number', 'qr_code', 'power', 'rpm', 'power_factor', 'failure_code', 'result',
+                  'voice_recognition', 'timestamp')
+
+# {source} is the hot scans table, or it together with archived months (see archive.py)
+EXPORT_QUERY = """
+    SELECT daily_number, qr_code, power, rpm, power_factor, failure_code, result, voice_recognition
+    FROM {source}
+    ORDER BY timestamp ASC
+"""
+
+# Longest text per database column over the range, in EXPORT_HEADERS order
+WIDTH_QUERY = """
+    SELECT MAX(LENGTH(daily_number)), MAX(LENGTH(qr_code)), MAX(LENGTH(power)), MAX(LENGTH(rpm)),
+           MAX(LENGTH(power_factor)), MAX(LENGTH(failure_code)), MAX(LENGTH(result)),
+           MAX(LENGTH(voice_recognition))
+    FROM {source}
+"""
+
+
+def has_rows(conn, start_date, end_date):
+    sources = iter_sources(conn, EXPORT_COLUMNS, start_date, end_date)
+    try:
+        for source, params, _, _ in sources:
+            if conn.execute(f"SELECT 1 FROM {source} LIMIT 1", params).fetchone() is not None:
+                return True
+        return False
+    finally:
+        sources.close()
+
+def iter_export_rows(conn, start_date, end_date, chunk_size=EXPORT_CHUNK_SIZE):
+    # Stretches come oldest first and each is sorted, so rows come out in timestamp order
+    for source, params, _, _ in iter_sources(conn, EXPORT_COLUMNS, start_date, end_date):
+        cur = conn.cursor()
+        cur.execute(EXPORT_QUERY.format(source=source), params)
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if not rows:
+                break
+            for scan in rows:
+                yield [
+                    scan['daily_number'],
+                    scan['qr_code'],
+                    scan['power'],
+                    scan['rpm'],
+                    scan['power_factor'],
+                    scan['failure_code'],
+                    'OK',
+                    'OK',
+                    'OK',
+                    'OK',
+                    scan['result'],
+                    scan['voice_recognition']
+                ]
+
+def column_widths(conn, start_date, end_date):
+    # A write-only sheet emits its column widths before the first row, so
+    # they are measured up front with one aggregate query instead of by
+    # walking the finished sheet.
+    lengths = [0] * 8
+    for source, params, _, _ in iter_sources(conn, EXPORT_COLUMNS, start_date, end_date):
+        row = conn.execute(WIDTH_QUERY.format(source=source), params).fetchone()
+        lengths = [max(a, b or 0) for a, b in zip(lengths, row)]
+    data = lengths[:6] + [2, 2, 2, 2] + lengths[6:]
+    return [max(len(header), length) + 2 for header, length in zip(EXPORT_HEADERS, data)]
+
+def write_xlsx(conn, start_date, end_date, path):
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+
+    for col_num, width in enumerate(column_widths(conn, start_date, end_date), 1):
+        ws.column_dimensions[get_column_letter(col_num)].width = width
+
+    center = Alignment(horizontal='center', vertical='center')
+    bold = Font(bold=True)
+
+    header_row = []
+    for header in EXPORT_HEADERS:
+        cell = WriteOnlyCell(ws, value=header)
+        cell.alignment = center
+        cell.font = bold
+        header_row.append(cell)
+    ws.append(header_row)
+
+    for row in iter_export_rows(conn, start_date, end_date):
+        cells = []
+        for value in row:
+            cell = WriteOnlyCell(ws, value=value)
+            cell.alignment = center
+            cells.append(cell)
+        ws.append(cells)
+
+    wb.save(path)
+
+def iter_delimited(conn, start_date, end_date, delimiter=','):
+    # Yields the export as CSV/TSV text, one chunk of rows at a time
+    buf = io.StringIO()
+    writer = csv.writer(buf, delimiter=delimiter)
+    writer.writerow(EXPORT_HEADERS)
+    pending = 0
+    for row in iter_export_rows(conn, start_date, end_date):
+        writer.writerow(row)
+        pending += 1
+        if pending >= EXPORT_CHUNK_SIZE:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+            pending = 0
+    yield buf.getvalue()
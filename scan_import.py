@@ -0,0 +1,127 @@
+import csv
+import io
+import json
+import math
+import sqlite3
+from datetime import datetime
+
+# Bulk loading of scans measured elsewhere: a bench that lost its link to the
+# server and buffered its readings, or a standalone tester being backfilled.
+#
+# Each record is a JSON object per line, or a CSV row with a header:
+#   qr_code, power, rpm, power_factor     required
+#   timestamp                             "YYYY-MM-DD HH:MM:SS" (or ISO 8601), default now
+#   failure_code, result, station, voice_recognition   optional
+
+IMPORT_CHUNK_SIZE = 500      # rows per transaction
+IMPORT_MAX_ROWS = 50000      # per request
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+IMPORT_COLUMNS = ('daily_number', 'qr_code', 'power', 'rpm', 'power_factor', 'failure_code',
+                  'status', 'timestamp', 'result', 'voice_recognition', 'station', 'scan_date')
+
+IMPORT_SQL = (f"INSERT INTO scans ({', '.join(IMPORT_COLUMNS)}) "
+              f"VALUES ({', '.join(':' + c for c in IMPORT_COLUMNS)})")
+
+
+def parse_jsonl(text):
+    for line_no, line in enumerate(text.splitlines(), 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            yield line_no, None, f'Invalid JSON: {e}'
+            continue
+        if not isinstance(record, dict):
+            yield line_no, None, 'Expected a JSON object'
+            continue
+        yield line_no, record, None
+
+def parse_csv(text):
+    reader = csv.DictReader(io.StringIO(text))
+    for record in reader:
+        # line_num counts physical lines, so the header is line 1
+        yield reader.line_num, {k.strip(): v for k, v in record.items() if k}, None
+
+def _text(record, key, default=None):
+    value = record.get(key)
+    if value is None or (isinstance(value, str) and not value.strip()):
+        return default
+    return str(value).strip()
+
+def _number(record, key, kind):
+    value = record.get(key)
+    if value is None or value == '':
+        raise ValueError(f'{key} is required')
+    if isinstance(value, bool):  # JSON true/false would pass as 1/0
+        raise ValueError(f'{key} must be a number')
+    try:
+        number = kind(value)
+    except (TypeError, ValueError):
+        raise ValueError(f'{key} must be a number')
+    if not math.isfinite(number):
+        raise ValueError(f'{key} must be a finite number')
+    return number
+
+def _timestamp(value, now):
+    if value is None:
+        return now
+    try:
+        return datetime.fromisoformat(value).strftime(TIMESTAMP_FORMAT)
+    except ValueError:
+        raise ValueError(f'timestamp {value!r} is not YYYY-MM-DD HH:MM:SS')
+
+def normalize_record(record, now):
+    # Checks one record and returns it with the columns /scan would fill in
+    qr_code = _text(record, 'qr_code')
+    if not qr_code:
+        raise ValueError('qr_code is required')
+    rpm = _number(record, 'rpm', float)
+    return {
+        'qr_code': qr_code,
+        'power': _number(record, 'power', float),
+        'rpm': int(rpm) if rpm.is_integer() else rpm,
+        'power_factor': _number(record, 'power_factor', float),
+        'timestamp': _timestamp(_text(record, 'timestamp'), now),
+        'failure_code': _text(record, 'failure_code', 'NA'),
+        'result': _text(record, 'result'),
+        'station': _text(record, 'station'),
+        'voice_recognition': _text(record, 'voice_recognition'),
+    }
+
+def check_result(requested, status):
+    # A client-supplied result must agree with the grade: a passing reading
+    # is always FP OK (grade_scan sets it), and FP OK on a failing one would
+    # count a failed unit as a first pass
+    if requested == 'FP OK' and status != 'PASS':
+        raise ValueError(f'result FP OK conflicts with status {status}')
+
+def next_daily_numbers(conn, dates):
+    # The number the next scan of each date gets, from the daily_stats rollup
+    numbers = {}
+    for date in dates:
+        row = conn.execute("SELECT scan_count FROM daily_stats WHERE scan_date = ?", (date,)).fetchone()
+        numbers[date] = (row[0] if row else 0) + 1
+    return numbers
+
+def insert_chunks(conn, scans, chunk_size=IMPORT_CHUNK_SIZE):
+    # Inserts in one transaction per chunk and sets each scan's 'id'. A chunk
+    # that hits a constraint (an FP OK written meanwhile by /scan) is redone
+    # row by row; the rows that still fail get 'error' set instead.
+    for start in range(0, len(scans), chunk_size):
+        chunk = scans[start:start + chunk_size]
+        try:
+            for scan in chunk:
+                scan['id'] = conn.execute(IMPORT_SQL, scan).lastrowid
+            conn.commit()
+        except sqlite3.IntegrityError:
+            conn.rollback()
+            for scan in chunk:
+                try:
+                    scan['id'] = conn.execute(IMPORT_SQL, scan).lastrowid
+                except sqlite3.IntegrityError:
+                    scan['id'] = None
+                    scan['error'] = 'Duplicate FP OK'
+            conn.commit()
@@ -0,0 +1,282 @@
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from duplicate_guard import DuplicateScanError
+
+logger = logging.getLogger(__name__)
+
+# Write-behind persistence for /scan. The request grades the scan, gets its
+# id and daily number from in-memory counters, appends it to a local journal
+# and returns; one writer thread inserts queued scans in a single
+# transaction per batch. On start, scans left in the journal by a crash are
+# written before anything else.
+#
+# The counters assume this process is the only one inserting scans, which
+# is how the app runs (one process owning the stations). For the same
+# reason the FP OK duplicate check happens in submit(), under the lock that
+# queues the scan, so two requests for one serial can't both get in.
+
+BATCH_SIZE = 200       # scans per transaction at most
+BATCH_DELAY = 0.02     # seconds to wait for more scans before committing
+RETRY_DELAY = 1.0      # seconds before retrying a batch that failed to commit
+FLUSH_POLL = 0.005     # seconds between checks while flush() waits
+FLUSH_TIMEOUT = 5.0    # seconds flush() waits before giving up on a writer that can't commit
+
+COLUMNS = ('id', 'daily_number', 'qr_code', 'power', 'rpm', 'power_factor', 'failure_code',
+           'status', 'timestamp', 'result', 'voice_recognition', 'station', 'scan_date')
+
+INSERT_SQL = f"INSERT INTO scans ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})"
+# Same row, flagged so the unique FP OK index lets it in (see _migration_unique_fp_ok)
+INSERT_DUPLICATE_SQL = (f"INSERT INTO scans ({', '.join(COLUMNS)}, fp_ok_duplicate) "
+                        f"VALUES ({', '.join('?' * len(COLUMNS))}, 1)")
+
+# Results tallied by the daily_stats triggers
+STAT_RESULTS = ('FP OK', 'SP OK', 'RW')
+
+
+class WriterStalledError(Exception):
+    # flush() timed out: the writer keeps retrying, the scans are safe in the journal
+    pass
+
+
+class ScanWriter:
+
+    def __init__(self, connect, journal_path, batch_size=BATCH_SIZE, batch_delay=BATCH_DELAY,
+                 sleep=time.sleep, fsync=True, guard=None):
+        self.connect = connect
+        self.guard = guard                   # DuplicateGuard for the committed FP OK scans
+        self.journal_path = journal_path
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.sleep = sleep
+        self.fsync = fsync
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()        # numbering, journal, enqueue order
+        self._state_lock = threading.Lock()  # pending tallies vs. what is committed
+        self._journal = None
+        self._next_id = None
+        self._next_number = {}
+        self._pending = {}                   # scan_date -> Counter of results
+        self._pending_fp_ok = Counter()      # qr_code -> queued FP OK scans
+        self._submitted = 0
+        self._committed = 0
+        self._running = False
+        self.batches = 0
+        self.flagged = 0                     # FP OK duplicates that reached the writer anyway
+
+    def start(self):
+        self.replay()
+        self._journal = open(self.journal_path, 'a', encoding='utf-8')
+        self._running = True
+        threading.Thread(target=self._run, name='scan-writer', daemon=True).start()
+        return self
+
+    def stop(self):
+        try:
+            self.flush()
+        except WriterStalledError as e:
+            logger.warning("Stopping with scans still queued, they stay in the journal: %s", e)
+        self._running = False
+        self._queue.put(None)
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    def replay(self):
+        # Insert journaled scans that never reached the database
+        if not os.path.exists(self.journal_path):
+            return 0
+        rows = []
+        with open(self.journal_path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    rows.append(json.loads(line))
+                except ValueError:
+                    break  # torn last line from the crash
+        conn = self.connect()
+        try:
+            written = 0
+            for row in rows:
+                if conn.execute("SELECT 1 FROM scans WHERE id = ?", (row['id'],)).fetchone():
+                    continue
+                self._insert_one(conn, row)
+                written += 1
+            conn.commit()
+        finally:
+            conn.close()
+        open(self.journal_path, 'w').close()
+        if written:
+            logger.info("Recovered %d scan(s) from %s", written, self.journal_path)
+        return written
+
+    def _seed(self, scan_date):
+        conn = self.connect()
+        try:
+            if self._next_id is None:
+                seq = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'scans'").fetchone()
+                top = conn.execute("SELECT MAX(id) FROM scans").fetchone()
+                self._next_id = max(seq[0] if seq else 0, top[0] or 0) + 1
+            if scan_date not in self._next_number:
+                row = conn.execute("SELECT scan_count FROM daily_stats WHERE scan_date = ?",
+                                   (scan_date,)).fetchone()
+                self._next_number[scan_date] = (row[0] if row else 0) + 1
+        finally:
+            conn.close()
+
+    def reset(self):
+        # Call after deleting scans: numbering is re-read from the database.
+        # Flushes under the lock, so no scan can be given an id in between
+        # that the re-read would hand out again.
+        with self.exclusive():
+            pass
+
+    @contextmanager
+    def exclusive(self):
+        # For inserting scans around the writer (bulk import): everything
+        # queued is committed first, submit() waits until the block is done,
+        # and numbering is re-read afterwards, so neither side can hand out
+        # an id or daily number the other one used
+        with self._lock:
+            self.flush()
+            try:
+                yield
+            finally:
+                self._next_id = None
+                self._next_number = {}
+
+    def submit(self, scan):
+        # scan holds every column but id and daily_number; both are filled in
+        # here and the completed scan is returned. It is durable once this
+        # returns. Raises DuplicateScanError for a second FP OK of a serial,
+        # queued or committed.
+        with self._lock:
+            if scan['result'] == 'FP OK':
+                qr_code = scan['qr_code']
+                if self.has_pending_fp_ok(qr_code) or (self.guard is not None and self.guard.is_duplicate(qr_code)):
+                    raise DuplicateScanError(qr_code)
+            scan_date = scan['scan_date']
+            if self._next_id is None or scan_date not in self._next_number:
+                self._seed(scan_date)
+            scan['id'] = self._next_id
+            scan['daily_number'] = self._next_number[scan_date]
+            self._journal.write(json.dumps(scan) + '\n')
+            self._journal.flush()
+            if self.fsync:
+                os.fsync(self._journal.fileno())
+            self._next_id += 1
+            self._next_number[scan_date] += 1
+            with self._state_lock:
+                self._pending.setdefault(scan_date, Counter())[scan['result']] += 1
+                if scan['result'] == 'FP OK':
+                    self._pending_fp_ok[scan['qr_code']] += 1
+            if scan['result'] == 'FP OK' and self.guard is not None:
+                self.guard.add(scan['qr_code'])
+            self._submitted += 1
+            self._queue.put(scan)
+        return scan
+
+    def flush(self, timeout=FLUSH_TIMEOUT):
+        # Wait until every scan submitted before this call is committed;
+        # raises WriterStalledError after `timeout` seconds
+        target = self._submitted
+        deadline = time.monotonic() + timeout
+        while self._committed < target:
+            if time.monotonic() >= deadline:
+                raise WriterStalledError(f"{target - self._committed} scan(s) not committed after {timeout:g}s")
+            self.sleep(FLUSH_POLL)
+
+    def has_pending_fp_ok(self, qr_code):
+        with self._state_lock:
+            return qr_code in self._pending_fp_ok
+
+    def read_with_pending(self, scan_date, read):
+        # Runs read() (a query on the committed rows) and returns its result
+        # with the queued scans of scan_date tallied per result, as one
+        # consistent view: a batch can't commit in between.
+        with self._state_lock:
+            pending = self._pending.get(scan_date, Counter())
+            return read(), tuple(pending[result] for result in STAT_RESULTS)
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def _run(self):
+        conn = self.connect()
+        while self._running:
+            scan = self._queue.get()
+            if scan is None:
+                break
+            batch = [scan]
+            deadline = time.monotonic() + self.batch_delay
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    scan = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if scan is None:
+                    self._running = False
+                    break
+                batch.append(scan)
+            while not self._write(conn, batch):
+                time.sleep(RETRY_DELAY)  # the scans stay in the journal meanwhile
+        conn.close()
+
+    def _write(self, conn, batch):
+        with self._state_lock:
+            try:
+                try:
+                    conn.executemany(INSERT_SQL, [[scan[c] for c in COLUMNS] for scan in batch])
+                except sqlite3.IntegrityError:
+                    conn.rollback()
+                    for scan in batch:
+                        self._insert_one(conn, scan)
+                conn.commit()
+            except sqlite3.Error as e:
+                conn.rollback()
+                logger.error("Error writing %d queued scan(s): %s", len(batch), e)
+                return False
+            for scan in batch:
+                self._pending[scan['scan_date']][scan['result']] -= 1
+                if scan['result'] == 'FP OK':
+                    self._pending_fp_ok[scan['qr_code']] -= 1
+                    if self._pending_fp_ok[scan['qr_code']] <= 0:
+                        del self._pending_fp_ok[scan['qr_code']]
+            self._committed += len(batch)
+            self.batches += 1
+        with self._lock:
+            if self._committed == self._submitted and self._journal is not None:
+                self._journal.truncate(0)
+        return True
+
+    def _insert_one(self, conn, scan):
+        # Fallback for a batch that hit a constraint: keep every scan, as the
+        # operator was already told it was recorded
+        values = [scan[c] for c in COLUMNS]
+        try:
+            conn.execute(INSERT_SQL, values)
+            return
+        except sqlite3.IntegrityError:
+            pass
+        if conn.execute("SELECT 1 FROM scans WHERE id = ?", (scan['id'],)).fetchone():
+            logger.warning("Scan id %s was taken, %s stored under a new id", scan['id'], scan['qr_code'])
+            values[0] = None
+        try:
+            conn.execute(INSERT_SQL, values)
+        except sqlite3.IntegrityError:
+            # Only another process writing the same serial meanwhile gets
+            # here (submit() rejects duplicates of its own). The operator was
+            # already told the scan is recorded, so keep it, flagged, and say so.
+            logger.error("Duplicate FP OK for %s (scan id %s) written by another process; "
+                         "stored with fp_ok_duplicate=1, check this unit", scan['qr_code'], values[0] or 'new')
+            conn.execute(INSERT_DUPLICATE_SQL, values)
+            self.flagged += 1
@@ -0,0 +1,103 @@
+import logging
+import threading
+import time
+from collections import deque, namedtuple
+
+from rs485_reader import get_live_power_and_factor_and_rpm
+
+logger = logging.getLogger(__name__)
+
+# Configuration
+POLL_INTERVAL = 0.25      # seconds between acquisitions
+BUFFER_SIZE = 240         # samples kept, one minute at the default interval
+
+# `monotonic` is used for staleness checks, `timestamp` is wall-clock for display
+Sample = namedtuple('Sample', 'monotonic timestamp power power_factor rpm')
+
+
+class SensorPoller:
+    # Polls the energy meter and MP5W continuously and keeps the most recent
+    # samples in a fixed-size ring buffer, so /scan can use a reading that is
+    # already in memory instead of waiting for the bus.
+
+    def __init__(self, read=get_live_power_and_factor_and_rpm, interval=POLL_INTERVAL, size=BUFFER_SIZE):
+        self.read = read
+        self.interval = interval
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+        self._listeners = []
+        self._running = False
+
+    def add_listener(self, callback):
+        self._listeners.append(callback)
+
+    def poll_once(self):
+        power, power_factor, rpm = self.read()
+        if power is None or power_factor is None or rpm is None:
+            return None
+        sample = Sample(time.monotonic(), time.time(), power, power_factor, rpm)
+        with self._lock:
+            self._samples.append(sample)
+        for callback in self._listeners:
+            try:
+                callback(sample)
+            except Exception as e:
+                logger.error("Sensor listener failed: %s", e)
+        return sample
+
+    def run(self, sleep=time.sleep):
+        self._running = True
+        while self._running:
+            started = time.monotonic()
+            try:
+                self.poll_once()
+            except Exception as e:
+                logger.error("Error polling sensors: %s", e)
+            sleep(max(0.0, self.interval - (time.monotonic() - started)))
+
+    def start(self, spawn=None, sleep=time.sleep):
+        # `spawn` lets the caller run the loop on its own green thread or
+        # background task; a daemon thread is used otherwise.
+        if spawn is not None:
+            return spawn(self.run, sleep)
+        thread = threading.Thread(target=self.run, args=(sleep,), name='sensor-poller', daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self._running = False
+
+    def latest(self, max_age):
+        with self._lock:
+            sample = self._samples[-1] if self._samples else None
+        if sample is None or time.monotonic() - sample.monotonic > max_age:
+            return None
+        return sample
+
+    def window(self, window, max_age):
+        # The samples taken in the last `window` seconds, oldest first, or []
+        # when the newest of them is older than `max_age`.
+        now = time.monotonic()
+        with self._lock:
+            recent = [s for s in self._samples if now - s.monotonic <= window]
+        if not recent or now - recent[-1].monotonic > max_age:
+            return []
+        return recent
+
+    def average(self, window, max_age):
+        # Mean of window(window, max_age)
+        recent = self.window(window, max_age)
+        if not recent:
+            return None
+        n = len(recent)
+        return Sample(
+            recent[-1].monotonic,
+            recent[-1].timestamp,
+            round(sum(s.power for s in recent) / n, 1),
+            round(sum(s.power_factor for s in recent) / n, 2),
+            round(sum(s.rpm for s in recent) / n),
+        )
+
+    def snapshot(self):
+        with self._lock:
+            return list(self._samples)
@@ -0,0 +1,204 @@
+import math
+import threading
+from collections import deque
+
+# Statistical process control per model prefix. Grading only says whether a
+# reading is inside the limits; this tracks where each measurement sits
+# between them and flags drift before units start failing.
+#
+# Every scan updates a running mean and variance (Welford) per model and
+# measure in O(1), and is checked against the Western Electric rules on an
+# individuals chart whose centre and sigma are those running values. The
+# first access to a model loads its recent history from the database in one
+# pass; after that the API and the 'spc' Socket.IO room are served from memory.
+
+MEASURES = ('power', 'power_factor', 'rpm')
+
+HISTORY_SCANS = 5000   # scans per model loaded to start the statistics
+CHART_POINTS = 50      # recent points kept per measure for the control chart
+MIN_POINTS = 10        # no rule checks until the statistics have this many scans
+
+RULES = {
+    1: 'One point beyond 3 sigma',
+    2: '2 of 3 points beyond 2 sigma on the same side',
+    3: '4 of 5 points beyond 1 sigma on the same side',
+    4: '8 points in a row on the same side of the centre line',
+}
+
+
+class RunningStats:
+    # Welford's online mean and variance
+
+    def __init__(self, n=0, mean=0.0, m2=0.0):
+        self.n = n
+        self.mean = mean
+        self.m2 = m2
+
+    def add(self, x):
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+
+    @property
+    def std(self):
+        return math.sqrt(self.m2 / (self.n - 1)) if self.n > 1 else None
+
+
+def column_stats(values):
+    # (n, mean, m2) of a whole column, for loading history
+    stats = RunningStats()
+    for x in values:
+        stats.add(x)
+    return stats.n, stats.mean, stats.m2
+
+def check_rules(zs):
+    # Western Electric rules for the newest point, given the z-scores of the
+    # recent points oldest first; returns the numbers of the rules it breaks
+    broken = []
+    z = zs[-1]
+    side = 1 if z > 0 else -1
+    if abs(z) > 3:
+        broken.append(1)
+    if sum(1 for v in zs[-3:] if v * side > 2) >= 2 and abs(z) > 2:
+        broken.append(2)
+    if sum(1 for v in zs[-5:] if v * side > 1) >= 4 and abs(z) > 1:
+        broken.append(3)
+    if len(zs) >= 8 and all(v * side > 0 for v in zs[-8:]):
+        broken.append(4)
+    return broken
+
+def capability(stats, lower, upper):
+    # (Cp, Cpk); Cp needs both limits, PF only has a lower one
+    std = stats.std
+    if not std:
+        return None, None
+    cp = (upper - lower) / (6 * std) if lower is not None and upper is not None else None
+    sides = []
+    if upper is not None:
+        sides.append((upper - stats.mean) / (3 * std))
+    if lower is not None:
+        sides.append((stats.mean - lower) / (3 * std))
+    return cp, min(sides) if sides else None
+
+def spec_limits(model):
+    # model is the config cache tuple (power_min, power_max, pf_min, rpm_min, rpm_max)
+    if not model:
+        return {measure: (None, None) for measure in MEASURES}
+    power_min, power_max, pf_min, rpm_min, rpm_max = model
+    return {'power': (power_min, power_max), 'power_factor': (pf_min, None), 'rpm': (rpm_min, rpm_max)}
+
+
+class MeasureChart:
+
+    def __init__(self):
+        self.stats = RunningStats()
+        self.points = deque(maxlen=CHART_POINTS)   # (scan id, timestamp, value, z, rules broken)
+
+    def observe(self, scan_id, timestamp, value):
+        # z against the statistics before this point, then fold it in
+        std = self.stats.std
+        z = (value - self.stats.mean) / std if std else 0.0
+        zs = [p[3] for p in self.points] + [z]
+        broken = check_rules(zs) if self.stats.n >= MIN_POINTS else []
+        self.points.append((scan_id, timestamp, value, z, broken))
+        self.stats.add(value)
+        return broken
+
+    def summary(self, lower, upper):
+        std = self.stats.std
+        cp, cpk = capability(self.stats, lower, upper)
+        return {
+            'n': self.stats.n,
+            'mean': self.stats.mean if self.stats.n else None,
+            'std': std,
+            'center': self.stats.mean if self.stats.n else None,
+            'ucl': self.stats.mean + 3 * std if std else None,
+            'lcl': self.stats.mean - 3 * std if std else None,
+            'lsl': lower,
+            'usl': upper,
+            'cp': cp,
+            'cpk': cpk,
+        }
+
+    def chart(self):
+        return [{'id': p[0], 'timestamp': p[1], 'value': p[2], 'z': p[3], 'rules': p[4]} for p in self.points]
+
+
+class SPCEngine:
+
+    def __init__(self, get_db):
+        self.get_db = get_db
+        self._models = {}   # casefolded prefix -> {measure: MeasureChart}
+        self._lock = threading.Lock()
+
+    def _load(self, prefix):
+        # Most recent HISTORY_SCANS scans of the model, as column arrays.
+        # LIKE matches the prefix in any case, as the charts are keyed by
+        # the casefolded prefix and observe() takes 'cf1.*' scans live.
+        pattern = prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '.%'
+        rows = self.get_db().execute("""
+            SELECT id, timestamp, power, power_factor, rpm FROM scans
+            WHERE qr_code LIKE ? ESCAPE '\\'
+            ORDER BY id DESC LIMIT ?
+        """, (pattern, HISTORY_SCANS)).fetchall()
+        rows.reverse()
+        charts = {}
+        tail = rows[-CHART_POINTS:]
+        for index, measure in enumerate(MEASURES, start=2):
+            chart = MeasureChart()
+            # Statistics up to the chart window in one vectorized pass, then
+            # the window point by point so its z-scores and rule checks match
+            # what live updates would have produced
+            head = [row[index] for row in rows[:len(rows) - len(tail)]]
+            chart.stats = RunningStats(*column_stats(head))
+            for row in tail:
+                chart.observe(row[0], row[1], row[index])
+            charts[measure] = chart
+        return charts
+
+    def _charts(self, prefix):
+        key = prefix.casefold()
+        charts = self._models.get(key)
+        if charts is None:
+            charts = self._models[key] = self._load(prefix)
+        return charts
+
+    def invalidate(self, prefix=None):
+        # Drop a model's state (all models without prefix); it is reloaded on next use
+        with self._lock:
+            if prefix is None:
+                self._models.clear()
+            else:
+                self._models.pop(prefix.casefold(), None)
+
+    def observe(self, prefix, scan):
+        # Feed one new scan; returns [{measure, value, z, rules}] for any rule it breaks
+        violations = []
+        with self._lock:
+            charts = self._charts(prefix)
+            latest = charts[MEASURES[0]].points
+            if latest and latest[-1][0] >= scan['id']:
+                return violations  # already part of the history just loaded
+            for measure in MEASURES:
+                broken = charts[measure].observe(scan['id'], scan['timestamp'], scan[measure])
+                if broken:
+                    point = charts[measure].points[-1]
+                    violations.append({'measure': measure, 'value': point[2], 'z': point[3],
+                                       'rules': broken})
+        return violations
+
+    def summary(self, prefix, model):
+        limits = spec_limits(model)
+        with self._lock:
+            charts = self._charts(prefix)
+            return {measure: charts[measure].summary(*limits[measure]) for measure in MEASURES}
+
+    def snapshot(self, prefix, model):
+        limits = spec_limits(model)
+        with self._lock:
+            charts = self._charts(prefix)
+            return {
+                measure: {**charts[measure].summary(*limits[measure]), 'points': charts[measure].chart()}
+                for measure in MEASURES
+            }
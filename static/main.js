@@ -29,6 +29,14 @@ const elements = {
 };
 
 let darkMode = localStorage.getItem('darkMode') === 'true';
+
+// Test bench this screen scans for: open the dashboard once with ?station=2
+// and it is remembered. Empty means the server's default station.
+const stationParam = new URLSearchParams(window.location.search).get('station');
+if (stationParam) {
+    localStorage.setItem('station', stationParam);
+}
+const currentStation = localStorage.getItem('station') || '';
 let pendingScanData = null;
 let currentScanId = null;
 
@@ -42,6 +50,12 @@ if (darkMode) {
 // Socket Connection
 socket.on('connect', () => {
     console.log('Connected to server');
+    // Join the rooms for this station and the day on screen (again after a reconnect)
+    socket.emit('subscribe', {
+        station: currentStation || null,
+        date: elements.scanTableBody.dataset.date,
+        spc: 'violations'  // the dashboard only shows rule violations, not the running summaries
+    });
 });
 
 socket.on('connect_error', (error) => {
@@ -49,7 +63,26 @@ socket.on('connect_error', (error) => {
     showNotification('Connection error', 'error');
 });
 
-socket.on('new_scan', handleNewScan);
+// The server coalesces events into one 'batch' message of [event, data] pairs
+const socketHandlers = {
+    new_scan: handleNewScan,
+    live_readings: handleLiveReadings,
+    scan_updated: handleScanUpdated,
+    scan_removed: handleScanRemoved,
+    stats_changed: handleStatsChanged,
+    settings_changed: handleSettingsChanged,
+    scans_imported: handleScansImported,
+    spc_violation: handleSpcViolation
+};
+
+socket.on('batch', events => {
+    events.forEach(([event, data]) => {
+        const handler = socketHandlers[event];
+        if (handler) {
+            handler(data);
+        }
+    });
+});
 
 let scannerJustScanned = false;
 
@@ -107,8 +140,7 @@ document.getElementById('submitFailureCodeBtn').addEventListener('click', async
             const data = await response.json();
             if (data.success) {
                 showNotification('✅ Failure code updated', 'success');
-                // Optionally, reload the page or fetch updated data
-                window.location.reload();
+                // The row itself is patched by the scan_updated event
             } else {
                 showNotification(data.error || 'Failed to update failure code', 'error');
             }
@@ -145,7 +177,7 @@ async function submitScan(failureCode = 'NA') {
             headers: {
                 'Content-Type': 'application/x-www-form-urlencoded',
             },
-            body: `qr_code=${encodeURIComponent(qrCode)}&failure_code=${failureCode}`
+            body: `qr_code=${encodeURIComponent(qrCode)}&failure_code=${failureCode}&station=${encodeURIComponent(currentStation)}`
         });
 
         const data = await response.json();
@@ -198,26 +230,80 @@ function handleFilter() {
     }
 }
 
-function handleNewScan(data) {
+function escapeHtml(value) {
+    return String(value ?? '').replace(/[&<>"']/g, c => ({
+        '&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;'
+    }[c]));
+}
+
+function buildScanRow(data) {
     const row = document.createElement('tr');
+    if (data.id) {
+        row.dataset.id = data.id;
+    }
     row.innerHTML = `
-        <td>${data.daily_number}</td>
-        <td>${data.qr_code}</td>
-        <td>${data.power}</td>
-        <td>${data.rpm}</td>
-        <td>${data.power_factor}</td>
-        <td>${data.failure_code}</td>
+        <td>${escapeHtml(data.daily_number)}</td>
+        <td>${escapeHtml(data.qr_code)}</td>
+        <td>${escapeHtml(data.power)}</td>
+        <td>${escapeHtml(data.rpm)}</td>
+        <td>${escapeHtml(data.power_factor)}</td>
+        <td>${escapeHtml(data.failure_code)}</td>
         <td>
-            <span class="status-badge ${data.status.toLowerCase()}">
-                ${data.status}
+            <span class="status-badge ${escapeHtml(data.status.toLowerCase())}">
+                ${escapeHtml(data.status)}
             </span>
         </td>
-        <td>${data.timestamp}</td>
-        <td>${data.status === 'PASS' ? 'FP OK' : data.result || ''}</td>
-        <td>${data.voice_recognition || 'NA'}</td>
+        <td>${escapeHtml(data.timestamp)}</td>
+        <td>${escapeHtml(data.status === 'PASS' ? 'FP OK' : data.result || '')}</td>
+        <td>${escapeHtml(data.voice_recognition || 'NA')}</td>
     `;
+    return row;
+}
+
+// Lazy loading: the page renders the newest rows, older ones are fetched
+// page by page from /api/scans as the operator scrolls down.
+let loadingOlderScans = false;
+
+async function loadOlderScans() {
+    const body = elements.scanTableBody;
+    const cursor = body.dataset.nextCursor;
+    if (!cursor || loadingOlderScans) {
+        return;
+    }
+    loadingOlderScans = true;
+    try {
+        const date = encodeURIComponent(body.dataset.date);
+        const response = await fetch(`/api/scans?date=${date}&before_id=${cursor}`);
+        const data = await response.json();
+        if (data.error) {
+            throw new Error(data.error);
+        }
+        const fragment = document.createDocumentFragment();
+        data.scans.forEach(scan => fragment.appendChild(buildScanRow(scan)));
+        body.appendChild(fragment);
+        body.dataset.nextCursor = data.next_cursor || '';
+        highlightAllDuplicateRows();
+    } catch (error) {
+        console.error('Failed to load older scans:', error);
+    } finally {
+        loadingOlderScans = false;
+    }
+}
+
+const scanTableSentinel = document.getElementById('scanTableSentinel');
+if (scanTableSentinel && 'IntersectionObserver' in window) {
+    new IntersectionObserver(entries => {
+        if (entries.some(entry => entry.isIntersecting)) {
+            loadOlderScans();
+        }
+    }, { rootMargin: '200px' }).observe(scanTableSentinel);
+}
+
+function handleNewScan(data) {
+    const row = buildScanRow(data);
     elements.scanTableBody.insertBefore(row, elements.scanTableBody.firstChild);
-    updateStats();
+    // The table holds one page of the day, so the counters come from the server
+    applyStats(data);
     showNotification(
         data.status === 'PASS' ? '✅ Scan added - PASS' : '⚠️ Scan added - FAIL',
         data.status === 'PASS' ? 'success' : 'error'
@@ -226,6 +312,93 @@ function handleNewScan(data) {
 
 }
 
+// Delta events: edits made from any client patch the affected row and the
+// counters in place instead of reloading the page. Handlers are idempotent,
+// so the client that made the edit can apply its own response too.
+function findScanRow(id) {
+    return elements.scanTableBody.querySelector(`tr[data-id="${id}"]`);
+}
+
+function handleScanUpdated(data) {
+    const row = findScanRow(data.scan.id);
+    if (row) {
+        row.replaceWith(buildScanRow(data.scan));
+        highlightAllDuplicateRows();
+    }
+}
+
+function handleScanRemoved(data) {
+    if (data.all) {
+        elements.scanTableBody.replaceChildren();
+        elements.scanTableBody.dataset.nextCursor = '';
+        return;
+    }
+    const row = findScanRow(data.id);
+    if (row) {
+        row.remove();
+        highlightAllDuplicateRows();
+    }
+}
+
+function applyStats(stats) {
+    elements.totalPassed.textContent = stats.total_passed;
+    elements.firstPassed.textContent = stats.first_passed;
+    elements.rework.textContent = stats.rework;
+    elements.secondPassed.textContent = stats.second_passed;
+}
+
+function handleStatsChanged(data) {
+    // Counters are per day; ignore changes to a day this page isn't showing
+    if (data.date === elements.scanTableBody.dataset.date) {
+        applyStats(data.stats);
+    }
+}
+
+function handleSettingsChanged(data) {
+    if (data.default_voice_recognition) {
+        currentVoiceState = data.default_voice_recognition;
+        updateVoiceToggleUI();
+    }
+}
+
+// A bulk import sends one event; reload the first page if it touched this day
+async function handleScansImported(data) {
+    const body = elements.scanTableBody;
+    if (!data.dates.includes(body.dataset.date)) {
+        return;
+    }
+    try {
+        const response = await fetch(`/api/scans?date=${encodeURIComponent(body.dataset.date)}`);
+        const page = await response.json();
+        if (page.error) {
+            throw new Error(page.error);
+        }
+        body.replaceChildren(...page.scans.map(buildScanRow));
+        body.dataset.nextCursor = page.next_cursor || '';
+        highlightAllDuplicateRows();
+        showNotification(`${data.count} imported scan(s)`, 'info');
+    } catch (error) {
+        console.error('Failed to reload scans after import:', error);
+    }
+}
+
+// A measurement broke a Western Electric rule on its model's control chart
+function handleSpcViolation(data) {
+    const measures = data.violations.map(v => v.measure).join(', ');
+    showNotification(`📈 ${data.model} drifting: ${measures} (${data.scan.qr_code})`, 'error');
+}
+
+function handleLiveReadings(data) {
+    if (currentStation && data.station !== currentStation) {
+        return;
+    }
+    document.getElementById('liveReadings').hidden = false;
+    document.getElementById('livePower').textContent = data.power;
+    document.getElementById('livePf').textContent = data.power_factor;
+    document.getElementById('liveRpm').textContent = data.rpm;
+    document.getElementById('liveTime').textContent = data.timestamp;
+}
+
 async function handleUndo() {
     hideModal('undoModal');
     
@@ -234,18 +407,9 @@ async function handleUndo() {
         const data = await response.json();
 
         if (data.success) {
-            if (elements.scanTableBody.firstElementChild) {
-                elements.scanTableBody.firstElementChild.remove();
-            }
-
-            // ✅ Update stats after undo
+            handleScanRemoved({ id: data.id });
             if (data.stats) {
-                elements.totalPassed.textContent = data.stats.total_passed;
-                elements.firstPassed.textContent = data.stats.first_passed;
-                elements.rework.textContent = data.stats.rework;
-                elements.secondPassed.textContent = data.stats.second_passed;
-            } else {
-                updateStats();
+                applyStats(data.stats);
             }
 
             showNotification('Last scan removed', 'success');
@@ -264,8 +428,9 @@ function handleExport(e) {
     const startDate = document.getElementById('startDate').value;
     const endDate = document.getElementById('endDate').value;
     const fileName = document.getElementById('fileName').value;
+    const format = document.getElementById('exportFormat').value;
     
-    window.location.href = `/export?start_date=${startDate}&end_date=${endDate}&file_name=${fileName}`;
+    window.location.href = `/export?start_date=${startDate}&end_date=${endDate}&file_name=${encodeURIComponent(fileName)}&format=${format}`;
     hideModal('exportModal');
 }
 
@@ -281,7 +446,9 @@ function updateFailureCodeAndResult(failureCode, result) {
     .then(response => response.json())
     .then(data => {
         if (data.success) {
-            location.reload(); // Refresh to show updated data
+            if (data.scan) {
+                handleScanUpdated(data);
+            }
         } else {
             throw new Error(data.error || 'Update failed');
         }
@@ -357,8 +524,7 @@ function sendVoiceOption(option) {
     .then(data => {
         if (data.success) {
             document.getElementById('voiceModal').style.display = 'none';
-            // No alert, just refresh to show updated settings
-            location.reload();
+            handleSettingsChanged({ default_voice_recognition: data.selected });
         } else {
             throw new Error(data.error || 'Update failed');
         }
@@ -426,8 +592,9 @@ document.getElementById('submitFailureCodeBtn').addEventListener('click', functi
     .then(data => {
         if (data.success) {
             document.getElementById('failureCodeModal').style.display = 'none';
-            // Refresh the page to show updated data
-            window.location.reload();
+            if (data.scan) {
+                handleScanUpdated(data);
+            }
         } else {
             alert('Error: ' + (data.error || 'Failed to update'));
         }
@@ -496,7 +663,9 @@ document.getElementById('saveEditBtn').onclick = async function() {
     if (data.success) {
       showNotification('✅ Last scan updated successfully', 'success');
       document.getElementById('editLastScanModal').style.display = 'none';
-      location.reload();  // Refresh to show updated data
+      if (data.scan) {
+        handleScanUpdated(data);
+      }
     } else {
       showNotification(`Error: ${data.error || 'Failed to update'}`, 'error');
     }
@@ -588,7 +757,7 @@ document.getElementById("formatScansBtn").addEventListener("click", function() {
             .then(data => {
                 if (data.success) {
                     alert(data.message);
-                    location.reload(); // refresh to show empty scans
+                    handleScanRemoved({ all: true });
                 } else {
                     alert("Error: " + (data.error || "Could not clear scans."));
                 }
@@ -602,31 +771,6 @@ document.getElementById("formatScansBtn").addEventListener("click", function() {
     }
 });
 
-// Recalculate stats based on current table rows
-function updateStats() {
-    let totalPassed = 0;
-    let firstPassed = 0;
-    let rework = 0;
-    let secondPassed = 0;
-
-    const rows = elements.scanTableBody.querySelectorAll('tr');
-    rows.forEach(row => {
-        const status = row.cells[6]?.textContent.trim(); // status column
-        const result = row.cells[8]?.textContent.trim(); // FP OK / result column
-
-        if (status === 'PASS') totalPassed++;
-        if (result === 'FP OK') firstPassed++;
-        if (status === 'FAIL' && result === 'REWORK') rework++;
-        if (status === 'PASS' && result === 'SECOND PASS') secondPassed++;
-    });
-
-    elements.totalPassed.textContent = totalPassed;
-    elements.firstPassed.textContent = firstPassed;
-    elements.rework.textContent = rework;
-    elements.secondPassed.textContent = secondPassed;
-}
-
-
 fetchVoiceState();
 // Run once on page load to highlight existing duplicates
 highlightAllDuplicateRows();
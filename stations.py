@@ -0,0 +1,91 @@
+import json
+import logging
+import os
+
+import serial
+
+from rs485_reader import (BAUDRATE, ENERGY_METER_PARITY, ENERGY_METER_SLAVE_ID, MP5W_PARITY,
+                          MP5W_SLAVE_ID, SERIAL_PORT, RS485Session)
+
+logger = logging.getLogger(__name__)
+
+# Test benches served by this app. Without a stations file there is a single
+# station using the rs485_reader defaults (COM3, slaves 1 and 3).
+STATIONS_FILE = os.environ.get('QA_STATIONS_FILE', 'stations.json')
+DEFAULT_STATION = '1'
+
+# Example stations.json:
+# [
+#   {"id": "1", "port": "COM3"},
+#   {"id": "2", "port": "COM4", "meter_slave_id": 2, "rpm_slave_id": 4,
+#    "meter_parity": "O", "rpm_parity": "N", "baudrate": 9600}
+# ]
+
+PARITIES = {
+    'N': serial.PARITY_NONE,
+    'E': serial.PARITY_EVEN,
+    'O': serial.PARITY_ODD,
+}
+
+
+class Station:
+    # One bench: its own serial port and slave map. Each station has its own
+    # RS485Session, so a read on one port never waits for another port.
+
+    def __init__(self, station_id, port=SERIAL_PORT, baudrate=BAUDRATE,
+                 meter_slave_id=ENERGY_METER_SLAVE_ID, rpm_slave_id=MP5W_SLAVE_ID,
+                 meter_parity=ENERGY_METER_PARITY, rpm_parity=MP5W_PARITY):
+        self.id = str(station_id)
+        self.port = port
+        self.session = RS485Session(port, baudrate, meter_parity, rpm_parity, meter_slave_id, rpm_slave_id)
+
+    def read(self):
+        try:
+            return self.session.read_all()
+        except Exception as e:
+            logger.error("Error reading RS485 data on station %s: %s", self.id, e)
+            return None, None, None
+
+    def close(self):
+        self.session.close()
+
+
+def _parity(value, default):
+    if value is None:
+        return default
+    if value not in PARITIES:
+        raise ValueError(f"Unknown parity {value!r}, expected one of {', '.join(PARITIES)}")
+    return PARITIES[value]
+
+def station_from_config(entry):
+    return Station(
+        entry['id'],
+        port=entry['port'],
+        baudrate=int(entry.get('baudrate', BAUDRATE)),
+        meter_slave_id=int(entry.get('meter_slave_id', ENERGY_METER_SLAVE_ID)),
+        rpm_slave_id=int(entry.get('rpm_slave_id', MP5W_SLAVE_ID)),
+        meter_parity=_parity(entry.get('meter_parity'), ENERGY_METER_PARITY),
+        rpm_parity=_parity(entry.get('rpm_parity'), MP5W_PARITY),
+    )
+
+def load_stations(path=STATIONS_FILE):
+    if not os.path.exists(path):
+        return {DEFAULT_STATION: Station(DEFAULT_STATION)}
+
+    with open(path) as f:
+        entries = json.load(f)
+
+    stations = {}
+    ports = set()
+    for entry in entries:
+        station = station_from_config(entry)
+        if station.id in stations:
+            raise ValueError(f"Duplicate station id {station.id!r} in {path}")
+        if station.port in ports:
+            # Only one handle can own a COM port, so every station needs its own adapter
+            raise ValueError(f"Port {station.port} is used by more than one station in {path}")
+        ports.add(station.port)
+        stations[station.id] = station
+    if not stations:
+        raise ValueError(f"No stations defined in {path}")
+    return stations
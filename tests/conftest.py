@@ -0,0 +1,16 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import app as app_module
+from app import app
+import pytest
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(app_module, 'DB_FILE', str(tmp_path / 'scan_log.db'))
+    app_module.init_db()
+    with app_module.get_db() as conn:
+        conn.execute("INSERT INTO models VALUES ('CF1', 50, 100, 0.9, 250, 400)")
+        conn.commit()
+    with app.test_client() as client:
+        yield client
@@ -0,0 +1,145 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import json
+import threading
+import time
+from acquisition_broker import Broker, BrokerClient, PRIORITY_SCAN, parse_address
+import pytest
+
+
+class FakeStation:
+
+    def __init__(self):
+        self.reads = 0
+        self.release = threading.Event()
+
+    def read(self):
+        self.release.wait(1)
+        self.reads += 1
+        return 75.5, 0.98, 320
+
+    def close(self):
+        pass
+
+
+def test_parse_address():
+    assert parse_address('127.0.0.1:6001') == ('127.0.0.1', 6001)
+    assert parse_address('/tmp/qa-broker.sock') == '/tmp/qa-broker.sock'
+    assert parse_address(r'\\.\pipe\qa-broker') == r'\\.\pipe\qa-broker'
+
+
+def test_client_reads_through_broker():
+    station = FakeStation()
+    station.release.set()
+    broker = Broker({'1': station}, address='127.0.0.1:0', authkey=b'test').start()
+    try:
+        client = BrokerClient(address=f'127.0.0.1:{broker.address[1]}', authkey=b'test')
+        assert client.stations() == ['1']
+        assert client.read('1', PRIORITY_SCAN) == (75.5, 0.98, 320)
+        client.close()
+    finally:
+        broker.stop()
+
+
+def test_waiting_requests_share_one_read():
+    station = FakeStation()
+    broker = Broker({'1': station}, address='127.0.0.1:0', authkey=b'test').start()
+    try:
+        results = []
+        first = threading.Thread(target=lambda: results.append(broker.read('1')))
+        first.start()
+        while broker._queues['1'].qsize():
+            pass  # wait until the worker is busy with the first read
+        waiters = [threading.Thread(target=lambda: results.append(broker.read('1'))) for _ in range(3)]
+        for t in waiters:
+            t.start()
+        while broker._queues['1'].qsize() < 3:
+            pass
+        station.release.set()
+        for t in [first] + waiters:
+            t.join(2)
+        assert len(results) == 4
+        assert station.reads == 2
+    finally:
+        broker.stop()
+
+
+class SlowStation(FakeStation):
+
+    def read(self):
+        time.sleep(0.3)
+        return super().read()
+
+
+def test_client_reads_stations_in_parallel():
+    stations = {'1': SlowStation(), '2': SlowStation()}
+    for station in stations.values():
+        station.release.set()
+    broker = Broker(stations, address='127.0.0.1:0', authkey=b'test').start()
+    try:
+        client = BrokerClient(address=f'127.0.0.1:{broker.address[1]}', authkey=b'test')
+        client.read('1')  # connect once up front
+        results = []
+        threads = [threading.Thread(target=lambda sid=sid: results.append(client.read(sid))) for sid in stations]
+        started = time.monotonic()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(2)
+        assert len(results) == 2
+        assert time.monotonic() - started < 0.55  # one read's time, not two
+        client.close()
+    finally:
+        broker.stop()
+
+
+def test_broker_does_not_unpickle():
+    import pickle
+    from multiprocessing.connection import Client
+    station = FakeStation()
+    station.release.set()
+    broker = Broker({'1': station}, address='127.0.0.1:0', authkey=b'test').start()
+    try:
+        with Client(('127.0.0.1', broker.address[1]), authkey=b'test') as conn:
+            conn.send_bytes(pickle.dumps({'op': 'ping'}))
+            assert b'not JSON' in conn.recv_bytes()
+            conn.send_bytes(b'{"op": "ping"}')
+            assert conn.recv_bytes() == b'{"ok": true}'
+    finally:
+        broker.stop()
+
+
+def test_broker_rejects_bad_requests():
+    from multiprocessing.connection import Client
+    station = FakeStation()
+    station.release.set()
+    broker = Broker({'1': station}, address='127.0.0.1:0', authkey=b'test').start()
+    try:
+        with Client(('127.0.0.1', broker.address[1]), authkey=b'test') as conn:
+            for request in ({'op': 'read', 'station': '1', 'priority': 'x'},
+                            {'op': 'read', 'station': '1', 'priority': -1},
+                            {'op': 'read', 'station': ['1']}):
+                conn.send_bytes(json.dumps(request).encode())
+                assert json.loads(conn.recv_bytes())['ok'] is False
+            conn.send_bytes(b'{"op": "read", "station": "1"}')
+            assert json.loads(conn.recv_bytes())['ok'] is True
+        assert broker._queues['1'].qsize() == 0
+    finally:
+        broker.stop()
+
+
+def test_stuck_station_times_out():
+    station = FakeStation()  # never released: each read takes a second
+    broker = Broker({'1': station}, address='127.0.0.1:0', authkey=b'test', timeout=0.2).start()
+    try:
+        client = BrokerClient(address=f'127.0.0.1:{broker.address[1]}', authkey=b'test', timeout=0.1)
+        with pytest.raises(TimeoutError):
+            client.read('1')
+        client.timeout = 2
+        with pytest.raises(ValueError, match='did not answer'):
+            client.read('1')
+        client.close()
+    finally:
+        station.release.set()
+        broker.stop()
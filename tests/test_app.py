@@ -1,14 +1,461 @@
 import sys
 import os
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import app as app_module
 from app import app
 import pytest
 
 @pytest.fixture
-def client():
-    with app.test_client() as client:
-        yield client
+def sensors(monkeypatch):
+    readings = {'power': 75.5, 'power_factor': 0.98, 'rpm': 320}
+    monkeypatch.setattr(app_module, 'read_sensors',
+                        lambda station_id=None: (readings['power'], readings['power_factor'], readings['rpm']))
+    return readings
 
 def test_index(client):
     rv = client.get('/')
     assert rv.status_code == 200
+
+def test_scan_records_station(client, sensors):
+    rv = client.post('/scan', data={'qr_code': 'CF1.0001'})
+    data = rv.get_json()
+    assert data['success'] and data['data']['status'] == 'PASS'
+    assert data['data']['station'] == app_module.DEFAULT_STATION
+
+    rv = client.post('/scan', data={'qr_code': 'CF1.0002', 'station': 'nope'})
+    assert rv.status_code == 400
+
+def test_init_db_migrates_old_database(tmp_path, monkeypatch):
+    import sqlite3
+    db = str(tmp_path / 'old.db')
+    conn = sqlite3.connect(db)
+    conn.execute("""
+        CREATE TABLE scans (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, daily_number INTEGER NOT NULL, qr_code TEXT NOT NULL,
+            power REAL NOT NULL, rpm INTEGER NOT NULL, power_factor REAL NOT NULL, failure_code TEXT NOT NULL,
+            status TEXT NOT NULL, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP, result TEXT DEFAULT 'FP OK',
+            voice_recognition TEXT DEFAULT 'NA')
+    """)
+    conn.execute("INSERT INTO scans (daily_number, qr_code, power, rpm, power_factor, failure_code, status, timestamp)"
+                 " VALUES (1, 'CF1.1', 75, 320, 0.98, 'NA', 'PASS', '2024-05-01 10:00:00')")
+    conn.commit()
+    conn.close()
+
+    monkeypatch.setattr(app_module, 'DB_FILE', db)
+    app_module.init_db()
+    app_module.init_db()  # idempotent
+
+    with app_module.get_db() as conn:
+        assert conn.execute("PRAGMA user_version").fetchone()[0] == len(app_module.MIGRATIONS)
+        row = conn.execute("SELECT scan_date, station FROM scans").fetchone()
+        assert (row['scan_date'], row['station']) == ('2024-05-01', '1')
+        plan = conn.execute("EXPLAIN QUERY PLAN SELECT COUNT(*) FROM scans WHERE scan_date = ? AND result = 'FP OK'",
+                            ('2024-05-01',)).fetchall()
+        assert 'idx_scans_scan_date_result' in plan[0]['detail']
+
+def test_daily_stats_follow_edits(client, sensors):
+    client.post('/scan', data={'qr_code': 'CF1.0001'})
+    client.post('/scan', data={'qr_code': 'CF1.0002'})
+    sensors['power'] = 200.0
+    rv = client.post('/scan', data={'qr_code': 'CF1.0003'})
+    assert rv.get_json()['data']['daily_number'] == 3
+    client.post('/update_result', data={'result': 'RW'})
+    assert app_module.get_stats() == {'total_passed': 2, 'first_passed': 2, 'second_passed': 0, 'rework': 1}
+
+    client.post('/edit_last_scan', data={'failure_code': 'FT3', 'result': 'SP OK'})
+    client.post('/undo')
+    assert app_module.get_stats() == {'total_passed': 2, 'first_passed': 2, 'second_passed': 0, 'rework': 0}
+    rv = client.post('/scan', data={'qr_code': 'CF1.0004'})
+    assert rv.get_json()['data']['daily_number'] == 3
+
+    with app_module.get_db() as conn:
+        before = [tuple(r) for r in conn.execute("SELECT * FROM daily_stats")]
+        app_module.rebuild_daily_stats(conn.cursor())
+        assert [tuple(r) for r in conn.execute("SELECT * FROM daily_stats")] == before
+
+def test_model_cache_invalidation(client, sensors, monkeypatch):
+    assert client.post('/scan', data={'qr_code': 'CF2.0001'}).get_json()['data']['result'] == 'MODEL NOT FOUND'
+    client.post('/models', data={'action': 'add', 'model_prefix': 'cf2', 'power_min': 50, 'power_max': 100,
+                                 'pf_min': 0.9, 'rpm_min': 250, 'rpm_max': 400})
+    assert client.post('/scan', data={'qr_code': 'CF2.0002'}).get_json()['data']['status'] == 'PASS'
+
+    # A change made by another process is picked up through the version stamp
+    monkeypatch.setattr(app_module.config_cache, 'check_interval', 0)
+    import sqlite3
+    with sqlite3.connect(app_module.DB_FILE) as conn:
+        conn.execute("UPDATE models SET rpm_min = 330 WHERE model_prefix = 'cf2'")
+    assert client.post('/scan', data={'qr_code': 'CF2.0003'}).get_json()['data']['status'] == 'FAIL'
+
+def test_model_cache_invalidated_while_reading(client, monkeypatch):
+    import threading
+    cache = app_module.config_cache
+    cache.model('CF1')
+    # Another thread invalidates the cache each time a read goes to the
+    # database, i.e. while it checks the version stamp or loads
+    monkeypatch.setattr(cache, 'check_interval', 0)
+    reading, invalidated, stop = threading.Event(), threading.Event(), threading.Event()
+    def invalidate():
+        while not stop.is_set():
+            if reading.wait(0.1):
+                reading.clear()
+                cache.invalidate()
+                invalidated.set()
+    get_db = cache.get_db
+    def racing_get_db():
+        reading.set()
+        invalidated.wait(1)
+        invalidated.clear()
+        return get_db()
+    monkeypatch.setattr(cache, 'get_db', racing_get_db)
+    thread = threading.Thread(target=invalidate)
+    thread.start()
+    try:
+        for _ in range(20):
+            assert cache.model('CF1') == (50, 100, 0.9, 250, 400)
+            assert cache.setting('missing', 'x') == 'x'
+    finally:
+        stop.set()
+        thread.join()
+
+def test_duplicate_fp_ok_guard(client, sensors):
+    assert client.post('/scan', data={'qr_code': 'CF1.0001'}).get_json()['success']
+    assert client.post('/scan', data={'qr_code': 'CF1.0001'}).get_json()['duplicate_fp_ok']
+
+    client.post('/undo')
+    assert client.post('/scan', data={'qr_code': 'CF1.0001'}).get_json()['success']
+
+    sensors['power'] = 200.0
+    assert client.post('/scan', data={'qr_code': 'CF1.0002'}).get_json()['data']['status'] == 'FAIL'
+    client.post('/update_result', data={'result': 'FP OK'})
+    assert client.post('/scan', data={'qr_code': 'CF1.0002'}).get_json()['duplicate_fp_ok']
+
+    # A second FP OK for the same serial is refused by the unique index
+    client.post('/scan', data={'qr_code': 'CF1.0001.B'})
+    with app_module.get_db() as conn:
+        conn.execute("UPDATE scans SET qr_code = 'CF1.0001' WHERE id = (SELECT MAX(id) FROM scans)")
+        conn.commit()
+    rv = client.post('/edit_last_scan', data={'failure_code': 'NA', 'result': 'FP OK'})
+    assert rv.status_code == 409
+
+def test_export_formats(client, sensors):
+    import io
+    from datetime import datetime
+    from openpyxl import load_workbook
+    for i in range(3):
+        client.post('/scan', data={'qr_code': f'CF1.{i:04d}'})
+    today = datetime.now().strftime('%Y-%m-%d')
+
+    rv = client.get(f'/export?start_date={today}&end_date={today}&file_name=r&format=csv')
+    lines = rv.get_data(as_text=True).splitlines()
+    assert lines[0].startswith('SL.NO,QR Code') and len(lines) == 4
+    assert lines[1].startswith('1,CF1.0000,75.5,320,0.98')
+
+    rv = client.get(f'/export?start_date={today}&end_date={today}&file_name=r')
+    ws = load_workbook(io.BytesIO(rv.data)).active
+    assert ws.max_row == 4 and ws['B2'].value == 'CF1.0000'
+    rv.close()
+
+    assert client.get('/export?start_date=2000-01-01&end_date=2000-01-02').status_code == 404
+
+def test_api_scans_keyset_pagination(client, sensors):
+    for i in range(5):
+        client.post('/scan', data={'qr_code': f'CF1.{i:04d}'})
+    client.post('/scan', data={'qr_code': 'XX.0001'})
+
+    page = client.get('/api/scans?limit=2&model=cf1&fields=qr_code').get_json()
+    assert page['scans'] == [{'id': 5, 'qr_code': 'CF1.0004'}, {'id': 4, 'qr_code': 'CF1.0003'}]
+    page = client.get(f"/api/scans?limit=2&model=cf1&fields=qr_code&before_id={page['next_cursor']}").get_json()
+    assert [s['id'] for s in page['scans']] == [3, 2]
+    page = client.get(f"/api/scans?limit=2&model=cf1&before_id={page['next_cursor']}").get_json()
+    assert [s['id'] for s in page['scans']] == [1] and page['next_cursor'] is None
+
+    assert len(client.get('/api/scans?result=MODEL NOT FOUND').get_json()['scans']) == 1
+    assert client.get('/api/scans?fields=password').status_code == 400
+    assert client.get('/api/scans?limit=0').status_code == 400
+    assert client.get('/api/scans?limit=-1').status_code == 400
+
+def received_events(ws):
+    app_module.broadcaster.flush()
+    events = {}
+    for message in ws.get_received():
+        assert message['name'] == 'batch'
+        for event, data in message['args'][0]:
+            events[event] = data
+    return events
+
+def test_edits_emit_delta_events(client, sensors):
+    ws = app_module.socketio.test_client(app, flask_test_client=client)
+    ws.emit('subscribe', {'station': app_module.DEFAULT_STATION})
+    client.post('/scan', data={'qr_code': 'CF1.0001'})
+    sensors['power'] = 10
+    scan_id = client.post('/scan', data={'qr_code': 'CF1.0002'}).get_json()['data']['id']
+    assert received_events(ws)['new_scan']['id'] == scan_id
+
+    rv = client.post('/update_failure_code', data={'qr_code': 'CF1.0002', 'failure_code': 'E7'})
+    assert rv.get_json()['scan']['failure_code'] == 'E7'
+    events = received_events(ws)
+    assert events['scan_updated']['scan']['id'] == scan_id
+    assert events['scan_updated']['scan']['failure_code'] == 'E7'
+
+    client.post('/update_result', data={'result': 'RW'})
+    events = received_events(ws)
+    assert events['scan_updated']['scan']['result'] == 'RW'
+    assert events['stats_changed']['stats']['rework'] == 1
+
+    data = client.post('/undo').get_json()
+    assert data['id'] == scan_id and data['stats']['rework'] == 0
+    events = received_events(ws)
+    assert events['scan_removed'] == {'id': scan_id}
+    assert events['stats_changed']['stats']['first_passed'] == 1
+
+    client.post('/voice_recognition', data={'option': 'OK'})
+    assert received_events(ws)['settings_changed'] == {'default_voice_recognition': 'OK'}
+
+    # A display showing another day gets no scan events for today
+    ws.emit('subscribe', {'date': '2000-01-01'})
+    client.post('/scan', data={'qr_code': 'CF1.0003'})
+    assert 'new_scan' not in received_events(ws)
+    ws.disconnect()
+
+def test_clear_scans_tells_displays_of_cleared_days(client, sensors):
+    from datetime import datetime
+    today = datetime.now().strftime('%Y-%m-%d')
+    client.post('/scan', data={'qr_code': 'CF1.0001'})
+    shown = app_module.socketio.test_client(app, flask_test_client=client)
+    shown.emit('subscribe', {'date': today})
+    other = app_module.socketio.test_client(app, flask_test_client=client)
+    other.emit('subscribe', {'date': '2000-01-01'})
+    received_events(shown), received_events(other)
+
+    client.post('/clear_scans')
+    events = received_events(shown)
+    assert events['scan_removed'] == {'all': True}
+    assert events['stats_changed'] == {'date': today, 'stats': {'total_passed': 0, 'first_passed': 0,
+                                                                 'second_passed': 0, 'rework': 0}}
+    assert received_events(other) == {}
+    shown.disconnect()
+    other.disconnect()
+
+def test_batch_import(client):
+    lines = [
+        '{"qr_code": "CF1.0002", "power": 75, "rpm": 320, "power_factor": 0.98, "timestamp": "2024-05-01 10:05:00"}',
+        '{"qr_code": "CF1.0001", "power": 75, "rpm": 320, "power_factor": 0.98, "timestamp": "2024-05-01T10:00:00"}',
+        '{"qr_code": "CF1.0001", "power": 75, "rpm": 320, "power_factor": 0.98, "timestamp": "2024-05-01 10:10:00"}',
+        '{"qr_code": "CF1.0003", "power": 10, "rpm": 320, "power_factor": 0.98, "timestamp": "2024-05-01 10:15:00"}',
+        '{"qr_code": "CF1.0004", "power": "high", "rpm": 320, "power_factor": 0.98}',
+        'not json',
+    ]
+    rv = client.post('/api/scans/batch', data='\n'.join(lines), content_type='application/x-ndjson')
+    data = rv.get_json()
+    assert data['summary'] == {'inserted': 3, 'duplicate': 1, 'invalid': 2}
+    outcomes = data['outcomes']
+    assert [o['status'] for o in outcomes] == ['inserted', 'inserted', 'duplicate', 'inserted', 'invalid', 'invalid']
+    # Numbered in timestamp order, not input order
+    assert (outcomes[1]['daily_number'], outcomes[0]['daily_number'], outcomes[3]['daily_number']) == (1, 2, 3)
+    assert outcomes[3]['result'] == ''
+
+    csv_body = 'qr_code,power,rpm,power_factor,timestamp\nCF1.0002,75,320,0.98,2024-05-02 09:00:00\nCF1.0005,75,320,0.98,2024-05-02 09:01:00\n'
+    data = client.post('/api/scans/batch?format=csv', data=csv_body).get_json()
+    assert data['summary'] == {'inserted': 1, 'duplicate': 1, 'invalid': 0}
+    assert data['outcomes'][1] == {'line': 3, 'status': 'inserted', 'id': data['outcomes'][1]['id'],
+                                   'daily_number': 1, 'result': 'FP OK'}
+    assert app_module.get_stats('2024-05-01')['first_passed'] == 2
+
+    # A result the grade contradicts, and values that only look like numbers
+    lines = [
+        '{"qr_code": "CF1.0006", "power": 10, "rpm": 320, "power_factor": 0.98, "result": "FP OK"}',
+        '{"qr_code": "CF1.0007", "power": true, "rpm": 320, "power_factor": 0.98}',
+        '{"qr_code": "CF1.0008", "power": NaN, "rpm": 320, "power_factor": 0.98}',
+        '{"qr_code": "CF1.0009", "power": 75, "rpm": 320, "power_factor": 0.98, "result": "RW"}',
+    ]
+    outcomes = client.post('/api/scans/batch', data='\n'.join(lines)).get_json()['outcomes']
+    assert [o['status'] for o in outcomes] == ['invalid', 'invalid', 'invalid', 'inserted']
+    assert 'conflicts' in outcomes[0]['error'] and outcomes[3]['result'] == 'FP OK'
+
+def test_rollups_follow_edits_and_match_backfill(client, sensors):
+    client.post('/scan', data={'qr_code': 'CF1.0001'})
+    sensors['power'] = 90
+    client.post('/scan', data={'qr_code': 'cf1.0002'})
+    sensors['power'] = 10
+    client.post('/scan', data={'qr_code': 'CF1.0003'})
+    client.post('/update_failure_code', data={'qr_code': 'CF1.0003', 'failure_code': 'E7'})
+    client.post('/scan', data={'qr_code': 'CF1.0004'})
+    client.post('/undo')
+
+    data = client.get('/api/trends?grain=month&model=CF1').get_json()
+    (point,) = data['points']
+    assert (point['scan_count'], point['pass_count'], point['fp_ok']) == (3, 2, 2)
+    assert abs(point['power']['mean'] - (75.5 + 90 + 10) / 3) < 1e-9
+    assert data['failure_codes'] == [{'failure_code': 'E7', 'count': 1}]
+
+    def snapshot():
+        with app_module.get_db() as conn:
+            rows = conn.execute("SELECT * FROM scan_rollups WHERE scan_count > 0 ORDER BY 1, 2, 3, 4").fetchall()
+            failures = conn.execute("SELECT * FROM failure_rollups WHERE count > 0 ORDER BY 1, 2, 3, 4, 5").fetchall()
+        # min/max may be a wider envelope after an undo, so compare counts and sums only
+        return ([tuple(round(v, 6) if isinstance(v, float) else v for k, v in dict(r).items()
+                       if not k.endswith(('_min', '_max'))) for r in rows],
+                [tuple(r) for r in failures])
+
+    incremental = snapshot()
+    app_module.rebuild_trend_rollups()
+    assert snapshot() == incremental
+
+    hourly = client.get('/api/trends?grain=hour&group_by=station').get_json()['points']
+    assert sum(p['scan_count'] for p in hourly) == 3 and all(p['station'] == '1' for p in hourly)
+
+def test_archive_closed_months(client, sensors, tmp_path):
+    from archive import archive_closed_months
+    lines = [f'{{"qr_code": "CF1.{n:04d}", "power": 75, "rpm": 320, "power_factor": 0.98, '
+             f'"timestamp": "2024-{month:02d}-10 10:{n:02d}:00"}}'
+             for month in (3, 4, 5) for n in range(month * 10, month * 10 + 3)]
+    client.post('/api/scans/batch', data='\n'.join(lines))
+    before = client.get('/api/trends?grain=month&start=2024-01&end=2024-12').get_json()['points']
+
+    with app_module.get_db() as conn:
+        archived = archive_closed_months(conn, retain_months=1, archive_dir=str(tmp_path / 'archive'),
+                                         today='2024-05-20')
+        assert archived == {'2024-03': 3, '2024-04': 3}
+        assert conn.execute("SELECT COUNT(*) FROM scans").fetchone()[0] == 3
+    assert (tmp_path / 'archive' / 'scans_2024-03.db').exists()
+
+    # Counters, trends, listings and exports still cover the archived months,
+    # also after the counters are rebuilt from the hot table
+    app_module.rebuild_stats()
+    app_module.rebuild_trend_rollups()
+    assert app_module.get_stats('2024-03-10')['first_passed'] == 3
+    assert client.get('/api/trends?grain=month&start=2024-01&end=2024-12').get_json()['points'] == before
+    assert len(client.get('/api/trends?grain=hour&start=2024-03-01&end=2024-03-31').get_json()['points']) == 1
+    page = client.get('/api/scans?start_date=2024-01-01&end_date=2024-12-31&limit=5').get_json()
+    assert [s['qr_code'] for s in page['scans']] == ['CF1.0052', 'CF1.0051', 'CF1.0050', 'CF1.0042', 'CF1.0041']
+    page = client.get(f"/api/scans?start_date=2024-01-01&end_date=2024-12-31&before_id={page['next_cursor']}").get_json()
+    assert [s['qr_code'] for s in page['scans']] == ['CF1.0040', 'CF1.0032', 'CF1.0031', 'CF1.0030']
+    assert client.get('/api/scans?date=2024-04-10').get_json()['scans'][0]['qr_code'] == 'CF1.0042'
+    rv = client.get('/export?start_date=2024-03-15&end_date=2024-05-31&format=csv')
+    assert [line.split(',')[1] for line in rv.get_data(as_text=True).splitlines()[1:]] == \
+        ['CF1.0040', 'CF1.0041', 'CF1.0042', 'CF1.0050', 'CF1.0051', 'CF1.0052']
+
+    # A serial that passed in an archived month can't pass again
+    rv = client.post('/scan', data={'qr_code': 'CF1.0031'})
+    assert rv.get_json()['duplicate_fp_ok']
+    app_module.duplicate_guard.invalidate()
+    with app_module.get_db() as conn:
+        try:
+            conn.execute("INSERT INTO scans (daily_number, qr_code, power, rpm, power_factor, failure_code, status, result)"
+                         " VALUES (1, 'CF1.0031', 75, 320, 0.98, 'NA', 'PASS', 'FP OK')")
+            assert False, 'archived FP OK serial was accepted'
+        except app_module.sqlite3.IntegrityError:
+            conn.rollback()
+
+    # Clearing the scan log leaves the archives alone
+    client.post('/clear_scans')
+    assert (tmp_path / 'archive' / 'scans_2024-03.db').exists()
+    assert app_module.get_stats('2024-03-10')['first_passed'] == 3
+    assert app_module.get_stats('2024-05-10')['first_passed'] == 0
+    assert client.post('/scan', data={'qr_code': 'CF1.0031'}).get_json()['duplicate_fp_ok']
+    assert len(client.get('/api/scans?start_date=2024-01-01&end_date=2024-12-31').get_json()['scans']) == 6
+
+    assert app_module.remove_scan_archives() == ['2024-03', '2024-04']
+    assert not (tmp_path / 'archive' / 'scans_2024-03.db').exists()
+    assert app_module.get_stats('2024-03-10')['first_passed'] == 0
+    assert client.post('/scan', data={'qr_code': 'CF1.0031'}).get_json()['success']
+
+def test_spc_updates_and_violations(client, sensors):
+    ws = app_module.socketio.test_client(app, flask_test_client=client)
+    ws.emit('subscribe', {'spc': True})
+    dashboard = app_module.socketio.test_client(app, flask_test_client=client)
+    dashboard.emit('subscribe', {'spc': 'violations'})
+    for n in range(20):
+        sensors['power'] = 75 + (0.5 if n % 2 else -0.5)
+        client.post('/scan', data={'qr_code': f'CF1.{n:04d}'})
+    ws.get_received()
+    sensors['power'] = 95
+    scan_id = client.post('/scan', data={'qr_code': 'CF1.0099'}).get_json()['data']['id']
+
+    events = received_events(ws)
+    assert events['spc_violation']['scan']['id'] == scan_id
+    assert events['spc_violation']['violations'][0]['measure'] == 'power'
+    assert 1 in events['spc_violation']['violations'][0]['rules']
+    assert events['spc_update']['measures']['power']['n'] == 21
+    # Dashboards get the violation but not the summary after every scan
+    events = {}
+    for message in dashboard.get_received():
+        for event, data in message['args'][0]:
+            events[event] = data
+    assert events['spc_violation']['scan']['id'] == scan_id and 'spc_update' not in events
+
+    data = client.get('/api/spc?model=CF1').get_json()
+    power = data['measures']['power']
+    assert power['n'] == 21 and power['points'][-1]['rules'] == [1]
+    assert power['cp'] > 0 and power['cpk'] < power['cp']
+    assert data['measures']['power_factor']['cp'] is None
+    assert client.get('/api/spc?model=XX9').status_code == 404
+
+    # Lowercase serials count for the model, also once the history is reloaded
+    sensors['power'] = 75
+    client.post('/scan', data={'qr_code': 'cf1.1000'})
+    client.post('/scan', data={'qr_code': 'cf1.1001'})
+    assert client.get('/api/spc?model=CF1').get_json()['measures']['power']['n'] == 23
+    client.post('/undo')
+    assert client.get('/api/spc?model=CF1').get_json()['measures']['power']['n'] == 22
+    ws.disconnect()
+    dashboard.disconnect()
+
+def test_capture_stores_waveform(client, monkeypatch, tmp_path):
+    from array import array
+    from archive import archive_closed_months
+    readings = iter([(70.0, 0.96, 310), (None, None, None), (80.0, 1.0, 330), (75.0, 0.98, 320)] * 10)
+    monkeypatch.setattr(app_module, 'CAPTURE', True)
+    monkeypatch.setattr(app_module, 'CAPTURE_WINDOW', 0.02)
+    monkeypatch.setattr(app_module, 'CAPTURE_INTERVAL', 0.005)
+    monkeypatch.setattr(app_module, 'read_bus', lambda station, priority=None: next(readings))
+
+    data = client.post('/scan', data={'qr_code': 'CF1.0001'}).get_json()['data']
+    info = client.get(f"/api/scans/{data['id']}/waveform").get_json()
+    n = info['sample_count']
+    assert n >= 3 and info['dtype'] == 'float32' and info['byteorder'] == 'little'
+
+    rv = client.get(f"/api/scans/{data['id']}/waveform/power")
+    assert rv.mimetype == 'application/octet-stream' and rv.headers['X-Sample-Count'] == str(n)
+    power = array('f', rv.data)
+    assert len(power) == n and power[:3].tolist() == [70.0, 80.0, 75.0]
+    assert data['power'] == round(sum(power) / n, 1)
+    assert client.get(f"/api/scans/{data['id']}/waveform/voltage").status_code == 400
+
+    # Archived with its scan, and still served from there
+    with app_module.get_db() as conn:
+        conn.execute("UPDATE scans SET timestamp = '2024-03-01 10:00:00', scan_date = '2024-03-01'")
+        conn.commit()
+        archive_closed_months(conn, retain_months=1, archive_dir=str(tmp_path / 'archive'), today='2024-05-10')
+        assert conn.execute("SELECT COUNT(*) FROM scan_waveforms").fetchone()[0] == 0
+    assert client.get(f"/api/scans/{data['id']}/waveform/power").data == rv.data
+
+    client.post('/clear_scans')
+    client.post('/scan', data={'qr_code': 'CF1.0002'})
+    client.post('/undo')
+    with app_module.get_db() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM scan_waveforms").fetchone()[0] == 0
+
+def test_steady_state_scan(client, monkeypatch):
+    readings = iter([(150.0, 0.5, 100), (120.0, 0.7, 200)] + [(75.0, 0.98, 320)] * 50)
+    monkeypatch.setattr(app_module, 'STEADY', True)
+    monkeypatch.setattr(app_module, 'read_bus', lambda station, priority=None: next(readings))
+
+    data = client.post('/scan', data={'qr_code': 'CF1.0001'}).get_json()
+    # Graded on the settled readings, not the spin-up ones
+    assert data['data']['status'] == 'PASS' and data['data']['power'] == 75.0
+    assert data['acquisition']['steady'] and data['acquisition']['samples'] == 2 + app_module.STEADY_SAMPLES
+    # Nothing stored unless capture mode is on too
+    assert client.get(f"/api/scans/{data['data']['id']}/waveform").status_code == 404
+
+def test_metrics_endpoint(client, sensors):
+    client.post('/scan', data={'qr_code': 'CF1.0001'})
+    app_module.broadcaster.flush()
+    rv = client.get('/metrics')
+    assert rv.status_code == 200 and rv.mimetype == 'text/plain'
+    text = rv.get_data(as_text=True)
+    assert 'qa_http_requests_total{endpoint="scan",status="200"}' in text
+    assert 'qa_http_request_seconds_bucket{endpoint="scan",method="POST",le="+Inf"}' in text
+    assert 'qa_db_statement_seconds_count{statement="INSERT scans"}' in text
+    assert 'qa_socketio_events_total{event="new_scan"}' in text
+    assert 'qa_socketio_queue_depth 0' in text
@@ -0,0 +1,43 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from broadcaster import ALL, Broadcaster, date_room
+
+
+class FakeSocketIO:
+    def __init__(self):
+        self.emitted = []
+
+    def start_background_task(self, target, *args):
+        pass  # tests flush by hand
+
+    def emit(self, event, data, to=None):
+        self.emitted.append((event, data, to))
+
+
+def test_burst_is_coalesced_per_room():
+    sio = FakeSocketIO()
+    b = Broadcaster(sio)
+    room = date_room('2024-05-01')
+    for n in range(3):
+        b.publish('new_scan', {'id': n}, room)
+        b.publish('stats_changed', {'date': '2024-05-01', 'stats': {'first_passed': n}}, room)
+    b.publish('settings_changed', {'default_voice_recognition': 'OK'}, ALL)
+    b.flush()
+
+    assert len(sio.emitted) == 2
+    event, batch, to = sio.emitted[0]
+    assert event == 'batch' and to == room
+    assert [e for e, _ in batch] == ['new_scan', 'new_scan', 'new_scan', 'stats_changed']
+    assert batch[-1][1]['stats'] == {'first_passed': 2}
+    assert sio.emitted[1][2] is ALL
+    assert b.stats()['sent'] == 5 and b.stats()['depth'] == 0
+
+
+def test_full_queue_drops_and_counts():
+    b = Broadcaster(FakeSocketIO(), max_pending=2)
+    assert b.publish('new_scan', {'id': 1})
+    assert b.publish('new_scan', {'id': 2})
+    assert not b.publish('new_scan', {'id': 3})
+    stats = b.stats()
+    assert stats['dropped'] == 1 and stats['depth'] == 2 and stats['max_depth'] == 2
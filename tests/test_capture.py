@@ -0,0 +1,57 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import struct
+
+from capture import capture, from_samples, pack, unpack
+from sensor_poller import Sample
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def test_capture_reads_for_the_window():
+    clock = FakeClock()
+    reads = iter([(70.0, 0.8, 300), (None, None, None)] + [(80.0, 1.0, 320)] * 100)
+    wave = capture(lambda: next(reads), window=1.0, interval=0.25, sleep=clock.sleep, clock=clock, now=lambda: 0)
+    assert len(wave) == 4  # reads at 0, 0.25 .. 1.0, the second one failed
+    assert wave.series['t'].tolist() == [0.0, 0.5, 0.75, 1.0]
+    assert wave.average() == (77.5, 0.95, 315)
+    assert capture(lambda: (None, None, None), window=0.2, interval=0.1, sleep=clock.sleep, clock=clock) is None
+
+def test_pack_is_little_endian_float32():
+    wave = from_samples([Sample(5.0, 100.0, 70.5, 0.9, 300), Sample(5.25, 100.25, 71.0, 0.95, 310)])
+    blob = pack(wave.series['power'])
+    assert blob == struct.pack('<2f', 70.5, 71.0)
+    assert unpack(blob).tolist() == [70.5, 71.0]
+    assert wave.series['t'].tolist() == [0.0, 0.25]
+    assert from_samples([]) is None
+
+def test_steady_state_ends_capture_early():
+    from capture import capture_steady
+    clock = FakeClock()
+    # Spin-up: power climbs, then holds within noise
+    readings = [(40.0 + 5 * i, 0.9, 200 + 20 * i) for i in range(6)]
+    readings += [(70.0 + 0.1 * (i % 2), 0.95, 320) for i in range(100)]
+    reads = iter(readings)
+    tolerance = {'power': 0.5, 'power_factor': 0.01, 'rpm': 5}
+    wave = capture_steady(lambda: next(reads), samples=5, timeout=30.0, interval=0.1, tolerance=tolerance,
+                          sleep=clock.sleep, clock=clock)
+    assert wave.steady and len(wave) == 11   # 6 ramping readings, then 5 settled ones
+    assert wave.average(5) == (70.0, 0.95, 320)
+
+    # Never settles: stops at the timeout and says so
+    clock = FakeClock()
+    reads = iter([(70.0 + 10 * (i % 2), 0.95, 320) for i in range(100)])
+    wave = capture_steady(lambda: next(reads), samples=5, timeout=1.0, interval=0.25, tolerance=tolerance,
+                          sleep=clock.sleep, clock=clock)
+    assert wave.steady is False and len(wave) == 5
@@ -0,0 +1,55 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import logging
+import sqlite3
+
+from metrics import (DB_STATEMENT_SECONDS, Counter, Histogram, TimedConnection, setup_logging, statement_label,
+                     stop_logging)
+
+
+def test_histogram_renders_cumulative_buckets():
+    h = Histogram('test_seconds', 'Test', ('slave',), buckets=(0.01, 0.1))
+    for value in (0.005, 0.01, 0.05, 2.0):
+        h.observe(value, '1')
+    lines = h.render()
+    assert 'test_seconds_bucket{slave="1",le="0.01"} 2' in lines
+    assert 'test_seconds_bucket{slave="1",le="0.1"} 3' in lines
+    assert 'test_seconds_bucket{slave="1",le="+Inf"} 4' in lines
+    assert 'test_seconds_count{slave="1"} 4' in lines
+    assert lines[1] == '# TYPE test_seconds histogram'
+
+def test_counter_escapes_labels():
+    c = Counter('test_total', 'Test', ('error',))
+    c.inc('say "hi"')
+    c.inc('say "hi"', amount=2)
+    assert c.render()[-1] == 'test_total{error="say \\"hi\\""} 3'
+
+def test_statement_label():
+    assert statement_label("SELECT id FROM scans WHERE qr_code = ?") == 'SELECT scans'
+    assert statement_label("\n  UPDATE daily_stats SET scan_count = 0") == 'UPDATE daily_stats'
+    assert statement_label("INSERT OR IGNORE INTO archived_fp_ok SELECT qr_code FROM x") == 'INSERT archived_fp_ok'
+    assert statement_label("PRAGMA user_version") == 'PRAGMA'
+
+def test_timed_connection_times_each_statement_once():
+    conn = sqlite3.connect(':memory:', factory=TimedConnection)
+    conn.execute("CREATE TABLE metrics_test (x)")
+    before = DB_STATEMENT_SECONDS.count('INSERT metrics_test')
+    conn.execute("INSERT INTO metrics_test VALUES (1)")
+    conn.cursor().execute("INSERT INTO metrics_test VALUES (2)")
+    conn.executemany("INSERT INTO metrics_test VALUES (?)", [(3,), (4,)])
+    assert DB_STATEMENT_SECONDS.count('INSERT metrics_test') == before + 3
+    assert conn.execute("SELECT COUNT(*) FROM metrics_test").fetchone()[0] == 4
+
+def test_setup_logging_goes_through_the_queue():
+    records = []
+
+    class Collect(logging.Handler):
+        def emit(self, record):
+            records.append(record.getMessage())
+
+    setup_logging(logging.DEBUG, Collect())
+    logging.getLogger('test').debug("scan %s", 'CF1.0001')
+    stop_logging()   # drains the queue
+    assert records == ['scan CF1.0001']
+    setup_logging(logging.INFO)
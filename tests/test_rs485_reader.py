@@ -0,0 +1,118 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import struct
+import pytest
+import serial
+from rs485_reader import RS485Session, SlaveTiming, calc_crc, plan_register_blocks, read_float_register
+
+
+def float_words(value):
+    raw = struct.pack('>f', value)
+    return [int.from_bytes(raw[:2], 'big'), int.from_bytes(raw[2:], 'big')]
+
+
+# (slave_id, function_code) -> {register address: 16-bit word}
+REGISTERS = {
+    (1, 0x03): dict(zip([3050, 3051, 3054, 3055], float_words(75.5) + float_words(0.98))),
+    (3, 0x04): {0x03E9: 320},
+}
+
+
+class FakeSerial:
+    opened = 0
+
+    def __init__(self, port=None, baudrate=None, bytesize=8, parity=None, stopbits=1, timeout=1):
+        FakeSerial.opened += 1
+        self.port = port
+        self.baudrate = baudrate or 9600
+        self.parity = parity
+        self.timeout = timeout
+        self.inter_byte_timeout = None
+        self.is_open = True
+        self._pending = b''
+        self.corrupt_next = 0
+        self.requests = []
+
+    def reset_input_buffer(self):
+        self._pending = b''
+
+    def write(self, data):
+        data = bytes(data)
+        self.requests.append(data)
+        slave_id, function_code = data[0], data[1]
+        start, count = int.from_bytes(data[2:4], 'big'), int.from_bytes(data[4:6], 'big')
+        registers = REGISTERS.get((slave_id, function_code))
+        if registers is None:
+            self._pending = b''
+            return
+        body = bytes([slave_id, function_code, 2 * count])
+        body += b''.join(registers.get(start + i, 0).to_bytes(2, 'big') for i in range(count))
+        self._pending = body + calc_crc(body)
+        if self.corrupt_next:
+            self.corrupt_next -= 1
+            self._pending = self._pending[:-1] + bytes([self._pending[-1] ^ 0xFF])
+
+    def read(self, size=1):
+        data, self._pending = self._pending[:size], self._pending[size:]
+        return data
+
+    def close(self):
+        self.is_open = False
+
+
+def test_session_keeps_port_open(monkeypatch):
+    monkeypatch.setattr(serial, 'Serial', FakeSerial)
+    FakeSerial.opened = 0
+    session = RS485Session(port='TEST')
+    assert session.read_all() == (75.5, 0.98, 320)
+    assert session.read_all() == (75.5, 0.98, 320)
+    assert FakeSerial.opened == 1
+    assert session._ser.parity == serial.PARITY_NONE
+    # one coalesced meter request plus one RPM request per scan
+    assert len(session._ser.requests) == 4
+
+
+def test_calc_crc_known_vector():
+    # Read holding registers 0x0000 x1 from slave 1
+    assert calc_crc(bytes([0x01, 0x03, 0x00, 0x00, 0x00, 0x01])) == bytes([0x84, 0x0A])
+
+
+def test_read_float_register_retries_bad_crc():
+    from metrics import MODBUS_ERRORS, MODBUS_SECONDS
+    crc_errors, replies = MODBUS_ERRORS.value('1', 'crc'), MODBUS_SECONDS.count('1')
+    ser = FakeSerial(port='TEST')
+    ser.corrupt_next = 1
+    timing = SlaveTiming()
+    assert round(read_float_register(ser, 1, 3051, timing), 1) == 75.5
+    assert timing.srtt is not None
+    assert timing.timeout < 1.0
+    assert MODBUS_ERRORS.value('1', 'crc') == crc_errors + 1
+    assert MODBUS_SECONDS.count('1') == replies + 1
+
+
+def test_read_float_register_gives_up_after_retries():
+    ser = FakeSerial(port='TEST')
+    ser.corrupt_next = 10
+    assert read_float_register(ser, 1, 3051) is None
+    assert ser.corrupt_next == 7
+
+
+def test_plan_register_blocks_merges_nearby_registers():
+    params = [("Power Factor", 3055), ("Active Power (W)", 3051), ("Frequency", 3110)]
+    assert plan_register_blocks(params) == [
+        (3051, 6, [("Active Power (W)", 0), ("Power Factor", 4)]),
+        (3110, 2, [("Frequency", 0)]),
+    ]
+    assert len(plan_register_blocks(params, max_block=4)) == 3
+
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='needs a pty')
+def test_session_against_simulator():
+    from modbus_sim import ModbusSimulator
+    with ModbusSimulator(latency=0, crc_error_rate=0.2, seed=3) as sim:
+        session = RS485Session(port=sim.port, meter_parity=serial.PARITY_NONE)
+        try:
+            assert session.read_all() == (75.5, 0.98, 320)
+        finally:
+            session.close()
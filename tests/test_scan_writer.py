@@ -0,0 +1,135 @@
+import sys
+import os
+import json
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import app as app_module
+from app import app
+from scan_writer import ScanWriter, WriterStalledError
+import pytest
+
+@pytest.fixture(autouse=True)
+def write_behind(client, tmp_path, monkeypatch):
+    # The client fixture (conftest.py) with the app in write-behind mode
+    monkeypatch.setattr(app_module, 'read_sensors', lambda station_id=None: (75.5, 0.98, 320))
+    writer = ScanWriter(app_module.connect_db, str(tmp_path / 'scan_log.db.pending'), fsync=False,
+                        guard=app_module.duplicate_guard).start()
+    monkeypatch.setattr(app_module, 'scan_writer', writer)
+    yield writer
+    writer.stop()
+
+def test_write_behind_scans_and_undo(client):
+    first = client.post('/scan', data={'qr_code': 'CF1.0001'}).get_json()
+    second = client.post('/scan', data={'qr_code': 'CF1.0002'}).get_json()
+    assert (first['data']['daily_number'], second['data']['daily_number']) == (1, 2)
+    assert second['data']['id'] == first['data']['id'] + 1
+    assert second['stats']['first_passed'] == 2
+
+    # A queued FP OK blocks a second one for the same unit
+    assert client.post('/scan', data={'qr_code': 'CF1.0002'}).get_json()['duplicate_fp_ok']
+
+    # /undo waits for the writer, so it removes the scan just acknowledged
+    data = client.post('/undo').get_json()
+    assert data['id'] == second['data']['id'] and data['stats']['first_passed'] == 1
+    third = client.post('/scan', data={'qr_code': 'CF1.0003'}).get_json()
+    assert third['data']['daily_number'] == 2
+
+    client.post('/api/flush')
+    with app_module.get_db() as conn:
+        rows = conn.execute("SELECT qr_code, daily_number FROM scans ORDER BY id").fetchall()
+    assert [tuple(r) for r in rows] == [('CF1.0001', 1), ('CF1.0003', 2)]
+    assert os.path.getsize(app_module.scan_writer.journal_path) == 0
+
+def test_journal_replayed_after_crash(client, tmp_path):
+    journal = str(tmp_path / 'crashed.pending')
+    scan = {'id': 500, 'daily_number': 1, 'qr_code': 'CF1.0009', 'power': 75, 'rpm': 320,
+            'power_factor': 0.98, 'failure_code': 'NA', 'status': 'PASS', 'timestamp': '2024-05-01 10:00:00',
+            'result': 'FP OK', 'voice_recognition': 'NA', 'station': '1', 'scan_date': '2024-05-01'}
+    with open(journal, 'w') as f:
+        f.write(json.dumps(scan) + '\n')
+        f.write('{"id": 501, "qr_co')  # torn write
+
+    assert ScanWriter(app_module.connect_db, journal).replay() == 1
+    assert ScanWriter(app_module.connect_db, journal).replay() == 0
+    with app_module.get_db() as conn:
+        assert conn.execute("SELECT qr_code FROM scans WHERE id = 500").fetchone()[0] == 'CF1.0009'
+
+def test_concurrent_duplicate_fp_ok_rejected(client, monkeypatch):
+    import threading
+    import time
+
+    def slow_read(station_id=None):
+        time.sleep(0.2)  # both requests are past the early duplicate check
+        return 75.5, 0.98, 320
+    monkeypatch.setattr(app_module, 'read_sensors', slow_read)
+
+    results = []
+    def post():
+        with app.test_client() as c:
+            results.append(c.post('/scan', data={'qr_code': 'CF1.0001'}).get_json())
+    threads = [threading.Thread(target=post) for _ in range(2)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert sorted(bool(r.get('success')) for r in results) == [False, True]
+    assert any(r.get('duplicate_fp_ok') for r in results)
+    client.post('/api/flush')
+    with app_module.get_db() as conn:
+        rows = conn.execute("SELECT result, fp_ok_duplicate FROM scans").fetchall()
+    assert [tuple(r) for r in rows] == [('FP OK', 0)]
+
+def test_flush_times_out_while_database_is_locked(client):
+    blocker = app_module.connect_db()
+    blocker.execute("BEGIN IMMEDIATE")
+    try:
+        data = client.post('/scan', data={'qr_code': 'CF1.0001'}).get_json()
+        assert data['success']  # journaled, the writer keeps retrying
+        with pytest.raises(WriterStalledError):
+            app_module.scan_writer.flush(timeout=0.2)
+        app_module.scan_writer.flush = lambda timeout=None: (_ for _ in ()).throw(WriterStalledError('stalled'))
+        rv = client.get('/api/scans')
+        assert rv.status_code == 503 and 'not accepting writes' in rv.get_json()['error']
+    finally:
+        blocker.rollback()
+        blocker.close()
+        del app_module.scan_writer.flush
+    app_module.scan_writer.flush(timeout=10)
+    assert client.get('/api/scans').get_json()['scans'][0]['id'] == data['data']['id']
+
+def test_scan_during_batch_import_waits_for_it(client, monkeypatch):
+    import threading
+    import time
+    from datetime import datetime
+    today = datetime.now().strftime('%Y-%m-%d')
+    first = client.post('/scan', data={'qr_code': 'CF1.0001'}).get_json()['data']
+
+    scanned = []
+    def scan():
+        with app.test_client() as c:
+            scanned.append(c.post('/scan', data={'qr_code': 'CF1.0002'}).get_json())
+    insert_chunks = app_module.insert_chunks
+    def slow_insert(conn, scans):
+        thread = threading.Thread(target=scan)
+        thread.start()
+        time.sleep(0.2)  # the scan is waiting on the writer by now
+        insert_chunks(conn, scans)
+        slow_insert.thread = thread
+    monkeypatch.setattr(app_module, 'insert_chunks', slow_insert)
+
+    lines = [f'{{"qr_code": "CF1.{n:04d}", "power": 75, "rpm": 320, "power_factor": 0.98, '
+             f'"timestamp": "{today} 00:00:0{n % 10}"}}' for n in range(10, 13)]
+    lines.append('{"qr_code": "CF1.0001", "power": 75, "rpm": 320, "power_factor": 0.98}')
+    data = client.post('/api/scans/batch', data='\n'.join(lines)).get_json()
+    slow_insert.thread.join(5)
+    assert data['summary'] == {'inserted': 3, 'duplicate': 1, 'invalid': 0}
+
+    (scan,) = scanned
+    assert scan['data']['daily_number'] == 5
+    assert scan['data']['id'] > max(o['id'] for o in data['outcomes'] if o['status'] == 'inserted')
+    client.post('/api/flush')
+    with app_module.get_db() as conn:
+        rows = conn.execute("SELECT id, daily_number FROM scans WHERE qr_code = 'CF1.0002'").fetchall()
+        numbers = [r[0] for r in conn.execute("SELECT daily_number FROM scans ORDER BY daily_number")]
+    assert [tuple(r) for r in rows] == [(scan['data']['id'], 5)]
+    assert numbers == [1, 2, 3, 4, 5] and first['daily_number'] == 1
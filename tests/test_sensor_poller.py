@@ -0,0 +1,17 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from sensor_poller import SensorPoller
+
+
+def test_latest_and_average():
+    readings = iter([(100.0, 0.9, 300), (110.0, 0.94, 310), (None, None, None)])
+    poller = SensorPoller(read=lambda: next(readings), size=4)
+    poller.poll_once()
+    poller.poll_once()
+    assert poller.poll_once() is None  # incomplete readings are not buffered
+
+    assert poller.latest(max_age=5).power == 110.0
+    avg = poller.average(window=5, max_age=5)
+    assert (avg.power, avg.power_factor, avg.rpm) == (105.0, 0.92, 305)
+    assert poller.latest(max_age=-1) is None
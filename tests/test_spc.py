@@ -0,0 +1,36 @@
+import sys
+import os
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import statistics
+from spc import MeasureChart, RunningStats, capability, check_rules, column_stats
+
+
+def test_running_stats_match_batch():
+    values = [75.1, 74.8, 75.6, 76.0, 74.9, 75.3, 75.2]
+    stats = RunningStats()
+    for x in values:
+        stats.add(x)
+    assert abs(stats.mean - statistics.mean(values)) < 1e-12
+    assert abs(stats.std - statistics.stdev(values)) < 1e-12
+    n, mean, m2 = column_stats(values)
+    assert n == 7 and abs(mean - stats.mean) < 1e-12 and abs(m2 - stats.m2) < 1e-9
+
+    cp, cpk = capability(stats, 50, 100)
+    assert abs(cp - 50 / (6 * stats.std)) < 1e-9
+    assert abs(cpk - (100 - stats.mean) / (3 * stats.std)) < 1e-9
+    assert capability(stats, 0.9, None)[0] is None
+
+
+def test_western_electric_rules():
+    assert check_rules([0.1, -0.2, 3.5]) == [1]
+    assert check_rules([2.5, 0.0, 2.2]) == [2]
+    assert check_rules([1.5, 1.2, -0.5, 1.1, 1.4]) == [3]
+    assert check_rules([0.2, 0.5, 0.1, 0.3, 0.4, 0.2, 0.6, 0.3]) == [4]
+    assert check_rules([0.2, -0.5, 0.1]) == []
+
+
+def test_chart_flags_drift():
+    chart = MeasureChart()
+    for n in range(30):
+        chart.observe(n, '', 75 + (0.5 if n % 2 else -0.5))
+    assert chart.observe(30, '', 79) == [1]